@@ -12,6 +12,7 @@ from .libs.excel_wrapper import (
 )
 from .libs.md5lines import MD5Parser
 from .resource_metadata import resource_metadata_from_file, resource_metadata_id
+from .profiling import phase
 from .util import make_logger, one
 import re
 
@@ -480,8 +481,10 @@ class BaseMetadata:
         # ensure that each class can expect to have _get_packages() called first,
         # then _get_resources(), and only once in the entire lifetime of the class.
         if self._packages is None:
-            self._packages = self._get_packages()
-            self._resources = self._get_resources()
+            with phase("get-packages"):
+                self._packages = self._get_packages()
+            with phase("get-resources"):
+                self._resources = self._get_resources()
             BaseMetadata.resources_add_format(self._resources)
             BaseMetadata.obj_round_floats_and_stringify(self._packages)
             BaseMetadata.obj_round_floats_and_stringify(
@@ -0,0 +1,328 @@
+import asyncio
+import random
+import time
+
+import ckanapi
+from ckanapi.common import prepare_action, reverse_apicontroller_action
+
+from .metrics import metrics
+from .ops import (
+    FINGERPRINT_FIELD,
+    method_stats,
+    method_stats_lock,
+    object_fingerprint,
+    plan_patch,
+)
+from .sync import package_compare_obj
+from .scheduler import (
+    DEFAULT_POLICY,
+    RETRY_POLICIES,
+    TIMEOUT,
+    RetryBudget,
+    classify_error,
+)
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+# the actions the sync path makes; anything else should use ckanapi
+ACTIONS = (
+    "package_show",
+    "package_create",
+    "package_patch",
+    "package_search",
+    "dataset_purge",
+    "resource_show",
+    "resource_create",
+    "resource_patch",
+    "resource_update",
+    "resource_delete",
+)
+
+
+class ActionProxy:
+    def __init__(self, ckan):
+        self._ckan = ckan
+
+    def __getattr__(self, action):
+        if action not in ACTIONS:
+            raise AttributeError(action)
+
+        async def _call(**kwargs):
+            return await self._ckan.call_action(action, kwargs)
+
+        return _call
+
+
+class AsyncCKAN:
+    """
+    a CKAN action client for asyncio, holding a pool of keep-alive connections.
+    errors are those `ckanapi.RemoteCKAN` raises; transient failures are retried
+    under the same policies as the synchronous scheduler, see `scheduler`.
+
+        async with AsyncCKAN(address, apikey) as ckan:
+            package = await ckan.action.package_show(id=...)
+
+    requires aiohttp.
+    """
+
+    def __init__(
+        self,
+        address,
+        apikey=None,
+        verify_ssl=True,
+        max_in_flight=100,
+        timeout=300,
+        backoff_base=0.5,
+        backoff_cap=30.0,
+    ):
+        self.address = address.rstrip("/")
+        self.apikey = apikey
+        self.verify_ssl = verify_ssl
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.budget = RetryBudget()
+        self.action = ActionProxy(self)
+        self._session = None
+        self._in_flight = None
+
+    async def __aenter__(self):
+        import aiohttp
+
+        self._timeout_errors = (asyncio.TimeoutError, aiohttp.ClientConnectionError)
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.max_in_flight, ssl=None if self.verify_ssl else False
+            ),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+        self._session = None
+
+    async def _post(self, url, data, headers):
+        "returns the status and text of the response"
+        async with self._session.post(url, data=data, headers=headers) as response:
+            return response.status, await response.text()
+
+    def _classify(self, e):
+        if isinstance(e, getattr(self, "_timeout_errors", ())):
+            return TIMEOUT
+        return classify_error(e)
+
+    async def call_action(self, action, data_dict=None):
+        object_type, method = action.rsplit("_", 1)
+        with method_stats_lock:
+            method_stats[(object_type, method)] += 1
+        path, data, headers = prepare_action(action, data_dict, self.apikey)
+        url = self.address + "/" + path
+        policy = RETRY_POLICIES.get(method, DEFAULT_POLICY)
+        attempt = 0
+        while True:
+            attempt += 1
+            self.budget.deposit()
+            start = None
+            try:
+                async with self._in_flight:
+                    start = time.perf_counter()
+                    status, response = await self._post(url, data, headers)
+                result = reverse_apicontroller_action(url, status, response)
+            except Exception as e:
+                kind = self._classify(e)
+                if start is not None:
+                    metrics.observe_call(
+                        object_type,
+                        method,
+                        time.perf_counter() - start,
+                        kind or type(e).__name__,
+                    )
+                if kind is None or not policy.may_retry(kind):
+                    raise
+                if attempt >= policy.attempts or not self.budget.withdraw():
+                    logger.error("%s failed (%s), giving up: %s" % (action, kind, e))
+                    raise
+                metrics.count_retry(object_type, method, kind)
+                delay = min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1))
+                delay *= random.uniform(0.5, 1.0)
+                logger.warning(
+                    "%s failed (%s), retrying in %.1fs (attempt %d of %d)"
+                    % (action, kind, delay, attempt, policy.attempts)
+                )
+            else:
+                metrics.observe_call(object_type, method, time.perf_counter() - start)
+                return result
+            await asyncio.sleep(delay)
+
+
+async def patch_if_required(
+    ckan, object_type, ckan_object, patch_object, fingerprint=False
+):
+    "see `ops.patch_if_required`"
+    patch_needed, patch, fingerprint_only = plan_patch(
+        object_type, ckan_object, patch_object, fingerprint=fingerprint
+    )
+    if patch is not None:
+        ckan_object = await ckan.call_action(object_type + "_patch", patch)
+    return patch_needed, ckan_object, fingerprint_only
+
+
+async def get_or_create_package(ckan, obj):
+    "see `sync.get_or_create_package`"
+    try:
+        ckan_obj = await ckan.action.package_show(id=obj["name"])
+        if ckan_obj["state"] == "deleted":
+            logger.info(
+                "found %s package object, purging: %s"
+                % (ckan_obj["state"], ckan_obj["id"])
+            )
+            await ckan.action.dataset_purge(id=ckan_obj["id"])
+            raise ckanapi.errors.NotFound
+    except ckanapi.errors.NotFound:
+        create_obj = dict(
+            (k, obj[k])
+            for k in (
+                "type",
+                "id",
+                "name",
+                "owner_org",
+                "private",
+                "resource_permissions",
+                "access_control_reason",
+                "access_control_date",
+                "access_control_mode",
+            )
+        )
+        ckan_obj = await ckan.action.package_create(**create_obj)
+        logger.info("created package object: %s" % (obj["id"]))
+    return ckan_obj
+
+
+async def sync_package(ckan, obj, cached_obj):
+    "see `sync.sync_package`"
+    if cached_obj is None:
+        ckan_obj = await get_or_create_package(ckan, obj)
+    else:
+        ckan_obj = cached_obj
+    patch_obj = obj.copy()
+    patch_obj["id"] = ckan_obj["id"]
+    was_patched, ckan_obj, fingerprint_only = await patch_if_required(
+        ckan, "package", package_compare_obj(ckan_obj), patch_obj, fingerprint=True
+    )
+    if was_patched:
+        logger.info("patched package object: %s" % (obj["id"]))
+    elif fingerprint_only:
+        logger.debug("recorded fingerprint of package object: %s" % (obj["id"]))
+    return ckan_obj
+
+
+async def sync_packages(ckan, to_sync, cache):
+    """
+    sync the package objects `to_sync` (see `sync.package_targets`), all at
+    once; the client limits the requests in flight. results are in the order
+    of `to_sync`.
+    """
+    return await asyncio.gather(
+        *[sync_package(ckan, obj, cache.get(obj["id"])) for obj in to_sync]
+    )
+
+
+async def sync_package_resources(
+    ckan, package_obj, resource_id_legacy_url, resources, do_delete
+):
+    """
+    create, delete and patch the resources of one package, see
+    `sync.sync_package_resources`. each change to a resource rewrites its
+    package, so the changes to one package are made in turn; it is across
+    packages that requests are overlapped.
+    """
+    existing_ids = set(t["id"] for t in package_obj["resources"])
+    needed_resources = dict((t["id"], t) for t in resources)
+    if len(needed_resources) != len(resources):
+        raise Exception(
+            "duplicate resource IDs in package {}".format(package_obj["id"])
+        )
+    to_create = [t for t in resources if t["id"] not in existing_ids]
+    to_delete = sorted(existing_ids - set(needed_resources))
+
+    to_reupload = []
+    for resource_obj in to_create:
+        create_obj = resource_obj.copy()
+        create_obj["url"] = resource_id_legacy_url[resource_obj["id"]]
+        create_obj[FINGERPRINT_FIELD] = object_fingerprint(resource_obj)
+        ckan_obj = await ckan.action.resource_create(**create_obj)
+        logger.info(
+            "created resource: %s/%s" % (create_obj["package_id"], ckan_obj["id"])
+        )
+        to_reupload.append((ckan_obj, create_obj["url"]))
+    for obj_id in to_delete:
+        logger.info(
+            "resource for deletion: %s/%s (do_delete=%s)"
+            % (package_obj["id"], obj_id, do_delete)
+        )
+        if do_delete:
+            await ckan.action.resource_delete(id=obj_id)
+            logger.info("deleted resource: %s/%s" % (package_obj["id"], obj_id))
+    if to_create or to_delete:
+        package_obj = await ckan.action.package_show(id=package_obj["id"])
+    for current_ckan_obj in package_obj["resources"]:
+        resource_obj = needed_resources.get(current_ckan_obj["id"])
+        if resource_obj is None:
+            continue
+        was_patched, _, fingerprint_only = await patch_if_required(
+            ckan, "resource", current_ckan_obj, resource_obj, fingerprint=True
+        )
+        if was_patched:
+            logger.info("patched resource: %s" % (current_ckan_obj["id"]))
+        elif fingerprint_only:
+            logger.debug(
+                "recorded fingerprint of resource: %s" % (current_ckan_obj["id"])
+            )
+    return to_reupload
+
+
+async def sync_all_package_resources(
+    ckan, ckan_packages, resource_idx, resource_id_legacy_url, do_delete
+):
+    "`sync_package_resources` for each of `ckan_packages`, concurrently"
+    with_resources = []
+    for package_obj in sorted(ckan_packages, key=lambda p: p["name"]):
+        if package_obj["id"] not in resource_idx:
+            logger.warning("No resources for package `%s`" % (package_obj["id"]))
+            continue
+        with_resources.append(package_obj)
+    results = await asyncio.gather(
+        *[
+            sync_package_resources(
+                ckan,
+                package_obj,
+                resource_id_legacy_url,
+                resource_idx[package_obj["id"]],
+                do_delete,
+            )
+            for package_obj in with_resources
+        ]
+    )
+    return [t for r in results for t in r]
+
+
+def run(ckan, max_in_flight, coro_fn, *args):
+    """
+    run `coro_fn(client, *args)` to completion, where client is an `AsyncCKAN`
+    connected to the same CKAN as `ckan` (a `ckanapi.RemoteCKAN`)
+    """
+
+    async def _run():
+        async with AsyncCKAN(
+            ckan.address,
+            apikey=ckan.apikey,
+            verify_ssl=getattr(ckan, "verify_ssl", True),
+            max_in_flight=max_in_flight,
+        ) as client:
+            return await coro_fn(client, *args)
+
+    return asyncio.run(_run())
@@ -0,0 +1,251 @@
+import json
+import os
+import time
+from hashlib import md5
+
+import ckanapi
+
+from .fakeckan import FakeCKANServer
+from .genhash import genhash, localpath
+from .libs.multihash import S3_HASH_FIELDS
+from .ops import method_stats, method_stats_lock
+from .pkgcache import build_resource_cache
+from .sync import sync_metadata
+from .util import make_ckan_session, make_logger
+
+logger = make_logger(__name__)
+
+PHASES = ("sync", "resync", "genhash", "check")
+
+
+class SyntheticMetadata:
+    """
+    a stand-in for a project's metadata class, with `n_packages` packages
+    each of `resources_per_package` resources. everything is derived from
+    the package and resource numbers, so two instances are identical.
+    """
+
+    organization = "bpa-benchmark"
+    ckan_data_type = "bpa-benchmark"
+    resource_linkage = ("sample_id",)
+
+    def __init__(self, archive_url, n_packages, resources_per_package, file_size=1024):
+        self.archive_url = archive_url.rstrip("/")
+        self.n_packages = n_packages
+        self.resources_per_package = resources_per_package
+        self.file_size = file_size
+
+    def sample_id(self, i):
+        return "102.100.100/%06d" % (i)
+
+    def get_packages(self):
+        return [
+            {
+                "id": "bpa-benchmark-%06d" % (i),
+                "name": "bpa-benchmark-%06d" % (i),
+                "type": self.ckan_data_type,
+                "title": "Benchmark sample %d" % (i),
+                "sample_id": self.sample_id(i),
+                "ticket": "BPA-BENCH-%d" % (i % 10),
+                "private": True,
+                "resource_permissions": "",
+                "access_control_reason": "",
+                "access_control_date": "",
+                "access_control_mode": "",
+                "notes": "synthetic package %d of %d" % (i, self.n_packages),
+                "tags": [{"name": "benchmark"}],
+            }
+            for i in range(self.n_packages)
+        ]
+
+    def file_data(self, i, j):
+        line = ("package %d resource %d\n" % (i, j)).encode("utf8")
+        return (line * (1 + self.file_size // len(line)))[: self.file_size]
+
+    def file_path(self, i, j):
+        return "/bpa/benchmark/%06d/sample_%06d_%02d.fastq.gz" % (i, i, j)
+
+    def get_resources(self):
+        resources = []
+        for i in range(self.n_packages):
+            for j in range(self.resources_per_package):
+                resource_id = "%032x" % (i * 1000 + j)
+                path = self.file_path(i, j)
+                obj = {
+                    "id": resource_id,
+                    "name": os.path.basename(path),
+                    "resource_type": self.ckan_data_type,
+                    "md5": md5(self.file_data(i, j)).hexdigest(),
+                    "read": "R%d" % (j % 2 + 1),
+                }
+                resources.append(((self.sample_id(i),), self.archive_url + path, obj))
+        return resources
+
+    def write_mirror(self, mirror_path):
+        "write the synthetic files to a local mirror of the archive"
+        for i in range(self.n_packages):
+            for j in range(self.resources_per_package):
+                fpath = localpath(mirror_path, self.archive_url + self.file_path(i, j))
+                os.makedirs(os.path.dirname(fpath), exist_ok=True)
+                with open(fpath, "wb") as fd:
+                    fd.write(self.file_data(i, j))
+
+
+def populate_archive(fake, meta):
+    for i in range(meta.n_packages):
+        for j in range(meta.resources_per_package):
+            fake.add_archive_file(meta.file_path(i, j), meta.file_size)
+
+
+def upload_all(fake, ckan, meta):
+    """
+    mark every resource as uploaded to S3, with the etag genhash calculated (if
+    it has been run), so that the resource checks pass
+    """
+    for resource_id, resource in build_resource_cache(
+        ckan, meta.ckan_data_type, meta.get_packages()
+    ).items():
+        etags = [resource.get(t) for t in S3_HASH_FIELDS if resource.get(t)]
+        fake.upload(resource_id, meta.file_size, etags[0] if etags else resource["md5"])
+
+
+def snapshot_stats():
+    with method_stats_lock:
+        return dict(method_stats)
+
+
+def stats_since(before):
+    after = snapshot_stats()
+    calls = {}
+    for key, count in after.items():
+        delta = count - before.get(key, 0)
+        if delta:
+            calls["%s_%s" % key] = delta
+    return calls
+
+
+class Benchmark:
+    """
+    runs the sync path against a `FakeCKANServer`, one phase at a time,
+    recording the CKAN calls made and the time taken by each phase
+    """
+
+    def __init__(self, server, meta, num_threads=4, mirror_path=None):
+        self.server = server
+        self.meta = meta
+        self.num_threads = num_threads
+        self.mirror_path = mirror_path
+        self.ckan = ckanapi.RemoteCKAN(
+            server.url, apikey="benchmark", session=make_ckan_session(num_threads)
+        )
+        server.ckan.add_organization(meta.organization)
+        populate_archive(server.ckan, meta)
+        self.results = []
+
+    def run_phase(self, name, fn, objects):
+        logger.info("benchmark phase: %s" % (name))
+        before = snapshot_stats()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        calls = stats_since(before)
+        result = {
+            "phase": name,
+            "seconds": round(elapsed, 3),
+            "calls": calls,
+            "total_calls": sum(calls.values()),
+            "objects": objects,
+            "objects_per_second": round(objects / elapsed, 1) if elapsed else None,
+            "calls_per_second": (
+                round(sum(calls.values()) / elapsed, 1) if elapsed else None
+            ),
+        }
+        self.results.append(result)
+        return result
+
+    def sync(self, do_resource_checks=False, **kwargs):
+        sync_metadata(
+            self.ckan,
+            self.meta,
+            None,
+            self.num_threads,
+            False,
+            do_resource_checks,
+            False,
+            False,
+            None,
+            check_threads=self.num_threads,
+            **kwargs,
+        )
+
+    def genhash(self):
+        self.meta.write_mirror(self.mirror_path)
+        genhash(self.ckan, self.meta, self.mirror_path, self.num_threads)
+
+    def check(self):
+        self.sync(do_resource_checks=True)
+
+    def run(self, phases=PHASES):
+        n_resources = self.meta.n_packages * self.meta.resources_per_package
+        objects = {
+            "sync": n_resources + self.meta.n_packages,
+            "resync": n_resources + self.meta.n_packages,
+            "genhash": n_resources,
+            "check": n_resources,
+        }
+        for name in PHASES:
+            if name not in phases:
+                continue
+            if name == "genhash" and self.mirror_path is None:
+                logger.warning("no mirror path: skipping genhash")
+                continue
+            if name == "check":
+                # outside the timing: a real sync would find the files uploaded
+                upload_all(self.server.ckan, self.ckan, self.meta)
+            fn = self.sync if name == "resync" else getattr(self, name)
+            self.run_phase(name, fn, objects[name])
+        return self.results
+
+
+def format_report(results):
+    lines = [
+        "%-8s %9s %8s %10s %10s" % ("phase", "seconds", "calls", "calls/s", "objects/s")
+    ]
+    for result in results:
+        lines.append(
+            "%-8s %9.3f %8d %10s %10s"
+            % (
+                result["phase"],
+                result["seconds"],
+                result["total_calls"],
+                result["calls_per_second"],
+                result["objects_per_second"],
+            )
+        )
+        for action, count in sorted(result["calls"].items()):
+            lines.append("    %-24s %d" % (action, count))
+    return "\n".join(lines)
+
+
+def run_benchmark(
+    n_packages,
+    resources_per_package,
+    num_threads=4,
+    latency=0.0,
+    error_rate=0.0,
+    error_status=503,
+    mirror_path=None,
+    phases=PHASES,
+    seed=None,
+):
+    with FakeCKANServer(
+        latency=latency, error_rate=error_rate, error_status=error_status, seed=seed
+    ) as server:
+        meta = SyntheticMetadata(server.url, n_packages, resources_per_package)
+        benchmark = Benchmark(server, meta, num_threads, mirror_path)
+        return benchmark.run(phases)
+
+
+def write_report(results, path):
+    with open(path, "w") as fd:
+        json.dump(results, fd, indent=2, sort_keys=True)
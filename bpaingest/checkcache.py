@@ -0,0 +1,191 @@
+import datetime
+import sqlite3
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from .ops import ckan_method
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+VERIFIED_AT_FIELD = "s3_etag_verified_at"
+VERIFIED_SIZE_FIELD = "s3_verified_size"
+VERIFIED_ETAG_FIELD = "s3_verified_etag"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS verified (
+    resource_id TEXT PRIMARY KEY,
+    verified_at TEXT NOT NULL,
+    url TEXT,
+    size INTEGER,
+    etag TEXT,
+    metadata_modified TEXT
+);
+"""
+
+
+def utcnow():
+    return (
+        datetime.datetime.now(datetime.timezone.utc)
+        .replace(microsecond=0)
+        .replace(tzinfo=None)
+    )
+
+
+def parse_timestamp(s):
+    "CKAN timestamps are ISO 8601, in UTC, without a timezone"
+    try:
+        return datetime.datetime.fromisoformat(s[:19])
+    except (TypeError, ValueError):
+        return None
+
+
+class CheckResultCache:
+    """
+    a local record, held in SQLite, of each resource which has passed its
+    check: when, against which URL, and the size and etag seen on S3
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get(self, resource_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT verified_at, url, size, etag, metadata_modified FROM verified WHERE resource_id = ?",
+                (resource_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(
+            zip(("verified_at", "url", "size", "etag", "metadata_modified"), row)
+        )
+
+    def record(self, resource_id, verified_at, url, size, etag, metadata_modified):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO verified (resource_id, verified_at, url, size, etag, metadata_modified) VALUES (?, ?, ?, ?, ?, ?)",
+                (resource_id, verified_at, url, size, etag, metadata_modified),
+            )
+
+    def set_metadata_modified(self, resource_id, metadata_modified):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE verified SET metadata_modified = ? WHERE resource_id = ?",
+                (metadata_modified, resource_id),
+            )
+
+
+class ResourceVerifier:
+    """
+    decides which resources can skip their check, and records the outcome of
+    those which pass. a resource is skipped if it was verified within
+    `max_age` (a timedelta), or, with `skip_unmodified`, if its CKAN
+    `metadata_modified` has not changed since it was verified. a resource
+    whose URL has changed since it was verified is always checked.
+
+    verifications are read from, and written to, `cache` (a `CheckResultCache`)
+    if given. with `write_ckan` set they are also stored on the CKAN resource,
+    from which they are read when `cache` has no record.
+    """
+
+    def __init__(
+        self, cache=None, max_age=None, skip_unmodified=False, write_ckan=False
+    ):
+        self.cache = cache
+        self.max_age = max_age
+        self.skip_unmodified = skip_unmodified
+        self.write_ckan = write_ckan
+        self._lock = threading.Lock()
+        self._verified = []
+
+    def _last_verified(self, resource):
+        record = self.cache.get(resource["id"]) if self.cache is not None else None
+        if record is None and resource.get(VERIFIED_AT_FIELD):
+            record = {
+                "verified_at": resource[VERIFIED_AT_FIELD],
+                "url": resource.get("url"),
+                "metadata_modified": None,
+            }
+        return record
+
+    def is_fresh(self, resource, now=None):
+        "True if the check of `resource` can be skipped"
+        record = self._last_verified(resource)
+        if record is None or record["url"] != resource.get("url"):
+            return False
+        if self.max_age is not None:
+            verified_at = parse_timestamp(record["verified_at"])
+            if (
+                verified_at is not None
+                and (now or utcnow()) - verified_at <= self.max_age
+            ):
+                return True
+        if self.skip_unmodified and record["metadata_modified"]:
+            return record["metadata_modified"] == resource.get("metadata_modified")
+        return False
+
+    def verified(self, resource, size, etag):
+        "record that `resource` has passed its check"
+        verified_at = utcnow().isoformat()
+        if self.cache is not None:
+            self.cache.record(
+                resource["id"],
+                verified_at,
+                resource.get("url"),
+                size,
+                etag,
+                resource.get("metadata_modified"),
+            )
+        if self.write_ckan:
+            with self._lock:
+                self._verified.append((resource, verified_at, size, etag))
+
+    def flush(self, ckan, num_threads=4):
+        """
+        write the verifications recorded since the last flush to CKAN. patching a
+        resource rewrites its package, so each package's resources are patched in
+        turn; packages are patched in parallel.
+        """
+        with self._lock:
+            verified, self._verified = self._verified, []
+        if not verified:
+            return
+        by_package = defaultdict(list)
+        for t in verified:
+            by_package[t[0].get("package_id")].append(t)
+        logger.info("recording verification of %d resources in CKAN" % (len(verified)))
+
+        def patch_package(package_verified):
+            for resource, verified_at, size, etag in package_verified:
+                try:
+                    patched = ckan_method(ckan, "resource", "patch")(
+                        id=resource["id"],
+                        **{
+                            VERIFIED_AT_FIELD: verified_at,
+                            VERIFIED_SIZE_FIELD: size,
+                            VERIFIED_ETAG_FIELD: (etag or "").strip('"'),
+                        }
+                    )
+                except Exception as e:
+                    logger.error(
+                        "unable to record verification of %s: %s" % (resource["id"], e)
+                    )
+                    continue
+                # the patch moves metadata_modified on; remember the new value,
+                # so that the resource is still seen as unmodified next time
+                if self.cache is not None:
+                    self.cache.set_metadata_modified(
+                        resource["id"], patched.get("metadata_modified")
+                    )
+
+        with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+            list(executor.map(patch_package, by_package.values()))
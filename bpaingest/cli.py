@@ -1,12 +1,16 @@
 import argparse
+import datetime
 import logging
 import sys
 import os
+import tempfile
 
 from .util import (
     make_registration_decorator,
     make_ckan_api,
     make_reuploads_cache_path,
+    make_state_cache_path,
+    make_check_cache_path,
     validate_write_reuploads_interval,
 )
 from .sync import sync_metadata
@@ -17,7 +21,23 @@ from .util import make_logger
 from .genhash import genhash as genhash_fn
 from .projects import ProjectInfo
 from .organizations import ORGANIZATIONS
-from .metadata import DownloadMetadata
+from .metadata import DownloadMetadata, project_auth
+from .plan import Plan, make_plan, apply_plan
+from .statecache import CKANStateCache
+from .journal import ReuploadJournal
+from .checkcache import CheckResultCache, ResourceVerifier
+from .benchmark import (
+    PHASES as BENCHMARK_PHASES,
+    format_report,
+    run_benchmark,
+    write_report,
+)
+from .fakeckan import FakeCKANServer
+from .syncall import select_projects, sync_projects
+from .metastore import make_metadata_store
+from .metrics import MetricsWriter, metrics
+from .profiling import CAPTURE_MODES, phase, profiler
+from .libs.excel_wrapper import use_streaming_reader
 
 register_command, command_fns = make_registration_decorator()
 project_info = ProjectInfo()
@@ -50,6 +70,89 @@ def str2bool(v):
         raise argparse.ArgumentTypeError("Boolean value expected.")
 
 
+def make_state_cache(logger, args, ckan):
+    path = make_state_cache_path(logger, args)
+    if path is None:
+        return None
+    return CKANStateCache(path, ckan.address)
+
+
+def make_reupload_journal(logger, args):
+    validate_write_reuploads_interval(logger, args)
+    path = make_reuploads_cache_path(logger, args)
+    if path is None:
+        return None
+    journal = ReuploadJournal(path)
+    journal.import_legacy_dump()
+    return journal
+
+
+def make_verifier(logger, args, write_ckan=False):
+    path = make_check_cache_path(logger, args)
+    if args.skip_unmodified and path is None:
+        # only the cache records the modification time a resource was verified at
+        raise Exception("To use --skip-unmodified, --check-cache must also be set.")
+    max_age = None
+    if args.verified_within is not None:
+        max_age = datetime.timedelta(hours=args.verified_within)
+    if path is None and max_age is None and not args.skip_unmodified and not write_ckan:
+        return None
+    return ResourceVerifier(
+        cache=CheckResultCache(path) if path is not None else None,
+        max_age=max_age,
+        skip_unmodified=args.skip_unmodified,
+        write_ckan=write_ckan,
+    )
+
+
+def add_check_cache_arguments(subparser):
+    subparser.add_argument(
+        "--check-cache",
+        action="store_const",
+        const=True,
+        default=False,
+        help="record resource check results in the download path",
+    )
+    subparser.add_argument(
+        "--verified-within",
+        type=float,
+        default=None,
+        help="skip checking resources verified within this many hours",
+    )
+    subparser.add_argument(
+        "--skip-unmodified",
+        action="store_const",
+        const=True,
+        default=False,
+        help="skip checking resources unmodified in CKAN since they were verified (requires --check-cache)",
+    )
+
+
+def add_s3_index_arguments(subparser):
+    subparser.add_argument(
+        "--s3-index",
+        action="store_const",
+        const=True,
+        default=False,
+        help="check resources against a listing of the upload bucket, rather than one at a time",
+    )
+    subparser.add_argument(
+        "--s3-inventory",
+        default=None,
+        help="check resources against this S3 Inventory CSV report of the upload bucket",
+    )
+
+
+def add_state_cache_argument(subparser):
+    subparser.add_argument(
+        "--state-cache",
+        action="store_const",
+        const=True,
+        default=False,
+        help="keep a local mirror of CKAN state in the download path, refreshed incrementally",
+    )
+
+
 def setup_ckan(subparser, required=True):
     # Possible future enhancement would be to grab these from environment variables
     # See approach in
@@ -63,6 +166,18 @@ def setup_ckan(subparser, required=True):
         default=True,
         help="CKAN base url",
     )
+    subparser.add_argument(
+        "--ckan-rate",
+        type=float,
+        default=None,
+        help="upper limit on CKAN requests per second (default: none, until CKAN pushes back)",
+    )
+    subparser.add_argument(
+        "--ckan-concurrency",
+        type=int,
+        default=16,
+        help="upper limit on CKAN requests in flight",
+    )
 
 
 def setup_sync(subparser):
@@ -75,6 +190,72 @@ def setup_sync(subparser):
     subparser.add_argument(
         "--uploads", type=int, default=4, help="number of parallel uploads"
     )
+    add_sync_arguments(subparser)
+
+
+def setup_sync_all(subparser):
+    setup_ckan(subparser)
+    subparser.add_argument(
+        "slugs",
+        nargs="*",
+        help="regular expressions matching the projects to sync (default: all projects)",
+    )
+    subparser.add_argument(
+        "--projects", type=int, default=4, help="number of projects to sync at once"
+    )
+    subparser.add_argument(
+        "--workers",
+        type=int,
+        default=16,
+        help="workers shared between the projects being synced",
+    )
+    add_sync_arguments(subparser)
+
+
+def add_sync_arguments(subparser):
+    subparser.add_argument(
+        "--sync-threads",
+        type=int,
+        default=None,
+        help="number of packages to sync with CKAN in parallel (defaults to --uploads)",
+    )
+    subparser.add_argument(
+        "--async-in-flight",
+        type=int,
+        default=None,
+        help="sync packages and resources with the asyncio CKAN client (requires aiohttp: install the `async` extra), with this many requests in flight",
+    )
+    subparser.add_argument(
+        "--check-threads",
+        type=int,
+        default=8,
+        help="number of resources to check in parallel",
+    )
+    subparser.add_argument(
+        "--download-threads",
+        type=int,
+        default=2,
+        help="number of parallel downloads from the legacy archive when re-uploading",
+    )
+    subparser.add_argument(
+        "--upload-threads",
+        type=int,
+        default=None,
+        help="number of parallel uploads to S3 when re-uploading (defaults to --uploads)",
+    )
+    subparser.add_argument(
+        "--patch-threads",
+        type=int,
+        default=1,
+        help="number of parallel CKAN patches of re-uploaded resources",
+    )
+    subparser.add_argument(
+        "--stream-reuploads",
+        action="store_const",
+        const=True,
+        default=False,
+        help="copy re-uploads from the legacy archive straight to S3, without a local temporary file",
+    )
     subparser.add_argument(
         "--metadata-only",
         "-m",
@@ -103,13 +284,13 @@ def setup_sync(subparser):
         action="store_const",
         const=True,
         default=False,
-        help="write reuploads to disk",
+        help="record reuploads in a journal on disk, as they are queued and completed",
     )
     subparser.add_argument(
         "--write-reuploads-interval",
         "-i",
         type=int,
-        help="write reuploads to disk interval when uploading resources (e.g., 100 means a reupload write occurs after 100 resources uploaded).",
+        help="no longer required: the reupload journal records every upload as it completes",
     )
     subparser.add_argument(
         "--read-reuploads",
@@ -117,7 +298,7 @@ def setup_sync(subparser):
         action="store_const",
         const=True,
         default=False,
-        help="read reuploads from disk",
+        help="resume reuploads from the journal on disk, rather than checking resources; several processes may share the journal",
     )
     subparser.add_argument(
         "-p", "--download-path", required=False, default=None, help="CKAN base url"
@@ -136,6 +317,100 @@ def setup_sync(subparser):
         default=None,
         help="Process a single ticket only",
     )
+    add_state_cache_argument(subparser)
+    add_check_cache_arguments(subparser)
+    add_s3_index_arguments(subparser)
+    subparser.add_argument(
+        "--record-verification",
+        action="store_const",
+        const=True,
+        default=False,
+        help="record the time, size and etag of each resource check which passes in CKAN",
+    )
+
+
+def setup_plan(subparser):
+    setup_ckan(subparser)
+    subparser.add_argument(
+        "project_name",
+        choices=sorted(project_cli_options.keys()),
+        help="path to metadata",
+    )
+    subparser.add_argument("plan_path", help="file to write the plan to")
+    subparser.add_argument(
+        "--check-threads",
+        type=int,
+        default=8,
+        help="number of resources to check in parallel",
+    )
+    subparser.add_argument(
+        "--skip-resource-checks",
+        action="store_const",
+        const=True,
+        default=False,
+        help="skip resource checks",
+    )
+    subparser.add_argument(
+        "--delete",
+        action="store_const",
+        const=True,
+        default=False,
+        help="plan package and resource deletion",
+    )
+    subparser.add_argument(
+        "-p", "--download-path", required=False, default=None, help="CKAN base url"
+    )
+    subparser.add_argument(
+        "--single-ticket",
+        "-s",
+        type=str,
+        default=None,
+        help="Process a single ticket only",
+    )
+    add_state_cache_argument(subparser)
+    add_check_cache_arguments(subparser)
+    add_s3_index_arguments(subparser)
+
+
+def setup_apply(subparser):
+    setup_ckan(subparser)
+    subparser.add_argument("plan_path", help="plan written by the plan command")
+    subparser.add_argument(
+        "--apply-threads",
+        type=int,
+        default=8,
+        help="number of CKAN changes to make in parallel",
+    )
+    subparser.add_argument(
+        "--uploads", type=int, default=4, help="number of parallel uploads"
+    )
+    subparser.add_argument(
+        "--download-threads",
+        type=int,
+        default=2,
+        help="number of parallel downloads from the legacy archive when re-uploading",
+    )
+    subparser.add_argument(
+        "--patch-threads",
+        type=int,
+        default=1,
+        help="number of parallel CKAN patches of re-uploaded resources",
+    )
+    subparser.add_argument(
+        "--stream-reuploads",
+        action="store_const",
+        const=True,
+        default=False,
+        help="copy re-uploads from the legacy archive straight to S3, without a local temporary file",
+    )
+    subparser.add_argument(
+        "--metadata-only",
+        "-m",
+        action="store_const",
+        const=True,
+        default=False,
+        help="set metadata only, no data uploads",
+    )
 
 
 def setup_hash(subparser):
@@ -151,6 +426,7 @@ def setup_hash(subparser):
         nargs="?",
         default=os.environ.get("MIRROR_PATH"),
     )
+    add_state_cache_argument(subparser)
 
 
 def setup_dump(subparser):
@@ -163,6 +439,62 @@ def setup_dump(subparser):
     setup_ckan(subparser, required=False)
 
 
+def setup_fake_ckan(subparser):
+    subparser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds added to every CKAN API call",
+    )
+    subparser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="fraction of CKAN API calls which fail",
+    )
+    subparser.add_argument(
+        "--error-status",
+        type=int,
+        default=503,
+        help="the HTTP status of failed calls (429 for throttling)",
+    )
+    subparser.add_argument("--seed", type=int, default=None, help="for error injection")
+
+
+def setup_benchmark(subparser):
+    setup_fake_ckan(subparser)
+    subparser.add_argument(
+        "--packages", type=int, default=100, help="packages in the synthetic project"
+    )
+    subparser.add_argument(
+        "--resources-per-package",
+        type=int,
+        default=4,
+        help="resources in each synthetic package",
+    )
+    subparser.add_argument(
+        "--threads", type=int, default=4, help="threads for sync, genhash and checks"
+    )
+    subparser.add_argument(
+        "--phases",
+        default=",".join(BENCHMARK_PHASES),
+        help="comma separated phases to run, from: %s" % (", ".join(BENCHMARK_PHASES)),
+    )
+    subparser.add_argument(
+        "--mirror-path",
+        default=None,
+        help="where to write the synthetic files for genhash (default: a temporary directory)",
+    )
+    subparser.add_argument(
+        "--json", default=None, help="write the results to this file"
+    )
+
+
+def setup_serve_fake_ckan(subparser):
+    setup_fake_ckan(subparser)
+    subparser.add_argument("--port", type=int, default=5000)
+
+
 def setup_makeschema(subparser):
     subparser.add_argument("--dump-re", help="restrict dump by slug", default="")
     subparser.add_argument("--validate-schema", help="validate schema if applicable")
@@ -174,16 +506,19 @@ def sync(args):
     ckan = make_ckan_api(args)
 
     logger = make_cli_logger(args)
-    kwargs = {
-        "write_reuploads": args.write_reuploads,
-        "read_reuploads": args.read_reuploads,
-        "reuploads_path": make_reuploads_cache_path(logger, args),
-        "write_reuploads_interval": validate_write_reuploads_interval(logger, args),
-    }
+    kwargs = sync_kwargs(
+        logger,
+        args,
+        make_state_cache(logger, args, ckan),
+        make_verifier(logger, args, args.record_verification),
+    )
     with DownloadMetadata(
         logger,
         project_cli_options[args.project_name],
         path=args.download_path,
+        refresh=args.refresh_metadata,
+        store=make_metadata_store(args),
+        mirror_path=args.archive_mirror,
     ) as dlmeta:
         sync_metadata(
             ckan,
@@ -200,6 +535,129 @@ def sync(args):
         print_accounts()
 
 
+def sync_kwargs(logger, args, state_cache, verifier):
+    return {
+        "read_reuploads": args.read_reuploads,
+        "reupload_journal": make_reupload_journal(logger, args),
+        "sync_threads": args.sync_threads,
+        "async_in_flight": args.async_in_flight,
+        "check_threads": args.check_threads,
+        "download_threads": args.download_threads,
+        "upload_threads": args.upload_threads,
+        "patch_threads": args.patch_threads,
+        "stream_reuploads": args.stream_reuploads,
+        "state_cache": state_cache,
+        "verifier": verifier,
+        "s3_index": args.s3_index,
+        "s3_inventory": args.s3_inventory,
+        "archive_mirror": args.archive_mirror,
+    }
+
+
+@register_command
+def sync_all(args):
+    """sync several projects at once"""
+    ckan = make_ckan_api(args)
+    args.project_name = "sync-all"
+    logger = make_cli_logger(args)
+    slugs = select_projects(project_cli_options, args.slugs)
+    if not slugs:
+        logger.error("no projects match: %s" % (" ".join(args.slugs)))
+        sys.exit(1)
+    # shared by all the projects
+    state_cache = make_state_cache(logger, args, ckan)
+    verifier = make_verifier(logger, args, args.record_verification)
+
+    def sync_project(slug, dlmeta, num_threads):
+        project_args = argparse.Namespace(**vars(args))
+        project_args.project_name = slug
+        project_logger = make_cli_logger(project_args)
+        kwargs = sync_kwargs(project_logger, project_args, state_cache, verifier)
+        kwargs["sync_threads"] = min(args.sync_threads or num_threads, num_threads)
+        kwargs["check_threads"] = min(args.check_threads, num_threads)
+        sync_metadata(
+            ckan,
+            dlmeta.meta,
+            dlmeta.auth,
+            num_threads,
+            not args.metadata_only,
+            not args.skip_resource_checks,
+            args.delete,
+            args.update_orgs,
+            args.single_ticket,
+            **kwargs,
+        )
+
+    results = sync_projects(
+        dict((slug, project_cli_options[slug]) for slug in slugs),
+        sync_project,
+        download_path=args.download_path,
+        max_projects=args.projects,
+        workers=args.workers,
+        refresh=args.refresh_metadata,
+        store=make_metadata_store(args),
+        mirror_path=args.archive_mirror,
+    )
+    print_accounts()
+    if any(e is not None for e in results.values()):
+        sys.exit(1)
+
+
+@register_command
+def plan(args):
+    """compute the changes a sync would make, and write them to a file"""
+    ckan = make_ckan_api(args)
+    logger = make_cli_logger(args)
+    with DownloadMetadata(
+        logger,
+        project_cli_options[args.project_name],
+        path=args.download_path,
+        refresh=args.refresh_metadata,
+        store=make_metadata_store(args),
+        mirror_path=args.archive_mirror,
+    ) as dlmeta:
+        sync_plan = make_plan(
+            ckan,
+            dlmeta.meta,
+            dlmeta.auth,
+            args.project_name,
+            not args.skip_resource_checks,
+            args.delete,
+            args.single_ticket,
+            check_threads=args.check_threads,
+            state_cache=make_state_cache(logger, args, ckan),
+            verifier=make_verifier(logger, args),
+            s3_index=args.s3_index,
+            s3_inventory=args.s3_inventory,
+            archive_mirror=args.archive_mirror,
+        )
+    sync_plan.write(args.plan_path)
+    logger.info("plan written to: {}".format(args.plan_path))
+    print_accounts()
+
+
+@register_command
+def apply(args):
+    """make the changes in a plan written by the plan command"""
+    ckan = make_ckan_api(args)
+    logger = make_cli_logger(args)
+    sync_plan = Plan.read(args.plan_path)
+    remaining = apply_plan(
+        ckan,
+        sync_plan,
+        project_auth(logger, project_cli_options[sync_plan.project_name]),
+        args.apply_threads,
+        not args.metadata_only,
+        download_threads=args.download_threads,
+        upload_threads=args.uploads,
+        patch_threads=args.patch_threads,
+        stream_reuploads=args.stream_reuploads,
+        archive_mirror=args.archive_mirror,
+    )
+    logger.info("resources remaining to be re-uploaded: {}".format(len(remaining)))
+    print_accounts()
+
+
 @register_command
 def makeschema(args):
     generate_schemas(args)
@@ -210,6 +668,46 @@ def dumpstate(args):
     dump_state(args)
 
 
+@register_command
+def benchmark(args):
+    "benchmark sync, genhash and resource checks against a fake CKAN"
+    phases = [t.strip() for t in args.phases.split(",") if t.strip()]
+    with tempfile.TemporaryDirectory() as tempdir:
+        results = run_benchmark(
+            args.packages,
+            args.resources_per_package,
+            num_threads=args.threads,
+            latency=args.latency,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            mirror_path=args.mirror_path or tempdir,
+            phases=phases,
+            seed=args.seed,
+        )
+    print(format_report(results))
+    if args.json:
+        write_report(results, args.json)
+
+
+@register_command
+def serve_fake_ckan(args):
+    "serve an empty, in-memory, CKAN action API on localhost"
+    server = FakeCKANServer(
+        port=args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        seed=args.seed,
+    )
+    print("fake CKAN listening on %s" % (server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
 @register_command
 def genhash(args):
     ckan = make_ckan_api(args)
@@ -217,19 +715,34 @@ def genhash(args):
     verify MD5 sums for a local (filesystem mounted) mirror of the BPA
     data, and generate expected E-Tag and SHA256 values.
     """
+    logger = make_cli_logger(args)
     with DownloadMetadata(
-        make_cli_logger(args),
+        logger,
         project_cli_options[args.project_name],
         path=args.download_path,
+        refresh=args.refresh_metadata,
+        store=make_metadata_store(args),
+        mirror_path=args.archive_mirror,
     ) as dlmeta:
-        genhash_fn(ckan, dlmeta.meta, args.mirror_path, num_threads=4)
+        genhash_fn(
+            ckan,
+            dlmeta.meta,
+            args.mirror_path,
+            num_threads=4,
+            state_cache=make_state_cache(logger, args, ckan),
+        )
         print_accounts()
 
 
 sync.setup = setup_sync
+sync_all.setup = setup_sync_all
+plan.setup = setup_plan
+apply.setup = setup_apply
 bootstrap.setup = setup_ckan
 dumpstate.setup = setup_dump
 genhash.setup = setup_hash
+benchmark.setup = setup_benchmark
+serve_fake_ckan.setup = setup_serve_fake_ckan
 makeschema.setup = setup_makeschema
 
 
@@ -270,6 +783,57 @@ def main():
     parser.add_argument(
         "--log-level", required=False, default="INFO", choices=LOG_LEVELS.keys()
     )
+    parser.add_argument(
+        "--refresh-metadata",
+        action="store_true",
+        help="refresh previously downloaded metadata, downloading only new and modified files",
+    )
+    parser.add_argument(
+        "--archive-mirror",
+        default=None,
+        help="a filesystem mirror of the legacy archive, read instead of fetching over HTTP",
+    )
+    parser.add_argument(
+        "--metadata-store",
+        default=None,
+        help="directory of metadata files shared between projects and runs",
+    )
+    parser.add_argument(
+        "--stream-xlsx",
+        action="store_true",
+        help="read xlsx metadata a row at a time, rather than loading whole workbooks",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="report the wall and CPU time spent in each phase of the run",
+    )
+    parser.add_argument(
+        "--profile-capture",
+        choices=CAPTURE_MODES,
+        default=None,
+        help="also profile each phase, to files under the download path",
+    )
+    parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=0.005,
+        help="seconds between stack samples, with --profile-capture sample",
+    )
+    parser.add_argument(
+        "--metrics-json", default=None, help="write run metrics to this JSON file"
+    )
+    parser.add_argument(
+        "--metrics-prom",
+        default=None,
+        help="write run metrics to this Prometheus textfile",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=60,
+        help="seconds between metrics writes during the run (0: only at the end)",
+    )
 
     subparsers = parser.add_subparsers(dest="name")
     for name, fn, setup_fn, help_text in sorted(commands()):
@@ -283,4 +847,22 @@ def main():
     if "func" not in args:
         usage(parser)
     logging.basicConfig(level=LOG_LEVELS[args.log_level])
-    args.func(args)
+    if args.stream_xlsx:
+        use_streaming_reader()
+    if args.profile or args.profile_capture:
+        profiler.configure(
+            args.profile_capture,
+            os.path.join(args.download_path or os.getcwd(), "profile"),
+            args.profile_interval,
+        )
+    try:
+        with phase(args.name):
+            if args.metrics_json or args.metrics_prom:
+                with MetricsWriter(
+                    metrics, args.metrics_json, args.metrics_prom, args.metrics_interval
+                ):
+                    args.func(args)
+            else:
+                args.func(args)
+    finally:
+        profiler.finish()
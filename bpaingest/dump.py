@@ -4,6 +4,8 @@ import re
 from collections import defaultdict, Counter
 
 from bpaingest.metadata import DownloadMetadata
+from bpaingest.metastore import make_metadata_store
+from bpaingest.profiling import phase
 from bpaingest.projects import ProjectInfo
 from bpaingest.resource_metadata import (
     build_raw_resources_from_state_as_file,
@@ -117,6 +119,8 @@ def dump_state(args):
 
     data_type_meta = {}
     # download metadata for all project types and aggregate metadata keys
+    # contextual metadata shared between projects is then downloaded only once
+    store = make_metadata_store(args)
     for class_info in sorted(classes, key=lambda x: x["slug"]):
         logger.info(
             "Dumping state generation: %s / %s"
@@ -127,6 +131,9 @@ def dump_state(args):
             make_logger(class_info["slug"], args.log_level),
             class_info["cls"],
             path=dlpath,
+            refresh=args.refresh_metadata,
+            store=store,
+            mirror_path=args.archive_mirror,
             has_sql_context=has_sql_context,
             has_validate_schema=has_validate_schema,
         ) as dlmeta:
@@ -145,8 +152,9 @@ def dump_state(args):
 
     ckan = make_ckan_api(args)
 
-    build_raw_resources_from_state_as_file(logger, ckan, state, data_type_meta)
-    validate_raw_resources_from_state(logger, state)
+    with phase("raw-resources"):
+        build_raw_resources_from_state_as_file(logger, ckan, state, data_type_meta)
+        validate_raw_resources_from_state(logger, state)
 
     # for datetime objects, use 'default as str' for now so that parsing doesn't break
     with open(args.filename, "w") as fd:
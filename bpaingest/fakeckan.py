@@ -0,0 +1,369 @@
+import copy
+import datetime
+import html
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlparse
+
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+
+class ActionError(Exception):
+    "an error returned by the action API: its CKAN `__type`, and HTTP status"
+
+    def __init__(self, error_type, status, message=""):
+        self.error_type = error_type
+        self.status = status
+        self.message = message
+        super().__init__(message)
+
+
+def not_found(what):
+    return ActionError("Not Found Error", 404, "Not found: %s" % (what))
+
+
+def timestamp():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None).isoformat()
+
+
+class FakeCKAN:
+    """
+    the state of a CKAN instance, held in memory, and the subset of the action
+    API which bpa-ingest uses. alongside, it plays the part of the S3 bucket
+    behind resource downloads, and of the legacy archive.
+    """
+
+    def __init__(self):
+        self.address = None
+        self._lock = threading.RLock()
+        self.organizations = {}
+        self.packages = {}
+        # resource ID -> package ID
+        self._resource_package = {}
+        # resource ID -> (size, etag) of the uploaded file
+        self.uploads = {}
+        # path -> size, of files in the legacy archive
+        self.archive = {}
+
+    def add_organization(self, name):
+        with self._lock:
+            obj = {"id": str(uuid.uuid4()), "name": name, "title": name}
+            self.organizations[obj["id"]] = obj
+            return obj
+
+    def add_archive_file(self, path, size):
+        with self._lock:
+            self.archive[path] = size
+
+    def upload(self, resource_id, size, etag):
+        "place a file on 'S3', and point the resource at it"
+        with self._lock:
+            package = self.packages[self._resource_package[resource_id]]
+            resource = self._find_resource(package, resource_id)
+            resource["url"] = "%s/dataset/%s/resource/%s/download/%s" % (
+                self.address,
+                package["id"],
+                resource_id,
+                quote(resource.get("name") or "file"),
+            )
+            resource["url_type"] = "upload"
+            self.uploads[resource_id] = (size, etag)
+
+    def _find_resource(self, package, resource_id):
+        for resource in package["resources"]:
+            if resource["id"] == resource_id:
+                return resource
+        raise not_found(resource_id)
+
+    def _package(self, id_or_name):
+        obj = self.packages.get(id_or_name)
+        if obj is None:
+            for candidate in self.packages.values():
+                if candidate["name"] == id_or_name:
+                    return candidate
+            raise not_found(id_or_name)
+        return obj
+
+    def _touch(self, obj):
+        obj["metadata_modified"] = timestamp()
+
+    def call(self, action, data):
+        fn = getattr(self, "action_" + action, None)
+        if fn is None:
+            raise ActionError("Not Found Error", 400, "unknown action: %s" % (action))
+        with self._lock:
+            return copy.deepcopy(fn(**data))
+
+    def action_organization_show(self, id, **kwargs):
+        for obj in self.organizations.values():
+            if id in (obj["id"], obj["name"]):
+                return obj
+        raise not_found(id)
+
+    def action_package_show(self, id, **kwargs):
+        return self._package(id)
+
+    def action_package_create(self, **data):
+        if "name" not in data:
+            raise ActionError("Validation Error", 409, "name: Missing value")
+        for existing in self.packages.values():
+            if existing["name"] == data["name"]:
+                raise ActionError("Validation Error", 409, "name: already in use")
+        obj = dict(data, state="active", resources=[], tags=data.get("tags", []))
+        obj.setdefault("id", str(uuid.uuid4()))
+        self._touch(obj)
+        self.packages[obj["id"]] = obj
+        return obj
+
+    def action_package_patch(self, id, **data):
+        obj = self._package(id)
+        resources = data.pop("resources", None)
+        obj.update(data)
+        if resources is not None:
+            for resource in obj["resources"]:
+                del self._resource_package[resource["id"]]
+            for resource in resources:
+                resource.setdefault("id", str(uuid.uuid4()))
+                resource["package_id"] = obj["id"]
+                self._resource_package[resource["id"]] = obj["id"]
+            obj["resources"] = resources
+        self._touch(obj)
+        return obj
+
+    def action_package_delete(self, id, **kwargs):
+        self._package(id)["state"] = "deleted"
+
+    def action_dataset_purge(self, id, **kwargs):
+        obj = self._package(id)
+        for resource in obj["resources"]:
+            del self._resource_package[resource["id"]]
+        del self.packages[obj["id"]]
+
+    def action_package_search(
+        self, q="", fq="", start=0, rows=10, sort="id asc", **kwargs
+    ):
+        results = sorted(self.packages.values(), key=lambda p: p["id"])
+        match = re.match(r"^type:(\S+)$", q or "")
+        if match:
+            results = [t for t in results if t.get("type") == match.group(1)]
+        return {"count": len(results), "results": results[start : start + rows]}
+
+    def action_resource_show(self, id, **kwargs):
+        package_id = self._resource_package.get(id)
+        if package_id is None:
+            raise not_found(id)
+        return self._find_resource(self.packages[package_id], id)
+
+    def action_resource_create(self, package_id, **data):
+        package = self._package(package_id)
+        obj = dict(data, package_id=package["id"])
+        obj.setdefault("id", str(uuid.uuid4()))
+        self._touch(obj)
+        package["resources"].append(obj)
+        self._resource_package[obj["id"]] = package["id"]
+        self._touch(package)
+        return obj
+
+    def action_resource_patch(self, id, **data):
+        obj = self.action_resource_show(id)
+        obj.update(data)
+        self._touch(obj)
+        self._touch(self.packages[obj["package_id"]])
+        return obj
+
+    def action_resource_update(self, id, **data):
+        obj = self.action_resource_show(id)
+        preserved = dict((k, obj[k]) for k in ("id", "package_id"))
+        obj.clear()
+        obj.update(data, **preserved)
+        self._touch(obj)
+        self._touch(self.packages[obj["package_id"]])
+        return obj
+
+    def action_resource_delete(self, id, **kwargs):
+        obj = self.action_resource_show(id)
+        package = self.packages[obj["package_id"]]
+        package["resources"].remove(obj)
+        del self._resource_package[id]
+        self._touch(package)
+
+    def listing(self, directory):
+        "an Apache autoindex page for `directory`, or None if there is nothing in it"
+        with self._lock:
+            names = sorted(
+                path[len(directory) :]
+                for path in self.archive
+                if path.startswith(directory) and "/" not in path[len(directory) :]
+            )
+            if not names:
+                return None
+            rows = "".join(
+                '<tr><td><a href="%s">%s</a></td><td align="right">%d</td></tr>\n'
+                % (quote(name), html.escape(name), self.archive[directory + name])
+                for name in names
+            )
+        return "<html><body><table>\n%s</table></body></html>" % (rows)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    download_re = re.compile(r"^/dataset/[^/]+/resource/([^/]+)/download/[^/]+$")
+    s3_re = re.compile(r"^/s3/([^/]+)/[^/]+$")
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, status, body=b"", headers=None, head=False):
+        if isinstance(body, str):
+            body = body.encode("utf8")
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("content-length") or 0)
+        body = self.rfile.read(length)
+        match = re.match(r"^/api/(?:3/)?action/(\w+)$", urlparse(self.path).path)
+        if match is None:
+            return self._send(404)
+        action = match.group(1)
+        if server.latency:
+            time.sleep(server.latency)
+        if server.inject_error():
+            return self._send(server.error_status, "<html>unavailable</html>")
+        try:
+            data = json.loads(body) if body else {}
+            result = server.ckan.call(action, data)
+        except ActionError as e:
+            error = {"__type": e.error_type, "message": e.message}
+            return self._send(
+                e.status,
+                json.dumps({"success": False, "error": error}),
+                {"Content-Type": "application/json"},
+            )
+        except TypeError as e:
+            error = {"__type": "Validation Error", "message": str(e)}
+            return self._send(
+                409,
+                json.dumps({"success": False, "error": error}),
+                {"Content-Type": "application/json"},
+            )
+        self._send(
+            200,
+            json.dumps({"success": True, "result": result}),
+            {"Content-Type": "application/json"},
+        )
+
+    def do_HEAD(self):
+        self._get(head=True)
+
+    def do_GET(self):
+        self._get(head=False)
+
+    def _get(self, head):
+        ckan = self.server.ckan
+        path = unquote(urlparse(self.path).path)
+        match = self.download_re.match(path)
+        if match:
+            # CKAN redirects downloads to a signed S3 URL
+            resource_id = match.group(1)
+            if resource_id not in ckan.uploads:
+                return self._send(404, head=head)
+            location = "%s/s3/%s/file" % (ckan.address, resource_id)
+            return self._send(302, headers={"Location": location}, head=head)
+        match = self.s3_re.match(path)
+        if match:
+            upload = ckan.uploads.get(match.group(1))
+            if upload is None:
+                return self._send(404, head=head)
+            size, etag = upload
+            headers = {
+                "ETag": '"%s"' % (etag),
+                "Content-Range": "bytes 0-0/%d" % (size),
+            }
+            return self._send(206, b"\0", headers, head=head)
+        if path.endswith("/"):
+            listing = ckan.listing(path)
+            if listing is None:
+                return self._send(404, head=head)
+            return self._send(200, listing, {"Content-Type": "text/html"}, head=head)
+        size = ckan.archive.get(path)
+        if size is None:
+            return self._send(404, head=head)
+        # no body is served: only the size of legacy files is ever asked for
+        self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+
+
+class FakeCKANServer(ThreadingHTTPServer):
+    """
+    serves a `FakeCKAN` over HTTP. every action API call is delayed by
+    `latency` seconds, and fails (with `error_status`) at random, with
+    probability `error_rate`.
+
+        with FakeCKANServer() as server:
+            ckan = ckanapi.RemoteCKAN(server.url)
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        ckan=None,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        error_rate=0.0,
+        error_status=503,
+        seed=None,
+    ):
+        super().__init__((host, port), RequestHandler)
+        self.ckan = ckan or FakeCKAN()
+        self.ckan.address = self.url
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    def inject_error(self):
+        if not self.error_rate:
+            return False
+        with self._random_lock:
+            return self._random.random() < self.error_rate
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,23 +1,15 @@
-import urllib.parse
 import re
 import os
 
 from .ops import ckan_method
-from .util import make_logger
+from .util import localpath, make_logger
 from .libs.multihash import generate_hashes
 from .pkgcache import build_resource_cache
+from .profiling import phase
 
 logger = make_logger(__name__)
 
 
-def localpath(mirror_path, legacy_url):
-    path = urllib.parse.urlparse(legacy_url).path
-    if path.startswith("/bpa/"):
-        path = path[5:]
-    path = path.lstrip("/")
-    return os.path.join(mirror_path, path)
-
-
 size_re = re.compile(r"^[0-9]+$")
 
 
@@ -57,8 +49,10 @@ def calculate_hashes(ckan, mirror_path, legacy_url, resource):
     logger.info("%s: hashes calculated and pushed" % (resource_path))
 
 
-def genhash(ckan, meta, mirror_path, num_threads):
-    cache = build_resource_cache(ckan, meta.ckan_data_type, meta.get_packages())
+def genhash(ckan, meta, mirror_path, num_threads, state_cache=None):
+    cache = build_resource_cache(
+        ckan, meta.ckan_data_type, meta.get_packages(), state_cache
+    )
     logger.info(
         "%d resources of type %s" % (len(meta.get_resources()), meta.ckan_data_type)
     )
@@ -74,5 +68,6 @@ def genhash(ckan, meta, mirror_path, num_threads):
             queue.append((legacy_url, resource))
 
     logger.info("{} resources to be hashed".format(len(queue)))
-    for task in queue:
-        calculate_hashes(ckan, mirror_path, *task)
+    with phase("genhash"):
+        for task in queue:
+            calculate_hashes(ckan, mirror_path, *task)
@@ -0,0 +1,304 @@
+import json
+import os
+import pickle
+import socket
+import sqlite3
+import threading
+import time
+
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+# the pickled list of re-uploads kept before the journal, in the same directory
+LEGACY_DUMP_FILENAME = "reupload_resources.dump"
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# a claim older than this is assumed to belong to a worker which has died. a
+# worker renews its claims while it runs, so the lease only runs out once the
+# worker has stopped
+LEASE_SECONDS = 6 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reuploads (
+    resource_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    resource TEXT NOT NULL,
+    legacy_url TEXT,
+    state TEXT NOT NULL,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reuploads_state ON reuploads (state, seq);
+"""
+
+
+def default_worker_id():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+def worker_is_dead(worker):
+    """
+    True if `worker` (see `default_worker_id`) was a process on this host which
+    is no longer running. a worker elsewhere, or with some other ID, can't be
+    checked, so is assumed to be alive.
+    """
+    host, _, pid = (worker or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    if int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+class ReuploadJournal:
+    """
+    the queue of resources to be re-uploaded, held in SQLite. each resource
+    moves from pending, to running once claimed by a worker, to done or
+    failed; each transition is a single-row write, committed immediately,
+    so a crash loses nothing but the uploads in flight. several worker
+    processes can share a journal: `claim` hands each resource to one of them.
+
+    while a worker holds claims, a thread renews them every quarter of the
+    lease, so long transfers are not handed on to another worker.
+    """
+
+    def __init__(self, path, worker=None, lease=LEASE_SECONDS):
+        self.path = path
+        self.worker = worker or default_worker_id()
+        self.lease = lease
+        self._lock = threading.Lock()
+        # autocommit: transactions are opened explicitly where needed
+        self._conn = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        # resources claimed by this worker, and not yet finished
+        self._held = set()
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def close(self):
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+        with self._lock:
+            self._conn.close()
+
+    def _transaction(self, fn):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn()
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def reset(self):
+        """
+        discard the contents of the journal, ahead of a fresh set of checks.
+        resources held by a running worker are left in place, so that worker
+        can still record its results.
+        """
+
+        def reset():
+            dead = [
+                worker
+                for (worker,) in self._conn.execute(
+                    "SELECT DISTINCT worker FROM reuploads WHERE state = ?", (RUNNING,)
+                ).fetchall()
+                if worker_is_dead(worker)
+            ]
+            self._conn.execute("DELETE FROM reuploads WHERE state != ?", (RUNNING,))
+            for worker in dead:
+                self._conn.execute(
+                    "DELETE FROM reuploads WHERE state = ? AND worker = ?",
+                    (RUNNING, worker),
+                )
+            (held,) = self._conn.execute(
+                "SELECT COUNT(*) FROM reuploads WHERE state = ?", (RUNNING,)
+            ).fetchone()
+            return held
+
+        held = self._transaction(reset)
+        if held:
+            logger.info(
+                "%d re-uploads held by other workers left in the journal" % (held)
+            )
+
+    def import_legacy_dump(self):
+        """
+        queue the re-uploads in a pickled list left by an earlier version, if
+        there is one beside the journal. the list is renamed once imported, so
+        it is only read once.
+        """
+        dump_path = os.path.join(os.path.dirname(self.path), LEGACY_DUMP_FILENAME)
+        if not os.path.exists(dump_path):
+            return
+        logger.warning("importing re-uploads from earlier version: %s" % (dump_path))
+        with open(dump_path, "rb") as fd:
+            to_reupload = pickle.load(fd)
+        self.enqueue(to_reupload)
+        os.rename(dump_path, dump_path + ".imported")
+
+    def enqueue(self, to_reupload):
+        """
+        add (resource, legacy_url) pairs to the queue. a resource already in the
+        journal is queued again unless a worker currently holds it.
+        """
+
+        def enqueue():
+            (seq,) = self._conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM reuploads"
+            ).fetchone()
+            now = time.time()
+            for offset, (resource, legacy_url) in enumerate(to_reupload, 1):
+                self._conn.execute(
+                    """INSERT INTO reuploads (resource_id, seq, resource, legacy_url, state, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (resource_id) DO UPDATE SET
+                        resource = excluded.resource,
+                        legacy_url = excluded.legacy_url,
+                        state = CASE WHEN state = ? THEN state ELSE excluded.state END,
+                        updated_at = excluded.updated_at""",
+                    (
+                        resource["id"],
+                        seq + offset,
+                        json.dumps(resource),
+                        legacy_url,
+                        PENDING,
+                        now,
+                        RUNNING,
+                    ),
+                )
+
+        self._transaction(enqueue)
+        logger.info("%d resources queued for re-upload" % (len(to_reupload)))
+
+    def resume(self):
+        """
+        queue failed resources for another attempt, along with those claimed by
+        a worker on this host which is no longer running. resources claimed by
+        any other worker which has not renewed its claim within the lease are
+        reclaimed by `claim`
+        """
+
+        def resume():
+            failed = self._conn.execute(
+                "UPDATE reuploads SET state = ?, worker = NULL WHERE state = ?",
+                (PENDING, FAILED),
+            ).rowcount
+            dead = [
+                worker
+                for (worker,) in self._conn.execute(
+                    "SELECT DISTINCT worker FROM reuploads WHERE state = ?", (RUNNING,)
+                ).fetchall()
+                if worker != self.worker and worker_is_dead(worker)
+            ]
+            abandoned = 0
+            for worker in dead:
+                abandoned += self._conn.execute(
+                    "UPDATE reuploads SET state = ?, worker = NULL WHERE state = ? AND worker = ?",
+                    (PENDING, RUNNING, worker),
+                ).rowcount
+            return failed, abandoned
+
+        failed, abandoned = self._transaction(resume)
+        logger.info("%d failed re-uploads queued again" % (failed))
+        if abandoned:
+            logger.info(
+                "%d re-uploads in flight when their worker stopped queued again"
+                % (abandoned)
+            )
+
+    def claim(self, limit):
+        "take up to `limit` resources from the queue for this worker, in queue order"
+
+        def claim():
+            now = time.time()
+            rows = self._conn.execute(
+                """SELECT resource_id, resource, legacy_url FROM reuploads
+                WHERE state = ? OR (state = ? AND updated_at < ?)
+                ORDER BY seq LIMIT ?""",
+                (PENDING, RUNNING, now - self.lease, limit),
+            ).fetchall()
+            self._conn.executemany(
+                "UPDATE reuploads SET state = ?, worker = ?, attempts = attempts + 1, updated_at = ? WHERE resource_id = ?",
+                ((RUNNING, self.worker, now, t[0]) for t in rows),
+            )
+            self._held.update(t[0] for t in rows)
+            return [
+                (json.loads(resource), legacy_url) for _, resource, legacy_url in rows
+            ]
+
+        claimed = self._transaction(claim)
+        if claimed and self._renewer is None and self.lease > 0:
+            self._renewer = threading.Thread(target=self._renew_claims, daemon=True)
+            self._renewer.start()
+        return claimed
+
+    def renew(self):
+        "extend the lease on the resources this worker holds"
+        with self._lock:
+            held = list(self._held)
+            self._conn.executemany(
+                "UPDATE reuploads SET updated_at = ? WHERE resource_id = ? AND state = ? AND worker = ?",
+                ((time.time(), t, RUNNING, self.worker) for t in held),
+            )
+
+    def _renew_claims(self):
+        while not self._stop.wait(self.lease / 4):
+            try:
+                self.renew()
+            except sqlite3.Error as e:
+                logger.error("unable to renew re-upload claims: %s" % (e))
+
+    def _finish(self, resource_id, state):
+        with self._lock:
+            self._held.discard(resource_id)
+            updated = self._conn.execute(
+                "UPDATE reuploads SET state = ?, updated_at = ? WHERE resource_id = ? AND worker = ?",
+                (state, time.time(), resource_id, self.worker),
+            ).rowcount
+        if not updated:
+            logger.warning(
+                "re-upload of %s finished (%s), but this worker (%s) no longer holds it: result not recorded"
+                % (resource_id, state, self.worker)
+            )
+
+    def succeeded(self, resource_id):
+        self._finish(resource_id, DONE)
+
+    def failed(self, resource_id):
+        self._finish(resource_id, FAILED)
+
+    def counts(self):
+        with self._lock:
+            return dict(
+                self._conn.execute(
+                    "SELECT state, COUNT(*) FROM reuploads GROUP BY state"
+                ).fetchall()
+            )
+
+    def remaining(self):
+        "resources which have not (yet) been successfully re-uploaded"
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT resource, legacy_url FROM reuploads WHERE state != ? ORDER BY seq",
+                (DONE,),
+            ).fetchall()
+        return [(json.loads(resource), legacy_url) for resource, legacy_url in rows]
@@ -0,0 +1,211 @@
+"""
+Read xlsx workbooks a row at a time.
+
+xlrd loads every sheet of a workbook, and every cell of those sheets, before
+a row can be read. the classes here read a workbook with openpyxl in
+read-only mode instead: only the sheet being read is parsed, as it is read,
+so memory use does not grow with the size of the sheet.
+
+the cells produced are xlrd cells, with the types and values xlrd would
+give them, so ExcelWrapper treats the rows read either way identically.
+"""
+
+import datetime
+import zipfile
+from xml.etree import ElementTree
+
+import xlrd
+from openpyxl import load_workbook
+from openpyxl.utils.cell import range_boundaries
+from openpyxl.utils.datetime import MAC_EPOCH, to_excel
+from xlrd.biffh import error_text_from_code
+from xlrd.sheet import Cell, empty_cell
+
+DCTERMS_NS = "{http://purl.org/dc/terms/}"
+SHEET_VISIBILITY = {"visible": 0, "hidden": 1, "veryHidden": 2}
+DATE_TYPES = (datetime.datetime, datetime.date, datetime.time, datetime.timedelta)
+error_code_from_text = dict((v, k) for k, v in error_text_from_code.items())
+
+
+def read_core_props(file_name):
+    "the created and modified dates of a workbook, as strings, as xlrd reads them"
+    props = {}
+    with zipfile.ZipFile(file_name) as zf:
+        names = dict((t.lower(), t) for t in zf.namelist())
+        if "docprops/core.xml" not in names:
+            return props
+        with zf.open(names["docprops/core.xml"]) as fd:
+            for elem in ElementTree.parse(fd).iter():
+                if elem.tag in (DCTERMS_NS + "created", DCTERMS_NS + "modified"):
+                    props[elem.tag[len(DCTERMS_NS) :]] = elem.text
+    return props
+
+
+def read_merged_cells(file_name, sheet_path):
+    """
+    the merged ranges of a worksheet, as xlrd (rlo, rhi, clo, chi) tuples. the
+    ranges follow the cells in the sheet's XML, so the cells are discarded as
+    they are passed over.
+    """
+    merged_cells = []
+    with zipfile.ZipFile(file_name) as zf, zf.open(sheet_path) as fd:
+        sheet_data = None
+        for event, elem in ElementTree.iterparse(fd, events=("start", "end")):
+            tag = elem.tag.rsplit("}", 1)[-1]
+            if event == "start":
+                if tag == "sheetData":
+                    sheet_data = elem
+            elif tag == "row" and sheet_data is not None:
+                sheet_data.clear()
+            elif tag == "mergeCell" and elem.get("ref"):
+                min_col, min_row, max_col, max_row = range_boundaries(elem.get("ref"))
+                merged_cells.append((min_row - 1, max_row, min_col - 1, max_col))
+    return merged_cells
+
+
+def to_xlrd_cell(cell, epoch):
+    "an openpyxl read-only cell, as the cell xlrd would have read"
+    value = cell.value
+    if value is None:
+        return empty_cell
+    if cell.data_type == "e":
+        return Cell(xlrd.XL_CELL_ERROR, error_code_from_text.get(value, 42))
+    if isinstance(value, bool):
+        return Cell(xlrd.XL_CELL_BOOLEAN, int(value))
+    if isinstance(value, str):
+        return Cell(xlrd.XL_CELL_TEXT, value)
+    if isinstance(value, DATE_TYPES):
+        # openpyxl converts date cells; xlrd leaves them as Excel serial dates
+        return Cell(xlrd.XL_CELL_DATE, float(to_excel(value, epoch)))
+    return Cell(xlrd.XL_CELL_NUMBER, float(value))
+
+
+class StreamingWorkbook:
+    """
+    an xlsx workbook, with the parts of the xlrd Book interface used by
+    ExcelWrapper. the workbook is closed once a sheet has been read through,
+    and opened again if needed.
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self._workbook = None
+        workbook = self.open()
+        self.epoch = workbook.epoch
+        self.datemode = 1 if workbook.epoch == MAC_EPOCH else 0
+        self.props = read_core_props(file_name)
+        self._sheets = [
+            StreamingSheet(self, t.title, t.sheet_state, t._worksheet_path)
+            for t in workbook.worksheets
+        ]
+
+    def open(self):
+        if self._workbook is None:
+            self._workbook = load_workbook(
+                self.file_name, read_only=True, data_only=True
+            )
+        return self._workbook
+
+    def close(self):
+        if self._workbook is not None:
+            self._workbook.close()
+            self._workbook = None
+
+    def sheet_names(self):
+        return [t.name for t in self._sheets]
+
+    def sheet_by_name(self, sheet_name):
+        for sheet in self._sheets:
+            if sheet.name == sheet_name:
+                return sheet
+        raise xlrd.XLRDError("No sheet named <%r>" % (sheet_name))
+
+    def sheet_by_index(self, sheetx):
+        return self._sheets[sheetx]
+
+
+class StreamingSheet:
+    """
+    a worksheet of a StreamingWorkbook, with the parts of the xlrd Sheet
+    interface used by ExcelWrapper, and `rows()` to read it through
+    """
+
+    def __init__(self, book, name, sheet_state, sheet_path):
+        self.book = book
+        self.name = name
+        self.visibility = SHEET_VISIBILITY.get(sheet_state, 0)
+        self._sheet_path = sheet_path
+        self._merged_cells = None
+        # the widest row read; rows are padded to this width, as xlrd pads rows
+        self.ncols = 0
+
+    @property
+    def merged_cells(self):
+        if self._merged_cells is None:
+            self._merged_cells = read_merged_cells(
+                self.book.file_name, self._sheet_path
+            )
+        return self._merged_cells
+
+    def _iter_rows(self, **kwargs):
+        worksheet = self.book.open()[self.name]
+        for row in worksheet.iter_rows(**kwargs):
+            yield [to_xlrd_cell(t, self.book.epoch) for t in row]
+
+    def row_values(self, rowx):
+        values = []
+        for row in self._iter_rows(min_row=rowx + 1, max_row=rowx + 1):
+            values = [t.value for t in row]
+        self.ncols = max(self.ncols, len(values))
+        return values + [""] * (self.ncols - len(values))
+
+    def rows(self, start=0):
+        """
+        yields the rows of the sheet from `start`, as lists of xlrd cells. merged
+        cells are given the top-left cell of their range, and, as in xlrd, empty
+        rows at the end of the sheet are dropped.
+
+        only the merged ranges, and their top-left cells, are held in memory
+        (and the merged parts of any run of empty rows).
+        """
+        pending = sorted(self.merged_cells)
+        pending.reverse()
+        active = []
+        # the first of a run of empty rows, and those of them holding merged cells
+        empty_from = None
+        empty_merged = {}
+        try:
+            for rowx, cells in enumerate(self._iter_rows()):
+                is_empty = all(t.ctype == xlrd.XL_CELL_EMPTY for t in cells)
+                while pending and pending[-1][0] == rowx:
+                    crange = pending.pop()
+                    clo = crange[2]
+                    active.append((crange, cells[clo] if clo < len(cells) else None))
+                active = [t for t in active if t[0][1] > rowx]
+                for (rlo, rhi, clo, chi), source in active:
+                    if source is None:
+                        continue
+                    cells += [empty_cell] * (chi - len(cells))
+                    for colx in range(clo, chi):
+                        if rowx != rlo or colx != clo:
+                            cells[colx] = source
+                self.ncols = max(self.ncols, len(cells))
+                if is_empty:
+                    if empty_from is None:
+                        empty_from = rowx
+                    if active and rowx >= start:
+                        empty_merged[rowx] = cells
+                    continue
+                if empty_from is not None:
+                    for empty_rowx in range(max(empty_from, start), rowx):
+                        yield self._pad(
+                            empty_merged.pop(empty_rowx, [empty_cell] * self.ncols)
+                        )
+                    empty_from = None
+                if rowx >= start:
+                    yield self._pad(cells)
+        finally:
+            self.book.close()
+
+    def _pad(self, cells):
+        return cells + [empty_cell] * (self.ncols - len(cells))
@@ -19,8 +19,11 @@ import os
 import xlrd
 import string
 import logging
+import zipfile
 from openpyxl.utils.cell import get_column_letter
 
+from .excel_stream import StreamingWorkbook
+
 SkipColumn = namedtuple("SkipColumn", ["column_name", "skip_all"])
 skip_column_default = SkipColumn("column_name", False)
 FieldDefinition = namedtuple(
@@ -41,6 +44,15 @@ def make_skip_column(column_name, **kwargs):
     return skip_column_default._replace(column_name=column_name, **kwargs)
 
 
+# whether ExcelWrapper reads xlsx files a row at a time, unless told otherwise
+_streaming_default = False
+
+
+def use_streaming_reader(enabled=True):
+    global _streaming_default
+    _streaming_default = enabled
+
+
 class ExcelWrapperLogger(logging.LoggerAdapter):
     def process(self, msg, kwargs):
         return (
@@ -68,6 +80,9 @@ class ExcelWrapper:
     sheet_name: sheet in workbook
     header_length: first number of lines to ignore
     column_name_row_index: row in which column names are found, typically 0
+    streaming: read the sheet a row at a time (xlsx files only), rather than
+        loading the whole workbook with xlrd. defaults to the setting made
+        by `use_streaming_reader()`
     """
 
     def __init__(
@@ -80,6 +95,7 @@ class ExcelWrapper:
         column_name_row_index=0,
         suggest_template=False,
         additional_context=None,
+        streaming=None,
     ):
         self._logger = logger
         self._log = []
@@ -91,7 +107,13 @@ class ExcelWrapper:
         self.additional_context = additional_context
         self.suggest_template = suggest_template
 
-        self.workbook = xlrd.open_workbook(file_name)
+        if streaming is None:
+            streaming = _streaming_default
+        self.streaming = streaming and zipfile.is_zipfile(file_name)
+        if self.streaming:
+            self.workbook = StreamingWorkbook(file_name)
+        else:
+            self.workbook = xlrd.open_workbook(file_name)
         self.modified = None
         try:
             self.modified = self.workbook.props["modified"]
@@ -442,6 +464,10 @@ class ExcelWrapper:
     def _get_rows(self):
         """Yields sequence of cells"""
 
+        if self.streaming:
+            yield from self.sheet.rows(self.header_length)
+            return
+
         merge_redirect = {}
         for crange in self.sheet.merged_cells:
             rlo, rhi, clo, chi = crange
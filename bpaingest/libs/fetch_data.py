@@ -5,9 +5,14 @@ Utility functions to fetch data from web server
 
 import os
 import re
+import shutil
+import threading
 import requests
 from bs4 import BeautifulSoup
-from urllib.parse import urljoin
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import quote, urljoin
+
+from ..util import localpath
 
 import requests.packages.urllib3
 
@@ -51,36 +56,273 @@ def get_env_username(username_variable="BPAINGEST_DOWNLOADS_USERNAME"):
     return os.getenv(username_variable)
 
 
+# the characters Apache leaves unescaped in autoindex hrefs, besides those
+# `quote` always leaves
+autoindex_safe = "$+!*'(),:;@&="
+# the size column of an Apache autoindex: bytes, a rounded size ("1.2G"), or "-"
+autoindex_size_re = re.compile(r"^(\d+(?:\.\d+)?[KMGTP]?|-)$")
+
+
+def autoindex_links(content):
+    """
+    the (href, size) of each link in an Apache autoindex page, in page order. `size`
+    is an int if the listing gives the exact size in bytes, otherwise None.
+    handles both table (HTMLTable) and <pre> (FancyIndexing) listings.
+    """
+    for link in BeautifulSoup(content, "html.parser").find_all("a"):
+        href = link.get("href")
+        if not href:
+            continue
+        row = link.find_parent("tr")
+        if row is not None:
+            cells = [t.get_text().strip() for t in row.find_all("td")]
+        else:
+            # <pre> listing: the date and size follow the link on the same line
+            following = link.next_sibling
+            text = following if isinstance(following, str) else ""
+            cells = text.split("\n", 1)[0].split()
+        sizes = [t for t in cells if autoindex_size_re.match(t)]
+        size = sizes[-1] if sizes else None
+        yield href, int(size) if size is not None and size.isdigit() else None
+
+
+def parse_autoindex(content):
+    "the {href: size} of each entry in an Apache autoindex page, see `autoindex_links`"
+    entries = {}
+    for href, size in autoindex_links(content):
+        if href.startswith(("?", "/")) or "://" in href:
+            continue
+        entries[href] = size
+    return entries
+
+
+class Validators:
+    """
+    the HTTP validators (ETag, Last-Modified) and size of each file downloaded by a
+    previous fetch, keyed by URL, used to make conditional requests; and those of
+    the files seen by this fetch. each record holds the local `path` of the file.
+    """
+
+    def __init__(self, previous=None):
+        self.previous = previous or {}
+        self.current = {}
+        self.not_modified = 0
+        self._lock = threading.Lock()
+
+    def headers(self, url, path, listed_size=None):
+        "the headers for a conditional GET of `url`, if it may be unchanged"
+        record = self.previous.get(url)
+        if record is None or not os.path.exists(path):
+            return {}
+        if listed_size is not None and listed_size != record.get("size"):
+            # the listing tells us it has changed
+            return {}
+        headers = {}
+        if record.get("etag"):
+            headers["If-None-Match"] = record["etag"]
+        if record.get("last_modified"):
+            headers["If-Modified-Since"] = record["last_modified"]
+        return headers
+
+    def unchanged(self, url):
+        with self._lock:
+            self.current[url] = self.previous[url]
+            self.not_modified += 1
+
+    def record(self, url, path, etag, last_modified, size, modified=True):
+        with self._lock:
+            self.current[url] = {
+                "path": path,
+                "etag": etag,
+                "last_modified": last_modified,
+                "size": size,
+            }
+            if not modified:
+                self.not_modified += 1
+
+    def removed(self):
+        "the records of files fetched before, but not seen by this fetch"
+        return [t for url, t in self.previous.items() if url not in self.current]
+
+
 class Fetcher:
     """facilitates fetching data from webserver"""
 
     recurse_re = re.compile(r"^[A-Za-z0-9_-]+/")
 
-    def __init__(self, logger, target_folder, metadata_source_url, auth=None):
+    def __init__(
+        self,
+        logger,
+        target_folder,
+        metadata_source_url,
+        auth=None,
+        validators=None,
+        store=None,
+        mirror_path=None,
+    ):
+        """
+        with `validators` (a `Validators`) given, files which are unchanged since
+        they were last downloaded are not downloaded again. with `store` (a
+        `metastore.MetadataStore`) given, files are fetched through it. with
+        `mirror_path` given, the archive is read from that filesystem mirror of it
+        (see `util.localpath`), rather than over HTTP.
+        """
         self._logger = logger
         self.target_folder = target_folder
         self.metadata_source_url = metadata_source_url
         self.auth = auth
+        self.validators = validators
+        self.store = store
+        self.mirror_path = mirror_path
         self._ensure_target_folder_exists()
 
     def _ensure_target_folder_exists(self):
         if not os.path.exists(self.target_folder):
             os.makedirs(self.target_folder, exist_ok=True)
 
-    def _fetch(self, session, base_url, name):
-        self._logger.info("Fetching {} from {}".format(name, base_url))
+    def _fetch(self, session, base_url, name, listed_size=None):
         url = base_url + name
-        with session.get(url, stream=True, auth=self.auth, verify=False) as r:
+        output_file = self.target_folder + "/" + name
+        if self.mirror_path is not None:
+            return self._copy_local(url, output_file)
+        if self.store is not None:
+            return self._fetch_stored(session, url, output_file, listed_size)
+        headers = {}
+        if self.validators is not None:
+            headers = self.validators.headers(url, output_file, listed_size)
+        if headers:
+            self._logger.debug("Checking {} from {}".format(name, base_url))
+        else:
+            self._logger.info("Fetching {} from {}".format(name, base_url))
+        with session.get(
+            url, stream=True, auth=self.auth, verify=False, headers=headers
+        ) as r:
+            if r.status_code == 304 and headers:
+                self.validators.unchanged(url)
+                return
             if r.status_code != 200:
                 raise DownloadException(
                     "status code {} for: {}".format(r.status_code, url)
                 )
-            output_file = self.target_folder + "/" + name
-            with open(output_file, "wb") as f:
+            # written alongside, and renamed, so an interrupted download doesn't
+            # leave a partial file which would later be taken as unchanged
+            tmpf = output_file + ".new"
+            size = 0
+            with open(tmpf, "wb") as f:
                 for chunk in r.iter_content(chunk_size=1024):
                     if chunk:
                         f.write(chunk)
-                        f.flush()
+                        size += len(chunk)
+            os.replace(tmpf, output_file)
+            if self.validators is not None:
+                self.validators.record(
+                    url,
+                    output_file,
+                    r.headers.get("ETag"),
+                    r.headers.get("Last-Modified"),
+                    size,
+                )
+
+    def _copy_local(self, url, output_file):
+        source = localpath(self.mirror_path, url)
+        self._logger.info("Copying {}".format(source))
+        tmpf = output_file + ".new"
+        try:
+            shutil.copyfile(source, tmpf)
+        except OSError as e:
+            raise DownloadException("unable to copy {}: {}".format(source, e))
+        os.replace(tmpf, output_file)
+        if self.validators is not None:
+            self.validators.record(
+                url, output_file, None, None, os.path.getsize(output_file)
+            )
+
+    def _fetch_stored(self, session, url, output_file, listed_size):
+        record, downloaded = self.store.fetch(
+            session, url, output_file, auth=self.auth, listed_size=listed_size
+        )
+        if self.validators is not None:
+            self.validators.record(
+                url,
+                output_file,
+                record["etag"],
+                record["last_modified"],
+                record["size"],
+                modified=downloaded,
+            )
+
+    def _list_folder(self, session, url):
+        """
+        {link target: size} for the unique link targets in the directory index at
+        `url`, in page order
+        """
+        if self.mirror_path is not None:
+            return self._scan_folder(url)
+        if self.store is not None:
+            return self.store.listing(url, lambda: self._read_folder(session, url))
+        return self._read_folder(session, url)
+
+    def _read_folder(self, session, url):
+        self._logger.info("Fetching folder from {}".format(url))
+        response = session.get(url, auth=self.auth, verify=False)
+        if response.status_code != 200:
+            self._logger.error(
+                "warning: status code %d for url %s" % (response.status_code, url)
+            )
+        targets = {}
+        for link_target, size in autoindex_links(response.content):
+            targets.setdefault(link_target, size)
+        return targets
+
+    def _scan_folder(self, url):
+        """
+        as `_read_folder`, from the archive mirror; dotfiles are hidden, and names
+        percent-encoded, as by Apache
+        """
+        path = localpath(self.mirror_path, url)
+        self._logger.info("Listing folder {}".format(path))
+        targets = {}
+        try:
+            entries = sorted(os.scandir(path), key=lambda t: t.name)
+        except OSError as e:
+            self._logger.error("warning: unable to list %s: %s" % (path, e))
+            return targets
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            name = quote(entry.name, safe=autoindex_safe)
+            if entry.is_dir():
+                targets[name + "/"] = None
+            else:
+                targets[name] = entry.stat().st_size
+        return targets
+
+    def _crawl(self, session, list_workers):
+        """
+        list every directory beneath `metadata_source_url`, `list_workers` at a
+        time, returning {url: link targets}
+        """
+        listings = {}
+        seen = {self.metadata_source_url}
+        with ThreadPoolExecutor(max_workers=max(1, list_workers)) as executor:
+            pending = {
+                executor.submit(
+                    self._list_folder, session, self.metadata_source_url
+                ): self.metadata_source_url
+            }
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = pending.pop(future)
+                    listings[url] = future.result()
+                    for link_target in listings[url]:
+                        child = urljoin(url, link_target)
+                        if Fetcher.recurse_re.match(link_target) and child not in seen:
+                            seen.add(child)
+                            pending[
+                                executor.submit(self._list_folder, session, child)
+                            ] = child
+        return listings
 
     def fetch_metadata_from_folder(
         self,
@@ -88,67 +330,44 @@ class Fetcher:
         metadata_info,
         url_components,
         download=True,
-        _target_depth=-1,
-        _url=None,
-        _session=None,
+        list_workers=8,
+        download_workers=4,
     ):
         """
         walk a directory structure, grabbing files matching `metadata_patterns`.
         `url_components` gives an expected minimum level of recursing to find matching files,
         and the names in `url_components` are used to set `metadata_info` for each downloaded file.
+
+        directories are listed, and files downloaded, concurrently; the listings are
+        then walked depth-first in page order, so `metadata_info` (and which file is
+        reported as non-unique) doesn't depend on the order the responses arrive in.
         """
 
         if metadata_patterns is None:
             metadata_patterns = [r"^.*\.(md5|xlsx)$"]
-        if _url is None:
-            _url = self.metadata_source_url
-        if _target_depth == -1:
-            _target_depth = len(url_components)
-        if _session is None:
-            _session = requests.Session()
-        self._logger.info("Fetching folder from {}".format(_url))
-        response = _session.get(_url, stream=True, auth=self.auth, verify=False)
-        if response.status_code != 200:
-            self._logger.error(
-                "warning: status code %d for url %s" % (response.status_code, _url)
-            )
-        fetched = set()
-        for link in BeautifulSoup(response.content, "html.parser").find_all("a"):
-            link_target = link.get("href")
-            if link_target in fetched:
-                continue
-            fetched.add(link_target)
-            # we need to descend directory tree further in order to find all `url_components`
-            if _target_depth > 0:
-                if Fetcher.recurse_re.match(link_target):
-                    self.fetch_metadata_from_folder(
-                        metadata_patterns,
-                        metadata_info,
-                        url_components,
-                        download=download,
-                        _session=_session,
-                        _target_depth=_target_depth - 1,
-                        _url=urljoin(_url, link_target),
-                    )
-            else:
+        patterns = [re.compile(pattern) for pattern in metadata_patterns]
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max(list_workers, download_workers, 1),
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        listings = self._crawl(session, list_workers)
+
+        to_fetch = []
+
+        def walk(url, target_depth):
+            for link_target in listings[url]:
+                # we need to descend directory tree further in order to find all `url_components`
+                if target_depth > 0:
+                    if Fetcher.recurse_re.match(link_target):
+                        walk(urljoin(url, link_target), target_depth - 1)
                 # descend anyway, to find whatever is there, but we've already hit target_depth
-                if Fetcher.recurse_re.match(link_target):
-                    self.fetch_metadata_from_folder(
-                        metadata_patterns,
-                        metadata_info,
-                        url_components,
-                        download=download,
-                        _session=_session,
-                        _target_depth=_target_depth,
-                        _url=urljoin(_url, link_target),
-                    )
-                elif not any(
-                    re.compile(pattern).match(link_target)
-                    for pattern in metadata_patterns
-                ):
-                    continue
-                else:
-                    subdir = _url[len(self.metadata_source_url) :].strip("/")
+                elif Fetcher.recurse_re.match(link_target):
+                    walk(urljoin(url, link_target), target_depth)
+                elif any(pattern.match(link_target) for pattern in patterns):
+                    subdir = url[len(self.metadata_source_url) :].strip("/")
                     meta_parts = subdir.split("/")[: len(url_components)]
                     assert len(meta_parts) == len(url_components)
                     if link_target in metadata_info:
@@ -159,7 +378,16 @@ class Fetcher:
                     metadata_info[link_target] = dict(
                         list(zip(url_components, meta_parts))
                     )
-                    metadata_info[link_target]["base_url"] = _url
-                    # download the actual file
-                    if download:
-                        self._fetch(_session, _url, link_target)
+                    metadata_info[link_target]["base_url"] = url
+                    to_fetch.append((url, link_target, listings[url][link_target]))
+
+        walk(self.metadata_source_url, len(url_components))
+
+        # download the actual files
+        if download and to_fetch:
+            with ThreadPoolExecutor(max_workers=max(1, download_workers)) as executor:
+                futures = [
+                    executor.submit(self._fetch, session, *task) for task in to_fetch
+                ]
+                for future in futures:
+                    future.result()
@@ -1,5 +1,15 @@
+import datetime
+import functools
+import os
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO
 
+import pytest
+from openpyxl import Workbook
+
+from .excel_wrapper import ExcelWrapper, make_field_definition as fld
+from .fetch_data import DownloadException, Fetcher, Validators
 from .ingest_utils import get_clean_number, get_clean_doi
 from .multihash import _generate_hashes
 from bpaingest.libs.common_resources import bsd_md5_re, linux_md5_re
@@ -120,3 +130,181 @@ def test_get_clean_doi():
         assert get_clean_doi(logger, s) == f
     assert get_clean_doi(logger, "") is ""
     assert get_clean_doi(logger, None) is None
+
+
+def serve_directory(path):
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(QuietHandler, directory=path)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_fetch_metadata_from_folder(tmpdir):
+    archive = tmpdir.mkdir("archive")
+    for ticket in range(12):
+        ticket_dir = archive.mkdir("BPA-%02d" % (ticket))
+        for amplicon in ("16S", "ITS"):
+            amplicon_dir = ticket_dir.mkdir(amplicon)
+            amplicon_dir.join("%s_%02d_metadata.xlsx" % (amplicon, ticket)).write(
+                "%s %d" % (amplicon, ticket)
+            )
+            amplicon_dir.join("%s_%02d_checksums.md5" % (amplicon, ticket)).write("")
+            amplicon_dir.join("%s_%02d.fastq.gz" % (amplicon, ticket)).write("")
+    server = serve_directory(str(archive))
+    url = "http://127.0.0.1:%d/" % (server.server_address[1])
+
+    def fetch(target, **kwargs):
+        metadata_info = {}
+        Fetcher(logger, str(target), url).fetch_metadata_from_folder(
+            None, metadata_info, ["ticket", "amplicon"], **kwargs
+        )
+        return metadata_info
+
+    try:
+        serial = fetch(tmpdir.join("serial"), list_workers=1, download_workers=1)
+        concurrent = fetch(tmpdir.join("concurrent"), list_workers=8)
+        assert list(serial.items()) == list(concurrent.items())
+        assert len(concurrent) == 48
+        assert concurrent["ITS_03_metadata.xlsx"] == {
+            "ticket": "BPA-03",
+            "amplicon": "ITS",
+            "base_url": url + "BPA-03/ITS/",
+        }
+        assert tmpdir.join("concurrent", "ITS_03_metadata.xlsx").read() == "ITS 3"
+        # the same, read from a filesystem mirror of the archive
+        mirrored = {}
+        Fetcher(
+            logger, str(tmpdir.join("mirrored")), url, mirror_path=str(archive)
+        ).fetch_metadata_from_folder(None, mirrored, ["ticket", "amplicon"])
+        assert list(mirrored.items()) == list(concurrent.items())
+        assert tmpdir.join("mirrored", "ITS_03_metadata.xlsx").read() == "ITS 3"
+
+        # the first file found, walking the tree in order, is the one reported
+        archive.join("BPA-07", "16S").join("ITS_03_metadata.xlsx").write("")
+        with pytest.raises(DownloadException, match="BPA-03"):
+            fetch(tmpdir.join("duplicate"), download=False)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_fetch_metadata_from_mirror_quoted(tmpdir):
+    # autoindex hrefs are percent-encoded; so are the names listed from the mirror
+    archive = tmpdir.mkdir("archive")
+    archive.mkdir("BPA-1").mkdir("16S").join("16S 1_metadata.xlsx").write("16S 1")
+    server = serve_directory(str(archive))
+    url = "http://127.0.0.1:%d/" % (server.server_address[1])
+
+    def fetch(target, **kwargs):
+        metadata_info = {}
+        Fetcher(logger, str(target), url, **kwargs).fetch_metadata_from_folder(
+            None, metadata_info, ["ticket", "amplicon"]
+        )
+        return metadata_info
+
+    try:
+        served = fetch(tmpdir.join("served"))
+        mirrored = fetch(tmpdir.join("mirrored"), mirror_path=str(archive))
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert served == {
+        "16S%201_metadata.xlsx": {
+            "ticket": "BPA-1",
+            "amplicon": "16S",
+            "base_url": url + "BPA-1/16S/",
+        }
+    }
+    assert mirrored == served
+    assert tmpdir.join("mirrored", "16S%201_metadata.xlsx").read() == "16S 1"
+
+
+def test_fetch_metadata_conditional(tmpdir):
+    archive = tmpdir.mkdir("archive")
+    for ticket in range(3):
+        archive.mkdir("BPA-%d" % (ticket)).join("%d_metadata.xlsx" % (ticket)).write(
+            "v1"
+        )
+    server = serve_directory(str(archive))
+    url = "http://127.0.0.1:%d/" % (server.server_address[1])
+    target = tmpdir.join("metadata")
+
+    def fetch(previous):
+        validators = Validators(previous)
+        Fetcher(
+            logger, str(target), url, validators=validators
+        ).fetch_metadata_from_folder(None, {}, ["ticket"])
+        return validators
+
+    try:
+        first = fetch({})
+        assert len(first.current) == 3 and first.not_modified == 0
+        second = fetch(first.current)
+        assert second.not_modified == 3
+        assert second.current == first.current
+
+        modified = archive.join("BPA-1", "1_metadata.xlsx")
+        modified.write("v2")
+        mtime = modified.mtime() + 10
+        os.utime(str(modified), (mtime, mtime))
+        archive.mkdir("BPA-3").join("3_metadata.xlsx").write("v1")
+        archive.join("BPA-0").remove()
+        third = fetch(second.current)
+        assert third.not_modified == 1
+        assert target.join("1_metadata.xlsx").read() == "v2"
+        assert target.join("3_metadata.xlsx").read() == "v1"
+        assert [t["path"] for t in third.removed()] == [
+            str(target.join("0_metadata.xlsx"))
+        ]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_excel_wrapper_streaming(tmpdir):
+    workbook = Workbook()
+    workbook.active.title = "Notes"
+    sheet = workbook.create_sheet("Metadata")
+    sheet.append(["Sample ID", "Site", "Collection Date", "Time", "Depth", "Flag"])
+    sheet.append(["102.100.100/1", "  Site A ", datetime.datetime(2019, 5, 1), None])
+    sheet.append(["102.100.100/2", None, datetime.datetime(2019, 5, 2, 13, 30)])
+    sheet.append([])
+    sheet.append(["102.100.100/3", "Site B", None, datetime.time(9, 15), 12, True])
+    sheet.append(["102.100.100/4", None, None, None, 7.5, "=1/0"])
+    sheet.merge_cells("B2:B4")
+    sheet.merge_cells("D5:D6")
+    sheet.cell(row=1000, column=2).number_format = "0.00"
+    fname = str(tmpdir.join("metadata.xlsx"))
+    workbook.save(fname)
+
+    field_spec = [
+        fld("sample_id", "sample id"),
+        fld("site", "site"),
+        fld("collection_date", "collection date"),
+        fld("time", "time"),
+        fld("depth", "depth"),
+        fld("flag", "flag"),
+    ]
+
+    def read(streaming):
+        wrapper = ExcelWrapper(
+            logger, field_spec, fname, header_length=1, streaming=streaming
+        )
+        assert wrapper.sheet.name == "Metadata"
+        return wrapper.modified, list(wrapper.get_all()), list(wrapper.get_all())
+
+    modified, rows, again = read(True)
+    assert read(False) == (modified, rows, again)
+    assert rows == again
+    assert len(rows) == 5
+    assert rows[1].site == "Site A"
+    assert rows[1].collection_date == datetime.datetime(2019, 5, 2, 13, 30)
+    # merged cells are read from the top-left cell of their range
+    assert rows[2].sample_id == ""
+    assert rows[2].site == "Site A"
+    assert rows[4].time == datetime.time(9, 15)
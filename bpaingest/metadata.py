@@ -2,11 +2,99 @@ import tempfile
 import shutil
 import json
 import os
+import threading
+from collections import defaultdict
 from contextlib import suppress
 
 import requests as requests
 
-from .libs.fetch_data import Fetcher, get_password, get_env_username
+from .libs.fetch_data import (
+    DownloadException,
+    Fetcher,
+    Validators,
+    get_password,
+    get_env_username,
+)
+from .profiling import phase
+
+
+def project_auth(logger, project_class):
+    "the (username, password) used to access the archive holding a project's data"
+    env_auth_user = get_env_username()
+    if env_auth_user is not None:
+        logger.info(f"Using username from environment: {env_auth_user}")
+        auth_user, auth_env_name = env_auth_user, env_auth_user
+    else:
+        logger.info(f"Defaulting to project auth...")
+        auth_user, auth_env_name = project_class.auth
+    return (auth_user, get_password(auth_env_name))
+
+
+class ContextualRegistry:
+    """
+    contextual metadata shared between the projects synced in one process:
+    each contextual class is fetched, into a directory under `path`, and
+    loaded once. the loaded instances must be treated as read-only.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._instances = {}
+        self._lock = threading.Lock()
+        self._class_locks = defaultdict(threading.Lock)
+
+    def get(self, logger, contextual_cls, auth, metadata_info):
+        with self._lock:
+            class_lock = self._class_locks[contextual_cls]
+        with class_lock:
+            if contextual_cls not in self._instances:
+                contextual_path = os.path.join(
+                    self.path,
+                    "%s.%s" % (contextual_cls.__module__, contextual_cls.__name__),
+                )
+                if not os.path.isdir(contextual_path):
+                    os.makedirs(contextual_path)
+                    fetch_contextual(
+                        logger, contextual_path, contextual_cls, auth, metadata_info
+                    )
+                else:
+                    logger.info(
+                        "Context path: {} already exists. Moving on.".format(
+                            contextual_path
+                        )
+                    )
+                self._instances[contextual_cls] = contextual_cls(
+                    logger, contextual_path
+                )
+            return self._instances[contextual_cls]
+
+
+def fetch_contextual(
+    logger,
+    contextual_path,
+    contextual_cls,
+    auth,
+    metadata_info,
+    validators=None,
+    store=None,
+    mirror_path=None,
+):
+    logger.info("fetching contextual metadata: %s" % (contextual_cls.metadata_urls))
+    for metadata_url in contextual_cls.metadata_urls:
+        fetcher = Fetcher(
+            logger,
+            contextual_path,
+            metadata_url,
+            auth,
+            validators=validators,
+            store=store,
+            mirror_path=mirror_path,
+        )
+        fetcher.fetch_metadata_from_folder(
+            getattr(contextual_cls, "metadata_patterns", None),
+            metadata_info,
+            getattr(contextual_cls, "metadata_url_components", []),
+        )
 
 
 class DownloadMetadata:
@@ -19,9 +107,26 @@ class DownloadMetadata:
         metadata_info=None,
         has_sql_context=False,
         has_validate_schema=False,
+        contextual_registry=None,
+        refresh=False,
+        store=None,
+        mirror_path=None,
     ):
+        """
+        with `contextual_registry` (a `ContextualRegistry`) given, contextual
+        metadata is taken from it, rather than fetched for this project alone.
+
+        metadata already downloaded to `path` is used as it is, unless `refresh`
+        is set: the archive is then crawled again, and only new or modified
+        files are downloaded. with `store` (a `metastore.MetadataStore`) given,
+        metadata files are fetched through it. with `mirror_path` given, the
+        metadata is read from that filesystem mirror of the archive.
+        """
         self.cleanup = True
         self.fetch = True
+        self.refresh = refresh
+        self.store = store
+        self.mirror_path = mirror_path
         self._logger = logger
         self._set_path(path)
         self._set_auth(project_class)
@@ -37,6 +142,12 @@ class DownloadMetadata:
         else:
             contextual_classes = getattr(project_class, "contextual_classes", [])
 
+        self.contextual_registry = contextual_registry
+        if contextual_registry is not None:
+            self.shared_contextual = contextual_classes
+            contextual_classes = []
+        else:
+            self.shared_contextual = []
         self.contextual = [
             (os.path.join(self.path, c.name), c) for c in contextual_classes
         ]
@@ -51,7 +162,8 @@ class DownloadMetadata:
         ]
 
         if self.fetch or force_fetch:
-            self._fetch_metadata(project_class, self.contextual, metadata_info)
+            with phase("metadata-fetch"):
+                self._fetch_metadata(project_class, self.contextual, metadata_info)
 
         self.project_class = project_class
         self.meta = self.make_meta(logger)
@@ -60,22 +172,57 @@ class DownloadMetadata:
         meta_kwargs = {}
         with open(self.info_json, "r") as fd:
             meta_kwargs["metadata_info"] = json.load(fd)
-        if self.contextual:
-            meta_kwargs["contextual_metadata"] = [
-                c(self._logger, p) for (p, c) in self.contextual
-            ]
+        with phase("contextual-load"):
+            if self.shared_contextual:
+                meta_kwargs["contextual_metadata"] = [
+                    self.contextual_registry.get(
+                        self._logger, c, self.auth, meta_kwargs["metadata_info"]
+                    )
+                    for c in self.shared_contextual
+                ]
+            elif self.contextual:
+                meta_kwargs["contextual_metadata"] = [
+                    c(self._logger, p) for (p, c) in self.contextual
+                ]
         if self.schema_definitions:
             meta_kwargs["schema_definitions"] = [
                 c(self._logger, p) for (p, c) in self.schema_definitions
             ]
         return self.project_class(logger, self.path, **meta_kwargs)
 
+    def _read_validators(self):
+        if not os.access(self.validators_json, os.R_OK):
+            return {}
+        with open(self.validators_json) as fd:
+            validators = json.load(fd)
+        for record in validators.values():
+            record["path"] = os.path.join(self.path, record["path"])
+        return validators
+
+    def _write_validators(self, validators):
+        records = {}
+        for url, record in validators.current.items():
+            records[url] = dict(record, path=os.path.relpath(record["path"], self.path))
+        tmpf = self.validators_json + ".new"
+        with open(tmpf, "w") as fd:
+            json.dump(records, fd, sort_keys=True)
+        os.replace(tmpf, self.validators_json)
+
     def _fetch_metadata(self, project_class, contextual, metadata_info):
+        validators = Validators(self._read_validators())
         for metadata_url in project_class.metadata_urls:
             self._logger.info(
                 "fetching submission metadata: %s" % (project_class.metadata_urls)
             )
-            fetcher = Fetcher(self._logger, self.path, metadata_url, self.auth)
+            fetcher = Fetcher(
+                self._logger,
+                self.path,
+                metadata_url,
+                self.auth,
+                validators=validators,
+                store=self.store,
+                mirror_path=self.mirror_path,
+            )
             fetcher.fetch_metadata_from_folder(
                 getattr(project_class, "metadata_patterns", None),
                 metadata_info,
@@ -94,19 +241,28 @@ class DownloadMetadata:
                         contextual_path
                     )
                 )
-            self._logger.info(
-                "fetching contextual metadata: %s" % (contextual_cls.metadata_urls)
+            fetch_contextual(
+                self._logger,
+                contextual_path,
+                contextual_cls,
+                self.auth,
+                metadata_info,
+                validators=validators,
+                store=self.store,
+                mirror_path=self.mirror_path,
             )
-            for metadata_url in contextual_cls.metadata_urls:
-                fetcher = Fetcher(
-                    self._logger, contextual_path, metadata_url, self.auth
-                )
-                fetcher.fetch_metadata_from_folder(
-                    getattr(contextual_cls, "metadata_patterns", None),
-                    metadata_info,
-                    getattr(contextual_cls, "metadata_url_components", []),
-                )
         self.init_schema_classes(project_class, metadata_info)
+        for record in validators.removed():
+            # no longer in the archive, so must not be ingested
+            self._logger.info("removing metadata file: %s" % (record["path"]))
+            with suppress(FileNotFoundError):
+                os.unlink(record["path"])
+        if validators.not_modified:
+            self._logger.info(
+                "%d metadata files unchanged since the last download"
+                % (validators.not_modified)
+            )
+        self._write_validators(validators)
         tmpf = self.info_json + ".new"
         with open(tmpf, "w") as fd:
             json.dump(metadata_info, fd)
@@ -131,6 +287,11 @@ class DownloadMetadata:
             )
             for metadata_url in schema_cls.metadata_urls:
                 local_filename = metadata_url.split("/")[-1]
+                if self.store is not None:
+                    self._fetch_stored_schema(
+                        schema_path, metadata_url, local_filename, metadata_info
+                    )
+                    continue
                 response = requests.get(url=metadata_url, timeout=10, stream=True)
                 error_message = f"Unable to download: {metadata_url}"
                 try:
@@ -148,15 +309,24 @@ class DownloadMetadata:
                 finally:
                     self._logger.info("schema download complete.")
 
+    def _fetch_stored_schema(
+        self, schema_path, metadata_url, local_filename, metadata_info
+    ):
+        try:
+            self.store.fetch(
+                requests.Session(),
+                metadata_url,
+                os.path.join(schema_path, local_filename),
+                timeout=10,
+            )
+        except (DownloadException, requests.exceptions.RequestException) as e:
+            self._logger.error(f"Unable to download: {metadata_url} ({e})")
+            return
+        metadata_info[local_filename] = dict()
+        metadata_info[local_filename]["base_url"] = schema_path
+
     def _set_auth(self, project_class):
-        env_auth_user = get_env_username()
-        if env_auth_user is not None:
-            self._logger.info(f"Using username from environment: {env_auth_user}")
-            auth_user, auth_env_name = env_auth_user, env_auth_user
-        else:
-            self._logger.info(f"Defaulting to project auth...")
-            auth_user, auth_env_name = project_class.auth
-        self.auth = (auth_user, get_password(auth_env_name))
+        self.auth = project_auth(self._logger, project_class)
 
     def _set_path(self, path):
         # if we have a user-specified target directory, don't clean up at the end
@@ -165,7 +335,14 @@ class DownloadMetadata:
             path = tempfile.mkdtemp(prefix="bpaingest-metadata-")
         self.path = path
         self.info_json = os.path.join(path, "bpa-ingest.json")
-        if os.access(self.info_json, os.R_OK):
+        self.validators_json = os.path.join(path, "bpa-ingest-validators.json")
+        if not os.access(self.info_json, os.R_OK):
+            return
+        if self.refresh:
+            self._logger.info(
+                "refreshing metadata, previous download in directory `%s'" % path
+            )
+        else:
             self._logger.info(
                 "skipping metadata download, complete download in directory `%s' exists"
                 % path
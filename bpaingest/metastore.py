@@ -0,0 +1,199 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+from collections import defaultdict
+
+from .libs.fetch_data import DownloadException
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    url TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    size INTEGER
+);
+"""
+
+
+class MetadataStore:
+    """
+    metadata files, shared between projects and runs. each file is stored once,
+    under `path`, named by the SHA-256 of its content; an index (in SQLite)
+    maps each URL to the file last downloaded from it, and the validators
+    (ETag, Last-Modified) sent with it.
+
+    a project's download directory is a view of the store: its files are hard
+    links to the stored files (or symbolic links, if the download directory is
+    on another filesystem). the stored files are never modified, so neither
+    are the views.
+
+    within a run (the lifetime of the store) a URL is requested at most once,
+    and directory listings are only fetched once; across runs, stored files
+    are revalidated with conditional requests.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.objects_path = os.path.join(path, "objects")
+        os.makedirs(self.objects_path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            os.path.join(path, "index.db"), check_same_thread=False
+        )
+        self._conn.executescript(SCHEMA)
+        self._url_locks = defaultdict(threading.Lock)
+        # URLs fetched, or revalidated, during this run
+        self._fresh = {}
+        self._listings = {}
+        self.downloaded = 0
+        self.reused = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _url_lock(self, url):
+        with self._lock:
+            return self._url_locks[url]
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_path, digest[:2], digest)
+
+    def get(self, url):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT digest, etag, last_modified, size FROM objects WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("digest", "etag", "last_modified", "size"), row))
+
+    def _record(self, url, record):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO objects (url, digest, etag, last_modified, size) VALUES (?, ?, ?, ?, ?)",
+                (
+                    url,
+                    record["digest"],
+                    record["etag"],
+                    record["last_modified"],
+                    record["size"],
+                ),
+            )
+
+    def _link(self, digest, destination):
+        source = self._object_path(digest)
+        tmpf = destination + ".new"
+        if os.path.lexists(tmpf):
+            os.unlink(tmpf)
+        try:
+            os.link(source, tmpf)
+        except OSError:
+            os.symlink(os.path.abspath(source), tmpf)
+        os.replace(tmpf, destination)
+
+    def _store(self, response):
+        "write the body of `response` to the store, returning its digest and size"
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, tmpf = tempfile.mkstemp(dir=self.objects_path, prefix=".download-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=65536):
+                    if chunk:
+                        f.write(chunk)
+                        sha256.update(chunk)
+                        size += len(chunk)
+            digest = sha256.hexdigest()
+            object_path = self._object_path(digest)
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.chmod(tmpf, 0o444)
+            os.replace(tmpf, object_path)
+        except BaseException:
+            if os.path.exists(tmpf):
+                os.unlink(tmpf)
+            raise
+        return digest, size
+
+    def fetch(
+        self, session, url, destination, auth=None, listed_size=None, timeout=None
+    ):
+        """
+        place the file at `url` at `destination`, downloading it only if it isn't
+        already stored and current. `listed_size` is the size given for the file by
+        a directory listing, if any. returns the file's record in the index, and
+        whether it was downloaded.
+        """
+        with self._url_lock(url):
+            record = self._fresh.get(url)
+            if record is not None:
+                with self._lock:
+                    self.reused += 1
+                self._link(record["digest"], destination)
+                return record, False
+            record = self.get(url)
+            headers = {}
+            if (
+                record is not None
+                and os.path.exists(self._object_path(record["digest"]))
+                and (listed_size is None or listed_size == record["size"])
+            ):
+                if record["etag"]:
+                    headers["If-None-Match"] = record["etag"]
+                if record["last_modified"]:
+                    headers["If-Modified-Since"] = record["last_modified"]
+            with session.get(
+                url,
+                stream=True,
+                auth=auth,
+                verify=False,
+                headers=headers,
+                timeout=timeout,
+            ) as response:
+                if response.status_code == 304 and headers:
+                    downloaded = False
+                elif response.status_code == 200:
+                    digest, size = self._store(response)
+                    record = {
+                        "digest": digest,
+                        "etag": response.headers.get("ETag"),
+                        "last_modified": response.headers.get("Last-Modified"),
+                        "size": size,
+                    }
+                    self._record(url, record)
+                    downloaded = True
+                else:
+                    raise DownloadException(
+                        "status code {} for: {}".format(response.status_code, url)
+                    )
+            self._fresh[url] = record
+            with self._lock:
+                if downloaded:
+                    self.downloaded += 1
+                else:
+                    self.reused += 1
+            self._link(record["digest"], destination)
+            return record, downloaded
+
+    def listing(self, url, list_fn):
+        "the directory listing at `url`, calling `list_fn` only once a run"
+        with self._url_lock(url):
+            if url not in self._listings:
+                self._listings[url] = list_fn()
+            return self._listings[url]
+
+
+def make_metadata_store(args):
+    "the metadata store given by --metadata-store, or None"
+    path = getattr(args, "metadata_store", None)
+    if path is None:
+        return None
+    logger.info("using metadata store: %s" % (path))
+    return MetadataStore(path)
@@ -0,0 +1,270 @@
+import json
+import os
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+)
+# upper bounds of the transfer size buckets, in bytes
+SIZE_BUCKETS = tuple(1 << t for t in range(10, 42, 2))
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    """
+    counts of observations in fixed buckets, as a Prometheus histogram. memory
+    use is fixed, however long the run; quantiles are estimated by
+    interpolating within the bucket in which they fall.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    # beyond the last bucket, the best we can say is its bound
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def as_dict(self):
+        d = {"count": self.count, "sum": round(self.sum, 6)}
+        for q in QUANTILES:
+            value = self.quantile(q)
+            d["p%d" % (q * 100)] = round(value, 6) if value is not None else None
+        return d
+
+    def prometheus(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += n
+            lines.append(
+                "%s_bucket%s %d"
+                % (name, format_labels(dict(labels, le=str(bound))), cumulative)
+            )
+        lines.append("%s_sum%s %s" % (name, format_labels(labels), repr(self.sum)))
+        lines.append("%s_count%s %d" % (name, format_labels(labels), self.count))
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in sorted(labels.items())
+    )
+
+
+class Metrics:
+    """
+    what a run spends its time on: the latency of each CKAN action, errors and
+    retries, the bytes moved by reuploads, and the outcome of resource checks
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+            self.errors = defaultdict(int)
+            self.retries = defaultdict(int)
+            self.transfer_bytes = defaultdict(int)
+            self.transfer_sizes = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+            self.checks = defaultdict(int)
+
+    def observe_call(self, object_type, method, seconds, error=None):
+        "a single attempt at a CKAN action; `error` is the kind of any failure"
+        with self._lock:
+            self.latency[(object_type, method)].observe(seconds)
+            if error is not None:
+                self.errors[(object_type, method, error)] += 1
+
+    def count_retry(self, object_type, method, kind):
+        with self._lock:
+            self.retries[(object_type, method, kind)] += 1
+
+    def add_transfer(self, direction, size):
+        "a file of `size` bytes was `downloaded` or `uploaded` by a reupload"
+        with self._lock:
+            self.transfer_bytes[direction] += size
+            self.transfer_sizes[direction].observe(size)
+
+    def count_check(self, outcome):
+        "the outcome of a resource check: `ok`, `skipped`, or the problem found"
+        with self._lock:
+            self.checks[outcome] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                "ckan_calls": dict(
+                    ("%s_%s" % k, v.as_dict()) for k, v in sorted(self.latency.items())
+                ),
+                "ckan_errors": dict(
+                    ("%s_%s/%s" % k, v) for k, v in sorted(self.errors.items())
+                ),
+                "ckan_retries": dict(
+                    ("%s_%s/%s" % k, v) for k, v in sorted(self.retries.items())
+                ),
+                "transfer_bytes": dict(self.transfer_bytes),
+                "transfers": dict(
+                    (k, v.as_dict()) for k, v in sorted(self.transfer_sizes.items())
+                ),
+                "resource_checks": dict(self.checks),
+            }
+
+    def prometheus(self):
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+        with self._lock:
+            family(
+                "bpaingest_ckan_call_seconds",
+                "histogram",
+                "latency of each attempt at a CKAN action",
+            )
+            for (object_type, method), histogram in sorted(self.latency.items()):
+                lines += histogram.prometheus(
+                    "bpaingest_ckan_call_seconds",
+                    {"object_type": object_type, "method": method},
+                )
+            family(
+                "bpaingest_ckan_errors_total", "counter", "failed CKAN action attempts"
+            )
+            for (object_type, method, kind), n in sorted(self.errors.items()):
+                labels = {"object_type": object_type, "method": method, "kind": kind}
+                lines.append(
+                    "bpaingest_ckan_errors_total%s %d" % (format_labels(labels), n)
+                )
+            family(
+                "bpaingest_ckan_retries_total",
+                "counter",
+                "retried CKAN action attempts",
+            )
+            for (object_type, method, kind), n in sorted(self.retries.items()):
+                labels = {"object_type": object_type, "method": method, "kind": kind}
+                lines.append(
+                    "bpaingest_ckan_retries_total%s %d" % (format_labels(labels), n)
+                )
+            family(
+                "bpaingest_reupload_bytes",
+                "histogram",
+                "size of each file transferred by a reupload",
+            )
+            for direction, histogram in sorted(self.transfer_sizes.items()):
+                lines += histogram.prometheus(
+                    "bpaingest_reupload_bytes", {"direction": direction}
+                )
+            family(
+                "bpaingest_resource_checks_total", "counter", "resource check outcomes"
+            )
+            for outcome, n in sorted(self.checks.items()):
+                lines.append(
+                    "bpaingest_resource_checks_total%s %d"
+                    % (format_labels({"outcome": outcome}), n)
+                )
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path=None, prometheus_path=None):
+        # written to a temporary file and renamed, so a reader (such as the
+        # node exporter's textfile collector) never sees a partial file
+        for path, content in (
+            (json_path, lambda: json.dumps(self.as_dict(), indent=2, sort_keys=True)),
+            (prometheus_path, self.prometheus),
+        ):
+            if path is None:
+                continue
+            tmpf = path + ".new"
+            with open(tmpf, "w") as fd:
+                fd.write(content())
+            os.replace(tmpf, path)
+
+
+metrics = Metrics()
+
+
+class MetricsWriter:
+    """
+    writes `metrics` out every `interval` seconds while running, and once more
+    when stopped
+    """
+
+    def __init__(self, metrics, json_path=None, prometheus_path=None, interval=60):
+        self.metrics = metrics
+        self.json_path = json_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _write(self):
+        try:
+            self.metrics.write(self.json_path, self.prometheus_path)
+        except OSError as e:
+            logger.error("unable to write metrics: %s" % (e))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._write()
+
+    def start(self):
+        if self.interval:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._write()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
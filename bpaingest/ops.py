@@ -1,3 +1,5 @@
+import json
+import re
 import subprocess
 import tempfile
 import urllib
@@ -7,30 +9,49 @@ import bitmath
 import requests
 import ckanapi
 import os
-import time
-from urllib.parse import urlparse
+import threading
+from urllib.parse import urlparse, unquote, urljoin
 from urllib.request import url2pathname
 from collections import defaultdict
+from hashlib import sha256
 
 from .libs.ingest_utils import ApiFqBuilder
-from .util import make_logger
+from .libs.fetch_data import parse_autoindex
+from .s3 import (
+    s3_location,
+    stream_to_s3,
+    stream_file_to_s3,
+    check_uploaded_etag,
+    file_range_reader,
+    http_range_reader,
+    list_resource_objects,
+    read_inventory_csv,
+)
+from .metrics import metrics
+from .scheduler import get_scheduler
+from .util import localpath, make_logger
 
 logger = make_logger(__name__)
 UPLOAD_RETRY = 3
+# CKAN field holding `object_fingerprint` of the object we last sent
+FINGERPRINT_FIELD = "bpaingest_fingerprint"
 
 method_stats = defaultdict(int)
+method_stats_lock = threading.Lock()
 
 
 def ckan_method(ckan, object_type, method):
     """
     returns a CKAN method from the upstream API, with an
-    intermediate function which does some global accounting
+    intermediate function which does some global accounting,
+    and which schedules (and if need be, retries) the call
     """
     fn = getattr(ckan.action, object_type + "_" + method)
 
     def _proxy_fn(*args, **kwargs):
-        method_stats[(object_type, method)] += 1
-        return fn(*args, **kwargs)
+        with method_stats_lock:
+            method_stats[(object_type, method)] += 1
+        return get_scheduler().call(object_type + "_" + method, fn, *args, **kwargs)
 
     return _proxy_fn
 
@@ -44,6 +65,20 @@ def print_accounts():
                 % (object_type, method, method_stats[(object_type, method)])
             )
         )
+    retry_stats = get_scheduler().retry_stats
+    if retry_stats:
+        print("API retries:")
+        for (action, kind), count in sorted(retry_stats.items()):
+            print("  %21s  %12s  %d" % (action, kind, count))
+    latency = metrics.as_dict()["ckan_calls"]
+    if latency:
+        print("API latency (seconds):")
+        print("  %21s  %8s  %8s  %8s" % ("", "p50", "p95", "p99"))
+        for action, summary in sorted(latency.items()):
+            print(
+                "  %21s  %8.3f  %8.3f  %8.3f"
+                % (action, summary["p50"], summary["p95"], summary["p99"])
+            )
 
 
 def diff_objects(obj1, obj2, desc, skip_differences=None):
@@ -74,26 +109,88 @@ def diff_objects(obj1, obj2, desc, skip_differences=None):
     return len(differences) > 0
 
 
-def patch_if_required(
-    ckan, object_type, ckan_object, patch_object, skip_differences=None
+def object_fingerprint(obj, skip_differences=None):
+    """
+    a digest of the content of `obj`, canonicalised the same way as `diff_objects`
+    compares it: lists are order-insensitive, and values compare as strings
+    """
+
+    def canonical(v):
+        if isinstance(v, list):
+            return sorted((canonical(t) for t in v), key=repr)
+        if isinstance(v, dict):
+            return dict((str(k), canonical(t)) for k, t in v.items())
+        if v is None or isinstance(v, bool):
+            return v
+        return str(v)
+
+    content = dict(
+        (k, canonical(v))
+        for k, v in obj.items()
+        if k != FINGERPRINT_FIELD and not (skip_differences and k in skip_differences)
+    )
+    return sha256(
+        json.dumps(content, sort_keys=True, separators=(",", ":")).encode("utf8")
+    ).hexdigest()
+
+
+def plan_patch(
+    object_type, ckan_object, patch_object, skip_differences=None, fingerprint=False
 ):
     """
-    patch ckan_object if applying patch_object would change it. ckan_object is unchanged
-    for any keys which are not mentioned in patch_object
+    decide whether ckan_object needs to be patched with patch_object, without
+    talking to CKAN. returns (patch_needed, patch, fingerprint_only), where `patch`
+    is the object to send to CKAN, or None if no call is required.
+
+    if `fingerprint` is set, a fingerprint of `patch_object` is stored on the CKAN
+    object. if the fingerprint stored on `ckan_object` matches, it is unchanged since
+    we last sent it, and the comparison is skipped. `fingerprint_only` is set when
+    nothing but the fingerprint differs, though a patch is still sent to record it.
     """
-    logger.debug("start patch if required")
+    if fingerprint:
+        object_print = object_fingerprint(patch_object, skip_differences)
+        if ckan_object.get(FINGERPRINT_FIELD) == object_print:
+            logger.debug("fingerprint matches, skipping comparison")
+            return False, None, False
     patch_needed = diff_objects(patch_object, ckan_object, object_type)
+    if fingerprint:
+        # record the fingerprint even if nothing else differs, so the
+        # comparison can be skipped next time
+        patch_object = dict(patch_object)
+        patch_object[FINGERPRINT_FIELD] = object_print
     if patch_needed:
-        try:
-            ckan_object = ckan_method(ckan, object_type, "patch")(**patch_object)
-        except ckanapi.errors.CKANAPIError:
-            # wait 2 sec, then try again (give up if it fails a second time)
-            logger.warning("ckan patch failed, waiting 2 sec, then trying again")
-            time.sleep(2)
-            ckan_object = ckan_method(ckan, object_type, "patch")(**patch_object)
+        return True, patch_object, False
+    if fingerprint and ckan_object.get(FINGERPRINT_FIELD) != object_print:
+        return False, patch_object, True
+    return False, None, False
+
 
+def apply_patch(ckan, object_type, patch_object):
+    "transient failures are retried by the scheduler, see `ckan_method`"
+    return ckan_method(ckan, object_type, "patch")(**patch_object)
+
+
+def patch_if_required(
+    ckan,
+    object_type,
+    ckan_object,
+    patch_object,
+    skip_differences=None,
+    fingerprint=False,
+):
+    """
+    patch ckan_object if applying patch_object would change it. ckan_object is unchanged
+    for any keys which are not mentioned in patch_object. returns (patch_needed,
+    ckan_object, fingerprint_only); see `plan_patch`.
+    """
+    logger.debug("start patch if required")
+    patch_needed, patch, fingerprint_only = plan_patch(
+        object_type, ckan_object, patch_object, skip_differences, fingerprint
+    )
+    if patch is not None:
+        ckan_object = apply_patch(ckan, object_type, patch)
     logger.debug("end patch_if_required")
-    return patch_needed, ckan_object
+    return patch_needed, ckan_object, fingerprint_only
 
 
 def make_obj(ckan, obj_type, obj):
@@ -105,7 +202,7 @@ def make_obj(ckan, obj_type, obj):
         logger.info("created %s `%s'" % (obj_type, obj["name"]))
     # copy over auto-allocated ID
     obj["id"] = ckan_obj["id"]
-    was_patched, ckan_obj = patch_if_required(ckan, obj_type, ckan_obj, obj)
+    was_patched, ckan_obj, _ = patch_if_required(ckan, obj_type, ckan_obj, obj)
     if was_patched:
         logger.info("updated %s `%s'" % (obj_type, obj["name"]))
     logger.debug("end make_obj")
@@ -121,8 +218,32 @@ def make_organization(ckan, organization_obj):
 
 
 class BaseArchiveInfo:
+    """
+    archive info objects are shared between resource check threads: each
+    thread gets its own `requests.Session`, and the size cache is guarded
+    by a lock
+    """
+
     def __init__(self):
         self._size_cache = {}
+        self._cache_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def cache_get(self, cache, url):
+        with self._cache_lock:
+            return cache.get(url)
+
+    def cache_set(self, cache, urls, value):
+        with self._cache_lock:
+            for url in urls:
+                cache[url] = value
 
     def check_status_code(self, response):
         if response.status_code in (403, 401):
@@ -151,7 +272,6 @@ def same_netloc(u1, u2):
 class CKANArchiveInfo(BaseArchiveInfo):
     def __init__(self, ckan):
         self.ckan = ckan
-        self.session = requests.Session()
         self._etag_cache = {}
         super().__init__()
 
@@ -176,13 +296,14 @@ class CKANArchiveInfo(BaseArchiveInfo):
         # we have to do a range request for the first byte, as S3 doesn't let us head
         # with an authorization token. however, we can still get the full size from the
         # content-range header
-        return requests.get(url, headers={"Range": "bytes=0-0"})
+        return self.session.get(url, headers={"Range": "bytes=0-0"})
 
     def get_size_and_etag(self, url):
         if not url:
             return None
         logger.debug("start get_size_and_etag `%s' " % url)
-        if url not in self._size_cache:
+        size = self.cache_get(self._size_cache, url)
+        if size is None:
             # a URL on S3 with auth token
             resolved = self.resolve_url(url)
             if resolved is None:
@@ -191,21 +312,56 @@ class CKANArchiveInfo(BaseArchiveInfo):
             self.check_status_code(response)
             if response.status_code not in (200, 206):
                 return None
-            self._size_cache[url] = self._size_cache[
-                resolved
-            ] = self.size_from_response(response)
-            self._etag_cache[url] = self._etag_cache[resolved] = response.headers.get(
-                "etag"
+            size = self.size_from_response(response)
+            self.cache_set(
+                self._etag_cache, (url, resolved), response.headers.get("etag")
             )
+            self.cache_set(self._size_cache, (url, resolved), size)
 
         logger.debug("end get_size_and_etag `%s' " % url)
-        return self._size_cache[url], self._etag_cache[url]
+        return size, self.cache_get(self._etag_cache, url)
+
+
+class S3IndexArchiveInfo:
+    """
+    a stand-in for `CKANArchiveInfo` which answers from an index of the
+    bucket CKAN uploads resources to, built in one pass: either by listing
+    the bucket, or from an S3 Inventory report. checking a resource then needs
+    no requests at all.
+    """
+
+    # https://<ckan>/dataset/<package>/resource/<resource id>/download/<filename>
+    resource_url_re = re.compile(r"/resource/([^/]+)/download/([^/]+)$")
+
+    def __init__(self, ckan, parent_destination, inventory_path=None, client=None):
+        self.ckan = ckan
+        if inventory_path is not None:
+            self._index = read_inventory_csv(inventory_path, parent_destination)
+        else:
+            self._index = list_resource_objects(parent_destination, client=client)
+
+    def on_ckan(self, url):
+        return same_netloc(self.ckan.address, url)
+
+    def ckan_address(self):
+        return self.ckan.address
+
+    def get_size_and_etag(self, url):
+        match = self.resource_url_re.search(urlparse(url).path) if url else None
+        if match is None:
+            logger.error("not a CKAN resource download URL: %s" % (url))
+            return None, None
+        resource_id, filename = match.groups()
+        entry = self._index.get((resource_id, unquote(filename)))
+        if entry is None:
+            logger.error("resource not found in S3 index: %s" % (url))
+            return None, None
+        return entry
 
 
 class ApacheArchiveInfo(BaseArchiveInfo):
     def __init__(self, auth):
         self.auth = auth
-        self.session = requests.Session()
         super().__init__()
 
     def head(self, url):
@@ -233,14 +389,167 @@ class ApacheArchiveInfo(BaseArchiveInfo):
     def get_size(self, url):
         if not url:
             return None
-        if url not in self._size_cache:
+        size = self.cache_get(self._size_cache, url)
+        if size is None:
             resolved = self.resolve_url(url)
             if resolved is None:
                 return None
-            self._size_cache[url] = self._size_cache[
-                resolved
-            ] = self.size_from_response(self.head(resolved))
-        return self._size_cache[url]
+            size = self.size_from_response(self.head(resolved))
+            self.cache_set(self._size_cache, (url, resolved), size)
+        return size
+
+    def range_reader(self, resolved_url):
+        return http_range_reader(resolved_url, self.auth)
+
+    def download(self, resolved_url, path):
+        "download `resolved_url` to `path`, returning True on success"
+        # wget will resume downloads, which is a huge win when dealing with
+        # mirrors that sometimes close connections. ugly, but pragmatic.
+        wget_args = ["wget", "-q", "-c", "-t", "0", "-O", path]
+        if self.auth:
+            wget_args += ["--user", self.auth[0]]
+            wget_args += ["--password", self.auth[1]]
+        wget_args.append(resolved_url)
+        status = subprocess.call(wget_args)
+        if status != 0:
+            logger.error("wget failed, returned %s" % (str(status)))
+            logger.error("wget args were: %s" % (str(wget_args)))
+            return False
+        return True
+
+
+class ApacheArchiveIndex(ApacheArchiveInfo):
+    """
+    answers `resolve_url` and `get_size` from the autoindex page of each directory
+    in the legacy archive. each directory is resolved (following any symlink
+    redirects) and listed once; a file then needs no requests if the listing gives
+    its exact size, or a single HEAD if the size is rounded. anything not found in
+    a listing falls back to the per-file requests of `ApacheArchiveInfo`.
+    """
+
+    def __init__(self, auth):
+        super().__init__(auth)
+        # directory URL -> (resolved directory URL, {filename: href, exact size or None})
+        self._listings = {}
+        self._listing_locks = defaultdict(threading.Lock)
+
+    def _split(self, url):
+        directory, filename = url.rsplit("/", 1)
+        return directory + "/", unquote(filename)
+
+    def listing(self, directory):
+        with self._cache_lock:
+            lock = self._listing_locks[directory]
+        # other directories are listed concurrently; only one thread lists each
+        with lock:
+            if directory not in self._listings:
+                self._listings[directory] = self._fetch_listing(directory)
+            return self._listings[directory]
+
+    def _fetch_listing(self, directory):
+        resolved = ApacheArchiveInfo.resolve_url(self, directory)
+        if resolved is None:
+            return None, {}
+        response = self.session.get(resolved, auth=self.auth)
+        if response.status_code != 200:
+            logger.warning(
+                "no listing (status %d) for %s" % (response.status_code, resolved)
+            )
+            return resolved, {}
+        entries = dict(
+            (unquote(href), (href, size))
+            for href, size in parse_autoindex(response.content).items()
+        )
+        logger.debug("listed %d entries in %s" % (len(entries), resolved))
+        return resolved, entries
+
+    def _entry(self, url):
+        directory, filename = self._split(url)
+        resolved, entries = self.listing(directory)
+        if filename not in entries:
+            return None, None
+        href, size = entries[filename]
+        return urljoin(resolved, href), size
+
+    def resolve_url(self, url):
+        resolved, _ = self._entry(url)
+        if resolved is None:
+            return super().resolve_url(url)
+        return resolved
+
+    def get_size(self, url):
+        if not url:
+            return None
+        size = self.cache_get(self._size_cache, url)
+        if size is not None:
+            return size
+        resolved, size = self._entry(url)
+        if resolved is None:
+            return super().get_size(url)
+        if size is None:
+            response = self.head(resolved)
+            if response.status_code in (301, 302):
+                # the file itself is a symlink
+                return super().get_size(url)
+            size = self.size_from_response(response)
+        self.cache_set(self._size_cache, (url, resolved), size)
+        return size
+
+
+class LocalMirrorArchiveInfo(BaseArchiveInfo):
+    """
+    answers for the legacy archive from a filesystem mirror of it (see
+    `util.localpath`), rather than over HTTP: sizes are taken from `stat`, and
+    data read straight from disk. resolved URLs are paths in the mirror.
+    """
+
+    def __init__(self, mirror_path):
+        self.mirror_path = mirror_path
+        super().__init__()
+
+    def path(self, url):
+        return localpath(self.mirror_path, url)
+
+    def resolve_url(self, url):
+        # follows any symlinks, as the archive's redirects do
+        path = os.path.realpath(self.path(url))
+        if not os.path.isfile(path):
+            logger.error("not in the archive mirror: %s (%s)" % (url, path))
+            return None
+        return path
+
+    def get_size(self, url):
+        if not url:
+            return None
+        size = self.cache_get(self._size_cache, url)
+        if size is None:
+            try:
+                size = os.stat(self.path(url)).st_size
+            except OSError:
+                return None
+            self.cache_set(self._size_cache, (url,), size)
+        return size
+
+    def range_reader(self, resolved_path):
+        return file_range_reader(resolved_path)
+
+    def download(self, resolved_path, path):
+        "link (or, across filesystems, copy) `resolved_path` to `path`"
+        try:
+            os.link(resolved_path, path)
+        except OSError:
+            shutil.copyfile(resolved_path, path)
+        return True
+
+
+def make_archive_info(auth, mirror_path=None):
+    """
+    the archive info used to check and re-upload resources: from a filesystem
+    mirror of the archive, if `mirror_path` is given, otherwise over HTTP
+    """
+    if mirror_path is not None:
+        return LocalMirrorArchiveInfo(mirror_path)
+    return ApacheArchiveIndex(auth)
 
 
 def get_legacy_size(apache_archive_info, legacy_url):
@@ -340,14 +649,20 @@ def download_legacy_local_file(legacy_url):
     return tempdir, dest_path
 
 
-def download_legacy_file(legacy_url, auth):
+def download_legacy_file(legacy_url, auth, archive_info=None):
+    """
+    download `legacy_url` into a new temporary directory. `archive_info` (an
+    `ApacheArchiveInfo`, or `LocalMirrorArchiveInfo`) may be shared between calls, to
+    reuse what it knows of the archive
+    """
     logger.debug("start download_legacy_file `%s' " % legacy_url)
     if legacy_url and legacy_url.startswith("file:///"):
         return download_legacy_local_file(legacy_url)
     basename = legacy_url.rsplit("/", 1)[-1]
     tempdir = tempfile.mkdtemp(prefix="bpaingest-data-")
     path = os.path.join(tempdir, basename)
-    archive_info = ApacheArchiveInfo(auth)
+    if archive_info is None:
+        archive_info = ApacheArchiveInfo(auth)
 
     # resolve URL
     resolved_url = archive_info.resolve_url(legacy_url)
@@ -383,19 +698,10 @@ def download_legacy_file(legacy_url, auth):
             )
         )
 
-    # wget will resume downloads, which is a huge win when dealing with
-    # mirrors that sometimes close connections. ugly, but pragmatic.
-    wget_args = ["wget", "-q", "-c", "-t", "0", "-O", path]
-    if auth:
-        wget_args += ["--user", auth[0]]
-        wget_args += ["--password", auth[1]]
-    wget_args.append(resolved_url)
-    status = subprocess.call(wget_args)
-    if status != 0:
-        logger.error("wget failed, returned %s" % (str(status)))
-        logger.error("wget args were: %s" % (str(wget_args)))
+    if not archive_info.download(resolved_url, path):
         try:
-            os.unlink(path)
+            if os.path.exists(path):
+                os.unlink(path)
         except OSError:
             logger.error("failed to unlink temp file")
         try:
@@ -407,74 +713,84 @@ def download_legacy_file(legacy_url, auth):
     return tempdir, path
 
 
-def reupload_resource(ckan, ckan_obj, legacy_url, parent_destination, auth=None):
-    "reupload data from legacy_url to ckan_obj"
-    logger.debug("start reupload_resource `%s' " % legacy_url)
+def upload_to_s3(path, ckan_obj, parent_destination):
+    """
+    upload the file at `path` to the S3 location CKAN expects for `ckan_obj`,
+    tagged to permit lifecycle rules. returns True on success
+    """
+    logger.info("re-uploading from tempfile: %s" % (path))
+    filename = os.path.basename(path)
+    bucket, key = s3_location(parent_destination, ckan_obj["id"], filename)
+    size = os.path.getsize(path)
+    try:
+        etag = stream_file_to_s3(path, bucket, key)
+    except Exception as e:
+        logger.error("upload of %s to s3://%s/%s failed: %s" % (path, bucket, key, e))
+        return False
+    return check_uploaded_etag(ckan_obj, etag, size)
 
-    if legacy_url is None:
-        logger.error("download from legacy archive URL failed - legacy_url not set")
-        return
 
-    tempdir, path = download_legacy_file(legacy_url, auth)
-    if path is None:
-        logger.error("download from legacy archive failed")
-        return
-    try:
-        logger.info("re-uploading from tempfile: %s" % (path))
-        filename = path.split("/")[-1]
-        s3_destination = "s3://{}/resources/{}/{}".format(
-            parent_destination, ckan_obj["id"], filename
-        )
-        s3cmd_args = [
-            "aws",
-            "s3",
-            "cp",
-            path,
-            s3_destination,
-        ]
-        status = subprocess.call(s3cmd_args)
-        if status == 0:
-            # patch the object in CKAN to have full URL
-            resource_url = "{}/dataset/{}/resource/{}/download/{}".format(
-                ckan.address, ckan_obj["package_id"], ckan_obj["id"], filename
-            )
-            ckan.action.resource_patch(
-                id=ckan_obj["id"],
-                url=resource_url,
-                url_type="upload",
-                size=os.path.getsize(path),
-            )
-        else:
-            logger.error("upload failed: status {}".format(status))
+def patch_uploaded_resource(ckan, ckan_obj, filename, size):
+    "patch the object in CKAN to have the full URL of the uploaded data"
+    resource_url = "{}/dataset/{}/resource/{}/download/{}".format(
+        ckan.address, ckan_obj["package_id"], ckan_obj["id"], filename
+    )
+    return ckan_method(ckan, "resource", "patch")(
+        id=ckan_obj["id"],
+        url=resource_url,
+        url_type="upload",
+        size=size,
+    )
 
-        # tag resource in S3 to permit lifecycle rules
-        logger.info("tagging resource : %s" % (s3_destination))
-        bucket = parent_destination.split("/")[0]
-        key = "{}/resources/{}/{}".format(
-            parent_destination.split("/", 1)[1], ckan_obj["id"], filename
-        )
 
-        tagging = '{"TagSet": [{ "Key": "source", "Value": "bpaingest" }]}'
-
-        s3cmd_args = [
-            "aws",
-            "s3api",
-            "put-object-tagging",
-            "--bucket",
-            bucket,
-            "--key",
-            key,
-            "--tagging",
-            tagging,
-        ]
-        status = subprocess.call(s3cmd_args)
-        if status != 0:
-            logger.error("tagging failed: status {}".format(status))
+def remove_legacy_download(tempdir, path):
+    os.unlink(path)
+    os.rmdir(tempdir)
 
-    finally:
-        os.unlink(path)
-        os.rmdir(tempdir)
-        logger.debug("end reupload_resource `%s' " % legacy_url)
+
+def stream_legacy_file_to_s3(
+    legacy_url, ckan_obj, parent_destination, auth=None, archive_info=None
+):
+    """
+    copy the data at `legacy_url` straight into S3 for `ckan_obj`, without
+    a local temporary copy. returns (filename, size), or (None, None) on failure
+    """
+    logger.debug("start stream_legacy_file_to_s3 `%s' " % legacy_url)
+    if legacy_url is None:
+        logger.error("stream from legacy archive URL failed - legacy_url not set")
+        return None, None
+    if legacy_url.startswith("file:///"):
+        file_path = url2pathname(urlparse(legacy_url).path)
+        if not os.access(file_path, os.R_OK):
+            logger.warning("File '%s' doesn't exist or isn't readable" % (file_path,))
+            return None, None
+        size = os.path.getsize(file_path)
+        read_range = file_range_reader(file_path)
+    else:
+        if archive_info is None:
+            archive_info = ApacheArchiveInfo(auth)
+        resolved_url = archive_info.resolve_url(legacy_url)
+        if not resolved_url:
+            logger.error("unable to resolve `%s' - file missing?" % (legacy_url))
+            return None, None
+        size = archive_info.get_size(legacy_url)
+        if size is None:
+            logger.error("unable to retrieve file size for `%s' " % (legacy_url))
+            return None, None
+        read_range = archive_info.range_reader(resolved_url)
+
+    filename = legacy_url.rsplit("/", 1)[-1]
+    bucket, key = s3_location(parent_destination, ckan_obj["id"], filename)
+    logger.info("streaming `%s' to s3://%s/%s" % (legacy_url, bucket, key))
+    try:
+        etag = stream_to_s3(read_range, size, bucket, key)
+    except Exception as e:
+        logger.error("streaming upload of `%s' failed: %s" % (legacy_url, e))
+        return None, None
+    if not check_uploaded_etag(ckan_obj, etag, size):
+        return None, None
+    logger.debug("end stream_legacy_file_to_s3 `%s' " % legacy_url)
+    return filename, size
 
 
 def create_resource(ckan, ckan_obj):
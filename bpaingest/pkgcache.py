@@ -1,32 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from .util import make_logger
 from .ops import ckan_method
 
 
 logger = make_logger(__name__)
 
+# CKAN caps package_search at `ckan.search.rows_max` rows (1000 by default)
+SEARCH_PAGE_SIZE = 1000
+SEARCH_THREADS = 4
+
 
-def build_package_cache(ckan, ckan_data_type, sync_packages):
+def iter_package_search(
+    ckan, page_size=SEARCH_PAGE_SIZE, num_threads=SEARCH_THREADS, **search_kwargs
+):
     """
-    build a cache of all the packages in `org`, to speed up comparison.
-    `sync_packages` is the packages we are aiming to set as our target
-    state
+    page through the results of a package_search, yielding one page of results
+    at a time. the first page gives the total count; the rest are fetched
+    concurrently, with at most `num_threads` pages in memory at once, and
+    yielded in order. results are sorted by id so the pages are stable.
     """
+    search = ckan_method(ckan, "package", "search")
+    search_kwargs.setdefault("sort", "id asc")
+
+    def fetch(start):
+        return search(start=start, rows=page_size, **search_kwargs)["results"]
+
+    first = search(start=0, rows=page_size, **search_kwargs)
+    yield first["results"]
+    starts = list(range(page_size, first["count"], page_size))
+    if not starts:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        window = []
+        for start in starts:
+            window.append(executor.submit(fetch, start))
+            if len(window) == num_threads:
+                yield window.pop(0).result()
+        for future in window:
+            yield future.result()
+
+
+def iter_packages(ckan, ckan_data_type, sync_packages, state_cache=None):
     package_types = set(t["type"] for t in sync_packages)
     package_types.add(ckan_data_type)
-    packages = []
     for typ in package_types:
+        if state_cache is not None:
+            state_cache.refresh(ckan, typ)
+            yield from state_cache.packages_of_type(typ)
+            continue
         logger.info("Retrieving all extant packages of type: {}".format(typ))
-        results = ckan_method(ckan, "package", "search")(
-            q="type:{}".format(typ), include_private=True, rows=50000
-        )
-        packages += results["results"]
-    logger.info("{} packages cached.".format(len(packages)))
-    return {t["id"]: t for t in packages}
+        for page in iter_package_search(
+            ckan, q="type:{}".format(typ), include_private=True
+        ):
+            yield from page
 
 
-def build_resource_cache(*args):
+def build_package_cache(ckan, ckan_data_type, sync_packages, state_cache=None):
+    """
+    build a cache of all the packages in `org`, to speed up comparison.
+    `sync_packages` is the packages we are aiming to set as our target
+    state. if `state_cache` (a `CKANStateCache`) is given, it is refreshed
+    and the packages are read from it.
+    """
+    cache = {}
+    for package in iter_packages(ckan, ckan_data_type, sync_packages, state_cache):
+        cache[package["id"]] = package
+    logger.info("{} packages cached.".format(len(cache)))
+    return cache
+
+
+def index_resources(packages):
+    "resource ID -> resource, for the resources of `packages`"
     cache = {}
-    for pkg in build_package_cache(*args).values():
-        for resource in pkg["resources"]:
+    for pkg in packages:
+        for resource in pkg.get("resources", []):
             cache[resource["id"]] = resource
     return cache
+
+
+def build_resource_cache(*args):
+    return index_resources(iter_packages(*args))
@@ -0,0 +1,367 @@
+import json
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .ops import (
+    FINGERPRINT_FIELD,
+    apply_patch,
+    ckan_method,
+    create_resource,
+    get_organization,
+    make_archive_info,
+    object_fingerprint,
+    plan_patch,
+)
+from .pkgcache import build_package_cache, index_resources
+from .sync import (
+    check_package_resources,
+    dangling_packages,
+    find_shared_resources,
+    link_resources,
+    make_ckan_archive_info,
+    package_compare_obj,
+    package_targets,
+    prepare_metadata,
+    reupload_resources,
+    sync_package,
+)
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+PLAN_VERSION = 1
+
+
+class PlanException(Exception):
+    pass
+
+
+class Plan:
+    """
+    a serialisable set of changes to make to CKAN. each action has an `id`, the
+    `action` to take, the `object` to send, and the IDs of the actions it
+    `depends` upon.
+    """
+
+    def __init__(self, ckan_address, project_name, actions=None, shared_resources=None):
+        self.ckan_address = ckan_address
+        self.project_name = project_name
+        self.actions = actions or []
+        self.shared_resources = shared_resources or {}
+
+    def add(self, action, obj, depends=(), **extra):
+        action_id = len(self.actions)
+        self.actions.append(
+            dict(
+                id=action_id, action=action, object=obj, depends=list(depends), **extra
+            )
+        )
+        return action_id
+
+    def summary(self):
+        return Counter(t["action"] for t in self.actions)
+
+    def write(self, path):
+        with open(path, "w") as fd:
+            json.dump(
+                {
+                    "version": PLAN_VERSION,
+                    "ckan_address": self.ckan_address,
+                    "project_name": self.project_name,
+                    "actions": self.actions,
+                    "shared_resources": self.shared_resources,
+                },
+                fd,
+                indent=2,
+                sort_keys=True,
+            )
+
+    @classmethod
+    def read(cls, path):
+        with open(path) as fd:
+            data = json.load(fd)
+        if data.get("version") != PLAN_VERSION:
+            raise PlanException(
+                "plan %s has version %s, expected %s"
+                % (path, data.get("version"), PLAN_VERSION)
+            )
+        return cls(
+            data["ckan_address"],
+            data["project_name"],
+            data["actions"],
+            data["shared_resources"],
+        )
+
+
+def plan_package_resources(
+    plan, package_obj, cached_obj, depends, resources, legacy_urls, do_delete
+):
+    """
+    plan the resource changes for one package. CKAN rewrites the whole package when a
+    resource is created, patched or deleted, so the changes to a package's resources
+    are chained one after the other; different packages proceed in parallel.
+    """
+    existing_resources = dict(
+        (t["id"], t) for t in (cached_obj or {}).get("resources", [])
+    )
+    needed_resources = dict((t["id"], t) for t in resources)
+    if len(needed_resources) != len(resources):
+        raise Exception(
+            "duplicate resource IDs in package {}".format(package_obj["id"])
+        )
+
+    for obj_id in sorted(set(needed_resources) - set(existing_resources)):
+        resource_obj = needed_resources[obj_id]
+        legacy_url = legacy_urls[obj_id]
+        # as with sync, resources are created pointing at the legacy archive, and
+        # the data is uploaded once all the metadata is in place
+        create_obj = resource_obj.copy()
+        create_obj["url"] = legacy_url
+        create_obj[FINGERPRINT_FIELD] = object_fingerprint(resource_obj)
+        create_id = plan.add("resource_create", create_obj, depends)
+        plan.add("reupload", create_obj, [create_id], legacy_url=legacy_url)
+        depends = [create_id]
+
+    for obj_id in sorted(set(existing_resources) - set(needed_resources)):
+        delete_obj = existing_resources[obj_id]
+        logger.info(
+            "resource for deletion: %s/%s (do_delete=%s)"
+            % (delete_obj["package_id"], obj_id, do_delete)
+        )
+        if do_delete:
+            depends = [
+                plan.add(
+                    "resource_delete",
+                    {"id": obj_id, "package_id": delete_obj["package_id"]},
+                    depends,
+                )
+            ]
+
+    for obj_id in sorted(set(existing_resources) & set(needed_resources)):
+        _, patch, _ = plan_patch(
+            "resource",
+            existing_resources[obj_id],
+            needed_resources[obj_id],
+            fingerprint=True,
+        )
+        if patch is not None:
+            depends = [plan.add("resource_patch", patch, depends)]
+
+
+def make_plan(
+    ckan,
+    meta,
+    auth,
+    project_name,
+    do_resource_checks,
+    do_delete,
+    do_single_ticket,
+    **kwargs
+):
+    """
+    work out everything that `sync_metadata` would change in CKAN, without changing
+    anything. the plan can be reviewed, and then run with `apply_plan`.
+    """
+    organization = get_organization(ckan, meta.organization)
+    packages, resources = prepare_metadata(ckan, meta, auth, do_single_ticket)
+    targets = package_targets(packages, organization, None, do_single_ticket)
+    cache = build_package_cache(
+        ckan, meta.ckan_data_type, packages, kwargs.get("state_cache")
+    )
+    plan = Plan(ckan.address, project_name)
+
+    if do_single_ticket is None:
+        for delete_id in dangling_packages(packages, cache):
+            logger.info(
+                "package for deletion: %s (do_delete=%s)" % (delete_id, do_delete)
+            )
+            if do_delete:
+                plan.add("package_delete", {"id": delete_id})
+
+    package_action = {}
+    for obj in targets:
+        cached_obj = cache.get(obj["id"])
+        if cached_obj is None:
+            package_action[obj["id"]] = plan.add("package_create", obj)
+            continue
+        patch_obj = obj.copy()
+        patch_obj["id"] = cached_obj["id"]
+        _, patch, _ = plan_patch(
+            "package", package_compare_obj(cached_obj), patch_obj, fingerprint=True
+        )
+        if patch is not None:
+            package_action[obj["id"]] = plan.add("package_patch", patch)
+
+    resource_idx, resource_id_legacy_url = link_resources(
+        resources, meta.resource_linkage, targets, do_single_ticket
+    )
+    for obj in targets:
+        package_resources = resource_idx.get(obj["id"])
+        if package_resources is None:
+            logger.warning("No resources for package `%s`" % (obj["id"]))
+            continue
+        depends = [package_action[obj["id"]]] if obj["id"] in package_action else []
+        plan_package_resources(
+            plan,
+            obj,
+            cache.get(obj["id"]),
+            depends,
+            package_resources,
+            resource_id_legacy_url,
+            do_delete,
+        )
+
+    if do_resource_checks:
+        for reupload_obj, legacy_url in check_package_resources(
+            ckan,
+            [cache[t["id"]] for t in targets if t["id"] in cache],
+            resource_id_legacy_url,
+            auth,
+            kwargs.get("check_threads") or 8,
+            kwargs.get("verifier"),
+            make_ckan_archive_info(
+                ckan, kwargs.get("s3_index"), kwargs.get("s3_inventory")
+            ),
+            make_archive_info(auth, kwargs.get("archive_mirror")),
+        ):
+            plan.add("reupload", reupload_obj, legacy_url=legacy_url)
+    else:
+        logger.warning(
+            "resource checks disabled: resource integrity will not be confirmed"
+        )
+
+    # the same lookup as sync, but answered only from the package cache
+    plan.shared_resources = find_shared_resources(
+        ckan,
+        resource_idx,
+        resource_cache=index_resources(cache.values()),
+        lookup_missing=False,
+    )
+    for action, count in sorted(plan.summary().items()):
+        logger.info("planned %d %s" % (count, action))
+    return plan
+
+
+def execute_action(ckan, action):
+    obj = action["object"]
+    kind = action["action"]
+    if kind == "package_create":
+        return sync_package(ckan, obj, None)
+    if kind in ("package_patch", "resource_patch"):
+        return apply_patch(ckan, kind.split("_")[0], obj)
+    if kind == "package_delete":
+        return ckan_method(ckan, "package", "delete")(id=obj["id"])
+    if kind == "resource_create":
+        return create_resource(ckan, obj)
+    if kind == "resource_delete":
+        return ckan_method(ckan, "resource", "delete")(id=obj["id"])
+    raise PlanException("unknown plan action: %s" % (kind))
+
+
+def run_actions(actions, execute, num_threads):
+    """
+    run `execute(action)` for each of `actions`, with up to `num_threads` at once.
+    an action is started once every action it depends upon has succeeded; if any
+    of them fails, it is skipped. returns ({action id: result}, set of failed or
+    skipped action ids)
+    """
+    by_id = dict((t["id"], t) for t in actions)
+    dependents = defaultdict(list)
+    waiting = {}
+    for action in actions:
+        depends = [t for t in action["depends"] if t in by_id]
+        waiting[action["id"]] = len(depends)
+        for depend_id in depends:
+            dependents[depend_id].append(action["id"])
+
+    results = {}
+    failed = set()
+
+    def skip(action_id):
+        # a package's resource changes are chained, so chains can be long:
+        # walked with a worklist, rather than recursively
+        to_skip = deque([action_id])
+        while to_skip:
+            for dependent_id in dependents[to_skip.popleft()]:
+                if dependent_id not in failed:
+                    logger.warning(
+                        "skipping %s %s: a prior action failed"
+                        % (by_id[dependent_id]["action"], dependent_id)
+                    )
+                    failed.add(dependent_id)
+                    to_skip.append(dependent_id)
+
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        running = {}
+
+        def submit(action_id):
+            running[executor.submit(execute, by_id[action_id])] = action_id
+
+        for action in actions:
+            if waiting[action["id"]] == 0:
+                submit(action["id"])
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                action_id = running.pop(future)
+                try:
+                    results[action_id] = future.result()
+                except Exception as e:
+                    logger.error(
+                        "%s %s failed: %s" % (by_id[action_id]["action"], action_id, e)
+                    )
+                    failed.add(action_id)
+                    skip(action_id)
+                    continue
+                for dependent_id in dependents[action_id]:
+                    waiting[dependent_id] -= 1
+                    if waiting[dependent_id] == 0 and dependent_id not in failed:
+                        submit(dependent_id)
+    return results, failed
+
+
+def apply_plan(ckan, plan, auth, num_threads, do_uploads, **kwargs):
+    """
+    make the changes in `plan`. the CKAN changes are made in parallel, in
+    dependency order; re-uploads follow, through the re-upload pipeline.
+    returns the re-uploads which could not be completed.
+    """
+    if plan.ckan_address != ckan.address:
+        raise PlanException(
+            "plan was made against %s, not %s" % (plan.ckan_address, ckan.address)
+        )
+    ckan_actions = [t for t in plan.actions if t["action"] != "reupload"]
+    logger.info(
+        "applying %d CKAN changes (%d threads)" % (len(ckan_actions), num_threads)
+    )
+    results, failed = run_actions(
+        ckan_actions, lambda action: execute_action(ckan, action), num_threads
+    )
+    logger.info("%d changes applied, %d failed" % (len(results), len(failed)))
+
+    to_reupload = []
+    for action in plan.actions:
+        if action["action"] != "reupload":
+            continue
+        if any(t not in results for t in action["depends"]):
+            continue
+        reupload_obj = action["object"]
+        # a newly created resource is re-uploaded using the object CKAN handed back
+        for depend_id in action["depends"]:
+            if results[depend_id]:
+                reupload_obj = results[depend_id]
+        to_reupload.append((reupload_obj, action["legacy_url"]))
+
+    if not do_uploads:
+        return to_reupload
+    return reupload_resources(
+        ckan,
+        to_reupload,
+        plan.shared_resources,
+        auth,
+        download_threads=kwargs.get("download_threads") or 2,
+        upload_threads=kwargs.get("upload_threads") or 4,
+        patch_threads=kwargs.get("patch_threads") or 1,
+        streaming=kwargs.get("stream_reuploads", False),
+        archive_info=make_archive_info(auth, kwargs.get("archive_mirror")),
+    )
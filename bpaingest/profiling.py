@@ -0,0 +1,187 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+CAPTURE_MODES = ("cprofile", "sample")
+
+
+def collapse_stack(frame):
+    "a frame's stack, outermost call first, in the folded format of flamegraph.pl"
+    calls = []
+    while frame is not None:
+        code = frame.f_code
+        calls.append(
+            "%s (%s:%d)"
+            % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+        )
+        frame = frame.f_back
+    return ";".join(reversed(calls))
+
+
+class PhaseProfiler:
+    """
+    wall and CPU time spent in each phase of a run, with (optionally) a profile
+    of each phase written to `output_path`:
+
+      cprofile: a cProfile of the thread which entered the phase, as
+                `<phase>.prof`. only one profile can run at a time: a phase
+                nested within a profiled phase (in the same thread) pauses
+                the enclosing profile until it ends, so each profile holds
+                only the time not spent in nested phases. phases entered by
+                other threads meanwhile are timed, but not profiled.
+      sample:   the stacks of every thread, sampled each `interval` seconds
+                while the phase is running, as `<phase>.folded`
+
+    CPU time is that of the whole process, so includes the work of any
+    threads a phase starts, and of other phases running alongside it.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.capture = None
+        self.output_path = None
+        self.interval = 0.005
+        self._lock = threading.Lock()
+        # phase -> [count, wall seconds, cpu seconds]
+        self.timings = defaultdict(lambda: [0, 0.0, 0.0])
+        self._active = defaultdict(int)
+        self._profiles = {}
+        # the profiles of the nested phases being profiled, innermost last
+        self._profile_stack = []
+        self._profile_thread = None
+        self._samples = defaultdict(lambda: defaultdict(int))
+        self._sampler = None
+        self._stop = threading.Event()
+
+    def configure(self, capture=None, output_path=None, interval=0.005):
+        if capture is not None and capture not in CAPTURE_MODES:
+            raise ValueError("unknown profile capture mode: %s" % (capture))
+        self.enabled = True
+        self.capture = capture
+        self.output_path = output_path
+        self.interval = interval
+        if capture == "sample":
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+
+    def phase(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name):
+        profile = outer = None
+        with self._lock:
+            self._active[name] += 1
+            if self.capture == "cprofile" and (
+                not self._profile_stack or self._profile_thread == threading.get_ident()
+            ):
+                profile = self._profiles.setdefault(name, cProfile.Profile())
+                if profile in self._profile_stack:
+                    # a phase nested within itself is already being profiled
+                    profile = None
+                else:
+                    if self._profile_stack:
+                        outer = self._profile_stack[-1]
+                    self._profile_stack.append(profile)
+                    self._profile_thread = threading.get_ident()
+        wall, cpu = time.perf_counter(), time.process_time()
+        if outer is not None:
+            outer.disable()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                if outer is not None:
+                    outer.enable()
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            with self._lock:
+                self._active[name] -= 1
+                if profile is not None:
+                    self._profile_stack.pop()
+                timing = self.timings[name]
+                timing[0] += 1
+                timing[1] += wall
+                timing[2] += cpu
+
+    def _sample(self):
+        ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                active = [name for name, count in self._active.items() if count]
+            if not active:
+                continue
+            stacks = [
+                collapse_stack(frame)
+                for thread_ident, frame in sys._current_frames().items()
+                if thread_ident != ident
+            ]
+            with self._lock:
+                for name in active:
+                    samples = self._samples[name]
+                    for stack in stacks:
+                        samples[stack] += 1
+
+    def report(self):
+        lines = ["%-24s %6s %10s %10s" % ("phase", "count", "wall (s)", "cpu (s)")]
+        with self._lock:
+            for name, (count, wall, cpu) in sorted(
+                self.timings.items(), key=lambda t: -t[1][1]
+            ):
+                lines.append("%-24s %6d %10.3f %10.3f" % (name, count, wall, cpu))
+        return "\n".join(lines)
+
+    def finish(self):
+        "stop sampling, and write out the timings and profiles"
+        if not self.enabled:
+            return
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+        print(self.report())
+        if self.output_path is None:
+            return
+        os.makedirs(self.output_path, exist_ok=True)
+        with open(os.path.join(self.output_path, "phases.json"), "w") as fd:
+            json.dump(
+                dict(
+                    (name, {"count": count, "wall": wall, "cpu": cpu})
+                    for name, (count, wall, cpu) in self.timings.items()
+                ),
+                fd,
+                indent=2,
+                sort_keys=True,
+            )
+        for name, profile in self._profiles.items():
+            profile.dump_stats(os.path.join(self.output_path, name + ".prof"))
+        for name, samples in self._samples.items():
+            with open(os.path.join(self.output_path, name + ".folded"), "w") as fd:
+                for stack, count in sorted(samples.items()):
+                    fd.write("%s %d\n" % (stack, count))
+        logger.info("profile written to: %s" % (self.output_path))
+
+
+profiler = PhaseProfiler()
+
+
+def phase(name):
+    """
+    time the enclosed block as phase `name`, if profiling is on:
+
+        with phase("package-sync"):
+            ...
+    """
+    return profiler.phase(name)
@@ -1,4 +1,4 @@
-from ...tracking import GoogleDriveTrackMetadata, get_track_csv
+from ...tracking import GoogleDriveTrackMetadata, get_track_csv, track_registry
 from ...util import make_logger, csv_to_named_tuple
 from ...libs import ingest_utils
 
@@ -14,7 +14,9 @@ class MarineMicrobesTrackMetadata:
     def __init__(self, logger, name):
         self._logger = logger
         fname = get_track_csv("bpam", "*" + name + "*.csv", project="marine-microbes")
-        self.track_meta = self.read_track_csv(fname)
+        self.track_meta = track_registry.get(
+            (type(self), fname), lambda: self.read_track_csv(fname)
+        )
 
     def read_track_csv(self, fname):
         header, rows = csv_to_named_tuple("MarineMicrobesTrack", fname)
@@ -0,0 +1,289 @@
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from .metrics import metrics
+from .ops import (
+    ApacheArchiveIndex,
+    ckan_method,
+    download_legacy_file,
+    upload_to_s3,
+    patch_uploaded_resource,
+    remove_legacy_download,
+    stream_legacy_file_to_s3,
+)
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+
+def shared_linkage(resource_obj):
+    "shared resources are unique by md5 and filename, so use that as a key"
+    if resource_obj.get("shared_file"):
+        return resource_obj["md5"] + "/" + resource_obj["name"]
+    return None
+
+
+class ReuploadPipeline:
+    """
+    re-upload resources in three overlapping stages: download from the legacy
+    archive, upload to S3, and patch the resource in CKAN. each stage has its
+    own thread pool, and at most `download_threads + upload_threads` downloaded
+    files are held on local disk at any one time.
+
+    resources flagged `shared_file` are uploaded once per md5/name key: the
+    first resource seen for a key uploads the data, and any others with the
+    same key wait for it and are then pointed at the uploaded copy. if that
+    upload fails, the next resource waiting on the key takes over.
+
+    with `streaming` set, the download stage is skipped: the upload workers
+    copy each file from the legacy archive straight into S3.
+
+    `on_result(resource, legacy_url, success)` is called as each resource
+    finishes; `on_progress(pipeline, success, remaining_count)` after it.
+    `archive_info` answers for the legacy archive, by default an
+    `ApacheArchiveIndex`.
+    """
+
+    def __init__(
+        self,
+        ckan,
+        destination,
+        auth,
+        shared_resources,
+        download_threads=2,
+        upload_threads=4,
+        patch_threads=1,
+        on_progress=None,
+        streaming=False,
+        on_result=None,
+        archive_info=None,
+    ):
+        self.ckan = ckan
+        self.destination = destination
+        self.auth = auth
+        self.shared_resources = shared_resources
+        self.download_threads = max(1, download_threads)
+        self.upload_threads = max(1, upload_threads)
+        self.patch_threads = max(1, patch_threads)
+        self.on_progress = on_progress
+        self.on_result = on_result
+        self.streaming = streaming
+        # shared by all the transfers, so each archive directory is listed once
+        self.archive_info = archive_info or ApacheArchiveIndex(auth)
+        self._staged = threading.BoundedSemaphore(
+            self.download_threads + self.upload_threads
+        )
+        # index into the reupload list -> (resource, legacy_url), removed on success
+        self._pending = {}
+        self._total = 0
+        self._finished = 0
+        self._finished_cond = threading.Condition()
+        self._key_locks = defaultdict(threading.Lock)
+        self._key_locks_lock = threading.Lock()
+        self._key_in_flight = set()
+        self._key_waiting = defaultdict(list)
+
+    @property
+    def total(self):
+        "the number of resources in the current run"
+        return self._total
+
+    def remaining(self):
+        "resources which have not (yet) been successfully re-uploaded"
+        with self._finished_cond:
+            return [self._pending[t] for t in sorted(self._pending)]
+
+    def run(self, to_reupload):
+        self._pending = dict(enumerate(to_reupload))
+        self._total = len(to_reupload)
+        self._finished = 0
+        with ThreadPoolExecutor(
+            max_workers=self.download_threads, thread_name_prefix="download"
+        ) as self._download_pool, ThreadPoolExecutor(
+            max_workers=self.upload_threads, thread_name_prefix="upload"
+        ) as self._upload_pool, ThreadPoolExecutor(
+            max_workers=self.patch_threads, thread_name_prefix="patch"
+        ) as self._patch_pool:
+            for idx in range(self._total):
+                self._dispatch(idx)
+            with self._finished_cond:
+                self._finished_cond.wait_for(lambda: self._finished == self._total)
+        return self.remaining()
+
+    def _key_lock(self, key):
+        with self._key_locks_lock:
+            return self._key_locks[key]
+
+    def _dispatch(self, idx):
+        reupload_obj, legacy_url = self._pending[idx]
+        key = shared_linkage(reupload_obj)
+        if key is None:
+            self._start(idx)
+            return
+        if key not in self.shared_resources:
+            logger.error(
+                "No shared resource on file for {}, resource {},  not uploading".format(
+                    key, reupload_obj
+                )
+            )
+            self._done(idx, False)
+            return
+        start = False
+        with self._key_lock(key):
+            uploaded = self.shared_resources[key][0].get("uploaded_resource")
+            if uploaded is not None and "size" in uploaded:
+                self._patch_pool.submit(self._link_shared, idx, uploaded)
+            elif key in self._key_in_flight:
+                self._key_waiting[key].append(idx)
+            else:
+                self._key_in_flight.add(key)
+                start = True
+        # don't wait for a download permit while holding the key lock
+        if start:
+            self._start(idx)
+
+    def _start(self, idx, acquire=True):
+        # the permit is released once the downloaded file has been removed.
+        # resources taking over a failed shared upload are started from a
+        # worker thread, and must not block on a permit.
+        if self.streaming:
+            self._upload_pool.submit(self._stream, idx)
+            return
+        if acquire:
+            self._staged.acquire()
+        self._download_pool.submit(self._download, idx, acquire)
+
+    def _release(self, permit):
+        if permit:
+            self._staged.release()
+
+    def _download(self, idx, permit):
+        reupload_obj, legacy_url = self._pending[idx]
+        try:
+            if legacy_url is None:
+                logger.error(
+                    "download from legacy archive URL failed - legacy_url not set"
+                )
+                tempdir, path = None, None
+            else:
+                tempdir, path = download_legacy_file(
+                    legacy_url, self.auth, archive_info=self.archive_info
+                )
+        except Exception as e:
+            logger.error(e)
+            tempdir, path = None, None
+        if path is None:
+            logger.error("download from legacy archive failed: %s" % (legacy_url))
+            self._release(permit)
+            self._failed(idx)
+            return
+        metrics.add_transfer("downloaded", os.path.getsize(path))
+        self._upload_pool.submit(self._upload, idx, permit, tempdir, path)
+
+    def _upload(self, idx, permit, tempdir, path):
+        reupload_obj, legacy_url = self._pending[idx]
+        uploaded = False
+        try:
+            filename = os.path.basename(path)
+            size = os.path.getsize(path)
+            uploaded = upload_to_s3(path, reupload_obj, self.destination)
+        except Exception as e:
+            logger.error(e)
+        finally:
+            try:
+                remove_legacy_download(tempdir, path)
+            except OSError:
+                logger.error("failed to remove temporary download: %s" % (path))
+            self._release(permit)
+        if not uploaded:
+            self._failed(idx)
+            return
+        metrics.add_transfer("uploaded", size)
+        self._patch_pool.submit(self._patch, idx, filename, size)
+
+    def _stream(self, idx):
+        reupload_obj, legacy_url = self._pending[idx]
+        try:
+            filename, size = stream_legacy_file_to_s3(
+                legacy_url,
+                reupload_obj,
+                self.destination,
+                self.auth,
+                archive_info=self.archive_info,
+            )
+        except Exception as e:
+            logger.error(e)
+            filename, size = None, None
+        if filename is None:
+            self._failed(idx)
+            return
+        # streamed through this process, without touching the disk
+        metrics.add_transfer("downloaded", size)
+        metrics.add_transfer("uploaded", size)
+        self._patch_pool.submit(self._patch, idx, filename, size)
+
+    def _patch(self, idx, filename, size):
+        reupload_obj, legacy_url = self._pending[idx]
+        try:
+            ckan_obj = patch_uploaded_resource(self.ckan, reupload_obj, filename, size)
+        except Exception as e:
+            logger.error(e)
+            self._failed(idx)
+            return
+        logger.info(
+            f"Resource successfully uploaded. Removed {reupload_obj} at {legacy_url} from reupload list..."
+        )
+        key = shared_linkage(reupload_obj)
+        if key is not None:
+            with self._key_lock(key):
+                self.shared_resources[key][0] = {"uploaded_resource": ckan_obj}
+                self._key_in_flight.discard(key)
+                waiting = self._key_waiting.pop(key, [])
+            for waiting_idx in waiting:
+                self._patch_pool.submit(self._link_shared, waiting_idx, ckan_obj)
+        self._done(idx, True)
+
+    def _link_shared(self, idx, uploaded):
+        # just update the resource with the metadata from the matching shared_resource.
+        reupload_obj, legacy_url = self._pending[idx]
+        try:
+            reupload_obj["url"] = uploaded["url"]
+            reupload_obj["size"] = uploaded["size"]
+            reupload_obj["url_type"] = ""  # explicitly NOT upload
+            ckan_method(self.ckan, "resource", "update")(**reupload_obj)
+        except Exception as e:
+            logger.error(e)
+            self._done(idx, False)
+            return
+        logger.info(
+            f"Shared resource not re-uploaded. Removed {reupload_obj} at {legacy_url} from reupload list..."
+        )
+        self._done(idx, True)
+
+    def _failed(self, idx):
+        logger.info("Resource failed to upload. Continuing...")
+        reupload_obj, legacy_url = self._pending[idx]
+        key = shared_linkage(reupload_obj)
+        if key is not None:
+            with self._key_lock(key):
+                waiting = self._key_waiting.get(key)
+                if waiting:
+                    self._start(waiting.pop(0), acquire=False)
+                else:
+                    self._key_in_flight.discard(key)
+        self._done(idx, False)
+
+    def _done(self, idx, success):
+        if self.on_result is not None:
+            reupload_obj, legacy_url = self._pending[idx]
+            self.on_result(reupload_obj, legacy_url, success)
+        with self._finished_cond:
+            if success:
+                del self._pending[idx]
+            self._finished += 1
+            remaining_count = len(self._pending)
+            self._finished_cond.notify_all()
+        if self.on_progress is not None:
+            self.on_progress(self, success, remaining_count)
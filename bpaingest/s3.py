@@ -0,0 +1,390 @@
+import csv
+import gzip
+import os
+import threading
+import time
+from binascii import unhexlify
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from urllib.parse import unquote_plus
+
+import boto3
+import botocore.config
+import botocore.exceptions
+import requests
+
+from .libs.multihash import S3_CHUNK_SIZES, make_multipart
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+# S3 will not accept more than this many parts in a multipart upload
+S3_MAX_PARTS = 10000
+S3_TAGGING = "source=bpaingest"
+PART_RETRY = 5
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class S3TransferException(Exception):
+    pass
+
+
+def get_s3_client():
+    """
+    returns a boto3 S3 client shared by all uploads; boto3 clients are thread-safe,
+    and sharing one lets concurrent uploads use the same connection pool
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = boto3.client(
+                "s3",
+                config=botocore.config.Config(
+                    max_pool_connections=50,
+                    retries={"max_attempts": 5, "mode": "adaptive"},
+                ),
+            )
+        return _client
+
+
+def choose_part_size(size):
+    """
+    the smallest of `S3_CHUNK_SIZES` which fits an object of `size` bytes within
+    the S3 part limit, so the resulting ETag matches one of the precomputed
+    `s3etag_<chunk>` fields
+    """
+    for part_size in S3_CHUNK_SIZES:
+        if size <= part_size * S3_MAX_PARTS:
+            return part_size
+    raise S3TransferException("object too large for multipart upload: %d" % (size))
+
+
+def check_uploaded_etag(resource, etag, size):
+    """
+    uploads are cut into parts of `choose_part_size(size)`, so the ETag S3 hands
+    back should equal the precomputed `s3etag_<part size>` field on the resource.
+    returns False only if the metadata has an ETag, and it doesn't match.
+    """
+    field = "s3etag_%d" % (choose_part_size(size))
+    expected = resource.get(field)
+    if not expected:
+        logger.warning(
+            "resource %s has no %s: run genhash for this project."
+            % (resource.get("id"), field)
+        )
+        return True
+    if etag.strip('"') != expected:
+        logger.error(
+            "resource %s uploaded with ETag %s, but %s is %s"
+            % (resource.get("id"), etag, field, expected)
+        )
+        return False
+    return True
+
+
+def s3_location(parent_destination, resource_id, filename):
+    "returns (bucket, key) of the S3 object CKAN serves for a resource"
+    bucket, prefix = parent_destination.split("/", 1)
+    return bucket, "{}/resources/{}/{}".format(prefix, resource_id, filename)
+
+
+def file_range_reader(path):
+    def read(start, length):
+        with open(path, "rb") as fd:
+            fd.seek(start)
+            return fd.read(length)
+
+    return read
+
+
+def http_range_reader(url, auth):
+    "returns a function reading byte ranges of `url`; one session per thread"
+    local = threading.local()
+
+    def read(start, length):
+        # an empty range can't be requested; the bytes=0--1 it would give is invalid
+        if length == 0:
+            return b""
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        headers = {
+            "Range": "bytes={}-{}".format(start, start + length - 1),
+            "Accept-Encoding": None,
+        }
+        response = session.get(url, auth=auth, headers=headers)
+        if response.status_code != 206:
+            raise S3TransferException(
+                "status code {} for range request: {}".format(response.status_code, url)
+            )
+        return response.content
+
+    return read
+
+
+def find_resumable_upload(client, bucket, key, part_size):
+    """
+    look for an incomplete multipart upload of `key` made with `part_size` parts,
+    returning (upload_id, {part_number: etag}) or (None, {})
+    """
+    response = client.list_multipart_uploads(Bucket=bucket, Prefix=key)
+    for upload in response.get("Uploads", []):
+        if upload["Key"] != key:
+            continue
+        parts = {}
+        paginator = client.get_paginator("list_parts")
+        for page in paginator.paginate(
+            Bucket=bucket, Key=key, UploadId=upload["UploadId"]
+        ):
+            for part in page.get("Parts", []):
+                parts[part["PartNumber"]] = part
+        # only resume if the uploaded parts were cut at the same size; the last
+        # part may be short, so judge by the first part
+        first = parts.get(1)
+        if first is not None and first["Size"] == part_size:
+            return upload["UploadId"], dict(
+                (n, t["ETag"].strip('"')) for n, t in parts.items()
+            )
+    return None, {}
+
+
+def stream_to_s3(
+    read_range,
+    size,
+    bucket,
+    key,
+    client=None,
+    part_size=None,
+    part_threads=4,
+    retries=PART_RETRY,
+):
+    """
+    copy `size` bytes, read in parts with `read_range(start, length)`, to
+    s3://bucket/key as a multipart upload. at most `part_threads` parts are held
+    in memory at once. each part is checked against the MD5 S3 reports for it,
+    and retried on failure; an incomplete upload is left in place to be resumed
+    by the next attempt. returns the ETag of the uploaded object.
+    """
+    if client is None:
+        client = get_s3_client()
+    if part_size is None:
+        part_size = choose_part_size(size)
+
+    def read_checked(start, length):
+        data = read_range(start, length)
+        if len(data) != length:
+            raise S3TransferException(
+                "short read at %d: got %d, expected %d" % (start, len(data), length)
+            )
+        return data
+
+    def with_retries(desc, fn, *args):
+        for attempt in range(retries):
+            try:
+                return fn(*args)
+            except (
+                IOError,
+                S3TransferException,
+                requests.RequestException,
+                botocore.exceptions.BotoCoreError,
+                botocore.exceptions.ClientError,
+            ) as e:
+                if attempt == retries - 1:
+                    raise
+                logger.warning(
+                    "%s failed (attempt %d of %d): %s" % (desc, attempt + 1, retries, e)
+                )
+                time.sleep(2**attempt)
+
+    if size <= part_size:
+
+        def put_whole():
+            data = read_checked(0, size)
+            response = client.put_object(
+                Bucket=bucket, Key=key, Body=data, Tagging=S3_TAGGING
+            )
+            etag = response["ETag"].strip('"')
+            if etag != md5(data).hexdigest():
+                raise S3TransferException("ETag mismatch uploading %s" % (key))
+            return etag
+
+        return with_retries("upload of %s" % (key), put_whole)
+
+    upload_id, uploaded = find_resumable_upload(client, bucket, key, part_size)
+    if upload_id is None:
+        upload_id = client.create_multipart_upload(
+            Bucket=bucket, Key=key, Tagging=S3_TAGGING
+        )["UploadId"]
+    else:
+        logger.info("resuming upload of %s: %d parts done" % (key, len(uploaded)))
+
+    part_count = (size + part_size - 1) // part_size
+
+    def put_part(part_number):
+        start = (part_number - 1) * part_size
+        length = min(part_size, size - start)
+        data = read_checked(start, length)
+        digest = md5(data)
+        response = client.upload_part(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data,
+        )
+        if response["ETag"].strip('"') != digest.hexdigest():
+            raise S3TransferException(
+                "ETag mismatch for part %d of %s" % (part_number, key)
+            )
+        return digest.hexdigest()
+
+    failed = threading.Event()
+
+    def part(part_number):
+        if part_number in uploaded:
+            return uploaded[part_number]
+        # don't keep transferring once any part has given up
+        if failed.is_set():
+            raise S3TransferException("upload of %s abandoned" % (key))
+        try:
+            return with_retries(
+                "part %d of %d for %s" % (part_number, part_count, key),
+                put_part,
+                part_number,
+            )
+        except Exception:
+            failed.set()
+            raise
+
+    with ThreadPoolExecutor(max_workers=max(1, part_threads)) as executor:
+        part_etags = list(executor.map(part, range(1, part_count + 1)))
+
+    response = client.complete_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={
+            "Parts": [
+                {"PartNumber": n, "ETag": etag} for n, etag in enumerate(part_etags, 1)
+            ]
+        },
+    )
+    # the ETag S3 gives the completed object is what is checked against the
+    # metadata; it should match the one we work out from the parts
+    etag = response["ETag"].strip('"')
+    if etag != make_multipart([unhexlify(t) for t in part_etags]):
+        raise S3TransferException("ETag mismatch completing upload of %s" % (key))
+    return etag
+
+
+def stream_file_to_s3(path, bucket, key, **kwargs):
+    return stream_to_s3(
+        file_range_reader(path), os.path.getsize(path), bucket, key, **kwargs
+    )
+
+
+def resources_prefix(parent_destination):
+    "returns (bucket, prefix) under which CKAN keeps uploaded resources"
+    bucket, prefix = parent_destination.split("/", 1)
+    return bucket, "{}/resources/".format(prefix)
+
+
+def index_entry(index, prefix, key, size, etag):
+    "add s3://bucket/<prefix><resource id>/<filename> to `index`"
+    if not key.startswith(prefix):
+        return
+    parts = key[len(prefix) :].split("/", 1)
+    if len(parts) != 2:
+        return
+    resource_id, filename = parts
+    index[(resource_id, filename)] = (int(size), etag.strip('"'))
+
+
+# resource IDs are hexadecimal, and the listing is split by their first digit.
+# any key under the prefix starting with another character falls between these
+# shards: the gaps are listed too, each as (start after, stop before). U+10FFFF
+# sorts after anything which can follow the last digit of the shard before.
+RESOURCE_SHARDS = "0123456789abcdef"
+RESOURCE_SHARD_GAPS = ((None, "0"), ("9\U0010ffff", "a"), ("f\U0010ffff", None))
+
+
+def list_resource_objects(parent_destination, client=None, num_threads=16):
+    """
+    index every uploaded resource by listing the bucket, returning
+    {(resource id, filename): (size, etag)}. the listing is split by the first
+    digit of the resource ID, and the parts listed in parallel.
+    """
+    if client is None:
+        client = get_s3_client()
+    bucket, prefix = resources_prefix(parent_destination)
+
+    def list_part(digit):
+        part = {}
+        paginator = client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix + digit):
+            for obj in page.get("Contents", []):
+                index_entry(part, prefix, obj["Key"], obj["Size"], obj["ETag"])
+        return part
+
+    def list_gap(gap):
+        start_after, stop_before = gap
+        kwargs = {}
+        if start_after is not None:
+            kwargs["StartAfter"] = prefix + start_after
+        part = {}
+        paginator = client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, **kwargs):
+            for obj in page.get("Contents", []):
+                if stop_before is not None and obj["Key"] >= prefix + stop_before:
+                    return part
+                index_entry(part, prefix, obj["Key"], obj["Size"], obj["ETag"])
+        return part
+
+    index = {}
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        for part in executor.map(list_part, RESOURCE_SHARDS):
+            index.update(part)
+        unsharded = 0
+        for part in executor.map(list_gap, RESOURCE_SHARD_GAPS):
+            unsharded += len(part)
+            index.update(part)
+    if unsharded:
+        logger.warning(
+            "%d objects in s3://%s/%s have a resource ID which is not hexadecimal"
+            % (unsharded, bucket, prefix)
+        )
+    logger.info(
+        "%d uploaded resources listed in s3://%s/%s" % (len(index), bucket, prefix)
+    )
+    return index
+
+
+INVENTORY_FIELDS = ("Bucket", "Key", "Size", "ETag")
+
+
+def read_inventory_csv(path, parent_destination, fields=INVENTORY_FIELDS):
+    """
+    index every uploaded resource from an S3 Inventory CSV report (optionally
+    gzipped, as S3 delivers them). `fields` is the column order configured for
+    the inventory. returns {(resource id, filename): (size, etag)}.
+    """
+    bucket, prefix = resources_prefix(parent_destination)
+    columns = dict((t, fields.index(t)) for t in INVENTORY_FIELDS)
+    opener = gzip.open if path.endswith(".gz") else open
+    index = {}
+    with opener(path, "rt", newline="") as fd:
+        for row in csv.reader(fd):
+            if row[columns["Bucket"]] != bucket:
+                continue
+            # inventory reports URL-encode the object key
+            index_entry(
+                index,
+                prefix,
+                unquote_plus(row[columns["Key"]]),
+                row[columns["Size"]],
+                row[columns["ETag"]],
+            )
+    logger.info("%d uploaded resources read from inventory %s" % (len(index), path))
+    return index
@@ -0,0 +1,253 @@
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+
+import ckanapi
+import requests
+
+from .metrics import metrics
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+# the status code is only to be found in the text of errors ckanapi can't map
+# back to a CKAN exception: repr([url, status, response])
+status_re = re.compile(r"^\[(?:'[^']*'|\"[^\"]*\"), (\d{3}),")
+
+THROTTLED = "throttled"
+SERVER_ERROR = "server-error"
+TIMEOUT = "timeout"
+
+
+def classify_error(e):
+    """
+    returns the kind of transient failure `e` represents, or None if retrying
+    would not help (the request was understood, and refused)
+    """
+    if isinstance(
+        e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)
+    ):
+        return TIMEOUT
+    if isinstance(e, (ckanapi.errors.NotFound, ckanapi.errors.ValidationError)):
+        return None
+    if isinstance(e, ckanapi.errors.NotAuthorized):
+        return None
+    if isinstance(
+        e, (ckanapi.errors.CKANAPIError, ckanapi.errors.ServerIncompatibleError)
+    ):
+        match = status_re.match(str(e.args[0]) if e.args else "")
+        if match is None:
+            return None
+        status = int(match.group(1))
+        if status == 429:
+            return THROTTLED
+        if status >= 500:
+            return SERVER_ERROR
+    return None
+
+
+class RetryPolicy:
+    """
+    how many attempts an action gets, and on which failures it may retry. an
+    action which is not idempotent retries only when throttled, as the
+    request was then refused before CKAN acted upon it.
+    """
+
+    def __init__(self, attempts, idempotent=True):
+        self.attempts = attempts
+        self.idempotent = idempotent
+
+    def may_retry(self, kind):
+        return kind == THROTTLED or (kind is not None and self.idempotent)
+
+
+DEFAULT_POLICY = RetryPolicy(attempts=3)
+# keyed by the method part of the action name, e.g. `show` for `package_show`
+RETRY_POLICIES = {
+    "show": RetryPolicy(attempts=5),
+    "search": RetryPolicy(attempts=5),
+    "list": RetryPolicy(attempts=5),
+    "patch": RetryPolicy(attempts=3),
+    "update": RetryPolicy(attempts=3),
+    "delete": RetryPolicy(attempts=3),
+    "purge": RetryPolicy(attempts=3),
+    "create": RetryPolicy(attempts=3, idempotent=False),
+}
+
+
+class RetryBudget:
+    """
+    retries are limited to a fraction of the requests made, so a struggling
+    CKAN is not buried under a growing pile of retries. each request adds
+    `ratio` to the budget, and each retry spends 1.
+    """
+
+    def __init__(self, ratio=0.1, minimum=10):
+        self.ratio = ratio
+        self._balance = float(minimum)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance += self.ratio
+
+    def withdraw(self):
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+
+class AdaptiveRateLimiter:
+    """
+    a token bucket, refilled at `rate` requests per second, in front of a limit
+    on the number of requests in flight. the rate is halved when CKAN shows
+    signs of overload, and recovers additively as requests succeed, up to
+    `max_rate`. with `max_rate` of None there is no rate limit until CKAN
+    first pushes back.
+    """
+
+    def __init__(self, max_rate=None, min_rate=1.0, max_concurrency=16):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(max(1, max_concurrency))
+
+    def _take(self):
+        "take a token, or return how long to wait for one"
+        with self._lock:
+            if self.rate is None:
+                return 0
+            now = time.monotonic()
+            self._tokens = min(
+                max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self._take()
+            if not wait:
+                break
+            time.sleep(wait)
+        self._in_flight.acquire()
+
+    def release(self):
+        self._in_flight.release()
+
+    def backoff(self, observed_rate):
+        with self._lock:
+            current = self.rate if self.rate is not None else observed_rate
+            self.rate = max(self.min_rate, current / 2)
+            logger.warning(
+                "CKAN is overloaded: reducing to %.1f requests/s" % (self.rate)
+            )
+
+    def success(self):
+        with self._lock:
+            if self.rate is None:
+                return
+            # one more request per second, for each second's worth of success
+            self.rate += 1.0 / self.rate
+            if self.max_rate is not None and self.rate >= self.max_rate:
+                self.rate = self.max_rate
+
+
+class CKANScheduler:
+    """
+    every CKAN action passes through here: the limiter paces the requests,
+    transient failures are retried with exponential backoff according to the
+    policy for the action, within an overall retry budget.
+    """
+
+    def __init__(
+        self,
+        max_rate=None,
+        min_rate=1.0,
+        max_concurrency=16,
+        budget=None,
+        backoff_base=0.5,
+        backoff_cap=30.0,
+    ):
+        self.limiter = AdaptiveRateLimiter(
+            max_rate=max_rate, min_rate=min_rate, max_concurrency=max_concurrency
+        )
+        self.budget = budget or RetryBudget()
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.retry_stats = defaultdict(int)
+        self._stats_lock = threading.Lock()
+        self._started = time.monotonic()
+        self._requests = 0
+
+    def observed_rate(self):
+        with self._stats_lock:
+            return max(1.0, self._requests / max(1.0, time.monotonic() - self._started))
+
+    def call(self, action, fn, *args, **kwargs):
+        policy = RETRY_POLICIES.get(action.rsplit("_", 1)[-1], DEFAULT_POLICY)
+        object_type, _, method = action.partition("_")
+        attempt = 0
+        while True:
+            attempt += 1
+            self.budget.deposit()
+            self.limiter.acquire()
+            try:
+                with self._stats_lock:
+                    self._requests += 1
+                start = time.perf_counter()
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                kind = classify_error(e)
+                metrics.observe_call(
+                    object_type,
+                    method,
+                    time.perf_counter() - start,
+                    kind or type(e).__name__,
+                )
+                if kind is None or not policy.may_retry(kind):
+                    raise
+                self.limiter.backoff(self.observed_rate())
+                if attempt >= policy.attempts or not self.budget.withdraw():
+                    logger.error("%s failed (%s), giving up: %s" % (action, kind, e))
+                    raise
+                with self._stats_lock:
+                    self.retry_stats[(action, kind)] += 1
+                metrics.count_retry(object_type, method, kind)
+                delay = min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1))
+                delay *= random.uniform(0.5, 1.0)
+                logger.warning(
+                    "%s failed (%s), retrying in %.1fs (attempt %d of %d)"
+                    % (action, kind, delay, attempt, policy.attempts)
+                )
+            else:
+                metrics.observe_call(object_type, method, time.perf_counter() - start)
+                self.limiter.success()
+                return result
+            finally:
+                self.limiter.release()
+            time.sleep(delay)
+
+
+_scheduler = CKANScheduler()
+
+
+def get_scheduler():
+    return _scheduler
+
+
+def configure_scheduler(**kwargs):
+    "replace the scheduler all CKAN calls pass through"
+    global _scheduler
+    _scheduler = CKANScheduler(**kwargs)
+    return _scheduler
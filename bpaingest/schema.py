@@ -4,6 +4,7 @@ import re
 from collections import defaultdict
 from .projects import ProjectInfo
 from .metadata import DownloadMetadata
+from .metastore import make_metadata_store
 from .util import make_logger
 from copy import deepcopy
 
@@ -96,6 +97,11 @@ schema_template = {
             "label": "Related Data",
             "form_placeholder": "used by ckanext-bpatheme",
         },
+        {
+            "field_name": "bpaingest_fingerprint",
+            "label": "bpa-ingest Fingerprint",
+            "form_placeholder": "used by bpa-ingest",
+        },
     ],
     "resource_fields": [
         {"field_name": "name", "label": "Name"},
@@ -121,6 +127,13 @@ schema_template = {
             "form_placeholder": "",
             "preset": "datetime",
         },
+        {"field_name": "s3_verified_size", "label": "S3 Size When Verified"},
+        {"field_name": "s3_verified_etag", "label": "S3 E-Tag When Verified"},
+        {
+            "field_name": "bpaingest_fingerprint",
+            "label": "bpa-ingest Fingerprint",
+            "form_placeholder": "used by bpa-ingest",
+        },
         {
             "field_name": "format",
             "label": "Format",
@@ -216,6 +229,7 @@ def generate_schemas(args):
 
     has_validate_schema = True if args.validate_schema == "True" else False
 
+    store = make_metadata_store(args)
     for class_info in classes:
         project_cls = class_info["cls"]
         logger.info(
@@ -226,6 +240,9 @@ def generate_schemas(args):
             make_logger(class_info["slug"]),
             project_cls,
             path=dlpath,
+            refresh=args.refresh_metadata,
+            store=store,
+            mirror_path=args.archive_mirror,
             has_validate_schema=has_validate_schema,
         ) as dlmeta:
             meta = dlmeta.meta
@@ -11,6 +11,7 @@ from bpaingest.resource_metadata import (
 )
 
 from bpaingest.util import make_logger
+from bpaingest.profiling import phase
 from bpaingest.util import logger_wrap as logwrap
 
 logger = make_logger(__name__)
@@ -88,9 +89,11 @@ class SecondaryMetadata(BaseMetadata):
         # ensure that each class can expect to have _get_packages() called first,
         # then _get_resources(), and only once in the entire lifetime of the class.
         if self._packages is None:
-            self._packages = self._get_packages()
+            with phase("get-packages"):
+                self._packages = self._get_packages()
             self._update_raw_resources()
-            self._resources = self._get_resources()
+            with phase("get-resources"):
+                self._resources = self._get_resources()
             BaseMetadata.resources_add_format(self._resources)
             BaseMetadata.obj_round_floats_and_stringify(self._packages)
             BaseMetadata.obj_round_floats_and_stringify(
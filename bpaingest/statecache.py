@@ -0,0 +1,225 @@
+import json
+import sqlite3
+import threading
+
+from .ops import ckan_method
+from .pkgcache import iter_package_search
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS packages (
+    id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    name TEXT,
+    metadata_modified TEXT,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS packages_type ON packages (type);
+CREATE TABLE IF NOT EXISTS resources (
+    id TEXT PRIMARY KEY,
+    package_id TEXT NOT NULL,
+    md5 TEXT,
+    name TEXT,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resources_package_id ON resources (package_id);
+CREATE INDEX IF NOT EXISTS resources_md5 ON resources (md5, name);
+CREATE TABLE IF NOT EXISTS refreshes (
+    type TEXT PRIMARY KEY,
+    metadata_modified TEXT
+);
+"""
+
+
+def solr_timestamp(metadata_modified):
+    """
+    CKAN timestamps are ISO 8601 without a timezone, in UTC. truncate to the
+    second, so that a range query from this timestamp is inclusive of it
+    """
+    return metadata_modified[:19] + "Z"
+
+
+class CKANStateCache:
+    """
+    a persistent local mirror of the CKAN package and resource state, held in
+    SQLite. the first refresh of a package type fetches every package of that
+    type; after that, only packages with a `metadata_modified` newer than the
+    last refresh are fetched, and packages which have left CKAN are pruned.
+    """
+
+    def __init__(self, path, ckan_address):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        with self._conn:
+            row = self._conn.execute(
+                "SELECT value FROM settings WHERE key = 'ckan_address'"
+            ).fetchone()
+            if row is not None and row[0] != ckan_address:
+                # state from a different CKAN instance is no use to us
+                logger.warning(
+                    "state cache %s was built from %s, discarding" % (path, row[0])
+                )
+                for table in ("packages", "resources", "refreshes"):
+                    self._conn.execute("DELETE FROM %s" % table)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES ('ckan_address', ?)",
+                (ckan_address,),
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _upsert_package(self, package):
+        self._conn.execute(
+            "DELETE FROM resources WHERE package_id = ?", (package["id"],)
+        )
+        self._conn.execute(
+            "INSERT OR REPLACE INTO packages (id, type, name, metadata_modified, body) VALUES (?, ?, ?, ?, ?)",
+            (
+                package["id"],
+                package["type"],
+                package["name"],
+                package.get("metadata_modified"),
+                json.dumps(package),
+            ),
+        )
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO resources (id, package_id, md5, name, body) VALUES (?, ?, ?, ?, ?)",
+            (
+                (
+                    resource["id"],
+                    package["id"],
+                    resource.get("md5"),
+                    resource.get("name"),
+                    json.dumps(resource),
+                )
+                for resource in package.get("resources", [])
+            ),
+        )
+
+    def _delete_package(self, package_id):
+        self._conn.execute("DELETE FROM resources WHERE package_id = ?", (package_id,))
+        self._conn.execute("DELETE FROM packages WHERE id = ?", (package_id,))
+
+    def refresh(self, ckan, package_type):
+        "bring the mirror of `package_type` up to date with CKAN"
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT metadata_modified FROM refreshes WHERE type = ?",
+                (package_type,),
+            ).fetchone()
+        q = "type:{}".format(package_type)
+        search_kwargs = {"q": q, "include_private": True}
+        if row is None:
+            logger.info(
+                "Retrieving all extant packages of type: {}".format(package_type)
+            )
+            with self._lock, self._conn:
+                for (package_id,) in self._conn.execute(
+                    "SELECT id FROM packages WHERE type = ?", (package_type,)
+                ).fetchall():
+                    self._delete_package(package_id)
+        else:
+            logger.info(
+                "Retrieving packages of type {} modified since {}".format(
+                    package_type, row[0]
+                )
+            )
+            search_kwargs["fq"] = "metadata_modified:[{} TO *]".format(
+                solr_timestamp(row[0])
+            )
+
+        # each page is committed as it arrives; the watermark is only moved
+        # once every page is in, so an interrupted refresh is simply repeated
+        fetched = 0
+        watermark = row[0] if row is not None else None
+        for page in iter_package_search(ckan, **search_kwargs):
+            fetched += len(page)
+            with self._lock, self._conn:
+                for package in page:
+                    self._upsert_package(package)
+                    modified = package.get("metadata_modified")
+                    if modified and (watermark is None or modified > watermark):
+                        watermark = modified
+        logger.info("{} packages fetched".format(fetched))
+
+        with self._lock, self._conn:
+            if watermark is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO refreshes (type, metadata_modified) VALUES (?, ?)",
+                    (package_type, watermark),
+                )
+            (cached_count,) = self._conn.execute(
+                "SELECT COUNT(*) FROM packages WHERE type = ?", (package_type,)
+            ).fetchone()
+
+        if row is not None:
+            # deleted packages don't show up as modified: if the counts disagree,
+            # list the IDs that CKAN still has to find what has gone
+            search = ckan_method(ckan, "package", "search")
+            count = search(q=q, include_private=True, rows=0)["count"]
+            if count != cached_count:
+                extant_ids = set()
+                for page in iter_package_search(
+                    ckan, q=q, include_private=True, fl="id"
+                ):
+                    extant_ids.update(t["id"] for t in page)
+                with self._lock, self._conn:
+                    cached_ids = set(
+                        t
+                        for (t,) in self._conn.execute(
+                            "SELECT id FROM packages WHERE type = ?", (package_type,)
+                        ).fetchall()
+                    )
+                    for package_id in cached_ids - extant_ids:
+                        self._delete_package(package_id)
+                    if extant_ids - cached_ids:
+                        # we've missed something: start again from scratch
+                        logger.warning(
+                            "state cache is missing packages of type {}, refetching".format(
+                                package_type
+                            )
+                        )
+                        self._conn.execute(
+                            "DELETE FROM refreshes WHERE type = ?", (package_type,)
+                        )
+                if extant_ids - cached_ids:
+                    self.refresh(ckan, package_type)
+
+    def _bodies(self, sql, args):
+        with self._lock:
+            return [json.loads(t) for (t,) in self._conn.execute(sql, args).fetchall()]
+
+    def packages_of_type(self, package_type):
+        return self._bodies(
+            "SELECT body FROM packages WHERE type = ? ORDER BY id", (package_type,)
+        )
+
+    def package(self, package_id):
+        packages = self._bodies("SELECT body FROM packages WHERE id = ?", (package_id,))
+        return packages[0] if packages else None
+
+    def resource(self, resource_id):
+        resources = self._bodies(
+            "SELECT body FROM resources WHERE id = ?", (resource_id,)
+        )
+        return resources[0] if resources else None
+
+    def resources_by_md5(self, md5, name=None):
+        if name is None:
+            return self._bodies(
+                "SELECT body FROM resources WHERE md5 = ? ORDER BY id", (md5,)
+            )
+        return self._bodies(
+            "SELECT body FROM resources WHERE md5 = ? AND name = ? ORDER BY id",
+            (md5, name),
+        )
@@ -1,19 +1,24 @@
-import os
-import pickle
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 from bpaingest.ops import (
     ckan_method,
     patch_if_required,
     check_resource,
     create_resource,
-    reupload_resource,
     get_organization,
     make_organization,
     CKANArchiveInfo,
-    ApacheArchiveInfo,
+    ApacheArchiveIndex,
+    make_archive_info,
+    object_fingerprint,
+    S3IndexArchiveInfo,
+    FINGERPRINT_FIELD,
 )
-from bpaingest.pkgcache import build_package_cache
+from bpaingest.metrics import metrics
+from bpaingest.profiling import phase
+from bpaingest.pkgcache import build_package_cache, index_resources
+from bpaingest.reupload import ReuploadPipeline, shared_linkage
 import ckanapi
 
 from bpaingest.resource_metadata import (
@@ -27,6 +32,9 @@ from collections import Counter
 
 logger = make_logger(__name__)
 
+# re-uploads claimed from the journal at a time, per pipeline thread
+REUPLOAD_BATCH_PER_THREAD = 8
+
 
 def get_or_create_package(ckan, obj):
     try:
@@ -58,16 +66,6 @@ def get_or_create_package(ckan, obj):
     return ckan_obj
 
 
-def get_or_create_resource(ckan, obj):
-    try:
-        ckan_obj = ckan_method(ckan, "resource", "show")(id=obj["id"])
-
-    except ckanapi.errors.NotFound:
-        ckan_obj = ckan_method(ckan, "resource", "create")(**obj)
-        logger.info("created resource object: %s" % (ckan_obj["id"]))
-    return ckan_obj
-
-
 def get_uploaded_resource_from_ckan(ckan, obj):
     #  this will return None if the resource is NOT uploaded to S3.
     try:
@@ -83,6 +81,13 @@ def get_uploaded_resource_from_ckan(ckan, obj):
     return resource_from_ckan
 
 
+def package_compare_obj(ckan_obj):
+    # tags are handed back with a bunch of info that's irrelevant
+    compare_ckan_obj = ckan_obj.copy()
+    compare_ckan_obj["tags"] = [{"name": t["name"]} for t in ckan_obj["tags"]]
+    return compare_ckan_obj
+
+
 def sync_package(ckan, obj, cached_obj):
     if cached_obj is None:
         ckan_obj = get_or_create_package(ckan, obj)
@@ -90,23 +95,25 @@ def sync_package(ckan, obj, cached_obj):
         ckan_obj = cached_obj
     patch_obj = obj.copy()
     patch_obj["id"] = ckan_obj["id"]
-    # tags are handed back with a bunch of info that's irrelevant
-    compare_ckan_obj = ckan_obj.copy()
-    compare_ckan_obj["tags"] = [{"name": t["name"]} for t in ckan_obj["tags"]]
-    was_patched, ckan_obj = patch_if_required(
-        ckan, "package", compare_ckan_obj, patch_obj
+    was_patched, ckan_obj, fingerprint_only = patch_if_required(
+        ckan, "package", package_compare_obj(ckan_obj), patch_obj, fingerprint=True
     )
     if was_patched:
         logger.info("patched package object: %s" % (obj["id"]))
+    elif fingerprint_only:
+        logger.debug("recorded fingerprint of package object: %s" % (obj["id"]))
     return ckan_obj
 
 
-def delete_dangling_packages(ckan, packages, cache, do_delete):
+def dangling_packages(packages, cache):
+    "IDs of the packages in `cache` which are not in `packages`"
     extant_ids = set(cache.keys())
     continuing_ids = set(t["id"] for t in packages)
-    to_delete = extant_ids - continuing_ids
+    return sorted(extant_ids - continuing_ids)
 
-    for delete_id in to_delete:
+
+def delete_dangling_packages(ckan, packages, cache, do_delete):
+    for delete_id in dangling_packages(packages, cache):
         delete_obj = cache[delete_id]
         logger.info(
             "package for deletion: %s/%s (do_delete=%s)"
@@ -117,32 +124,67 @@ def delete_dangling_packages(ckan, packages, cache, do_delete):
             logger.info("deleted package: %s/%s" % (delete_obj["id"], delete_id))
 
 
-def sync_packages(
-    ckan, ckan_data_type, packages, org, group, do_delete, do_single_ticket
-):
-    # FIXME: we don't check if there are any packages we should remove (unpublish)
-    logger.info("syncing %d packages" % (len(packages)))
-    reporting_interval = determine_reporting_interval(len(packages))
+def package_targets(packages, org, group, do_single_ticket):
+    """
+    the package objects we want CKAN to hold, in the order they are synced
+    """
     # we have to post the group back in package objects, send a minimal version of it
     api_group_obj = prune_dict(
         group,
         ("display_name", "description", "title", "image_display_url", "id", "name"),
     )
-    ckan_packages = []
-
-    cache = build_package_cache(ckan, ckan_data_type, packages)
-    if do_single_ticket is None:  # no need to try to delete them
-        delete_dangling_packages(ckan, packages, cache, do_delete)
-
-    synched_package_count = 0
+    targets = []
     for package in sorted(packages, key=lambda p: p["name"]):
         obj = package.copy()
         obj["owner_org"] = org["id"]
         if api_group_obj is not None:
             obj["groups"] = [api_group_obj]
         if do_single_ticket is None or obj["ticket"] == do_single_ticket:
-            ckan_packages.append(sync_package(ckan, obj, cache.get(obj["id"])))
-            synched_package_count += 1
+            targets.append(obj)
+    return targets
+
+
+def sync_packages(
+    ckan,
+    ckan_data_type,
+    packages,
+    org,
+    group,
+    do_delete,
+    do_single_ticket,
+    num_threads=1,
+    state_cache=None,
+    async_in_flight=None,
+):
+    """
+    with `async_in_flight` set, the packages are synced with the asyncio
+    client, with up to that many requests in flight, rather than with threads
+    """
+    # FIXME: we don't check if there are any packages we should remove (unpublish)
+    logger.info("syncing %d packages (%d threads)" % (len(packages), num_threads))
+    reporting_interval = determine_reporting_interval(len(packages))
+    cache = build_package_cache(ckan, ckan_data_type, packages, state_cache)
+    if do_single_ticket is None:  # no need to try to delete them
+        delete_dangling_packages(ckan, packages, cache, do_delete)
+
+    to_sync = package_targets(packages, org, group, do_single_ticket)
+    if async_in_flight:
+        from bpaingest import aiockan
+
+        return aiockan.run(ckan, async_in_flight, aiockan.sync_packages, to_sync, cache)
+
+    # each package is independent of the others, so the CKAN round trips can
+    # be overlapped. results are collected in submission order, so the output
+    # is the same as a serial sync.
+    ckan_packages = []
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        futures = [
+            executor.submit(sync_package, ckan, obj, cache.get(obj["id"]))
+            for obj in to_sync
+        ]
+        for future in futures:
+            ckan_packages.append(future.result())
+            synched_package_count = len(ckan_packages)
             if synched_package_count % reporting_interval == 0:
                 logger.info(
                     "synced %d of %d packages" % (synched_package_count, len(packages))
@@ -150,13 +192,37 @@ def sync_packages(
     return ckan_packages
 
 
-def check_resources(ckan, current_resources, resource_id_legacy_url, auth, num_threads):
-    ckan_archive_info = CKANArchiveInfo(ckan)
-    apache_archive_info = ApacheArchiveInfo(auth)
-    to_reupload = []
-
-    def check(current_ckan_obj, legacy_url, current_url):
+def check_resources(
+    ckan,
+    current_resources,
+    resource_id_legacy_url,
+    auth,
+    num_threads,
+    verifier=None,
+    ckan_archive_info=None,
+    archive_info=None,
+):
+    """
+    check each of `current_resources`, returning the (resource, legacy_url) pairs which
+    need to be re-uploaded. if `verifier` (a `ResourceVerifier`) is given, it decides
+    which resources can skip the check, and records those which pass.
+    `ckan_archive_info` defaults to a `CKANArchiveInfo`, which asks CKAN and S3
+    about each resource in turn; `archive_info`, which answers for the legacy
+    archive, to an `ApacheArchiveIndex`.
+    """
+    if ckan_archive_info is None:
+        ckan_archive_info = CKANArchiveInfo(ckan)
+    apache_archive_info = archive_info or ApacheArchiveIndex(auth)
+    reporting_interval = determine_reporting_interval(len(current_resources))
+
+    def check(current_ckan_obj):
         obj_id = current_ckan_obj["id"]
+        legacy_url = resource_id_legacy_url.get(obj_id)
+        current_url = current_ckan_obj.get("url")
+        if verifier is not None and verifier.is_fresh(current_ckan_obj):
+            logger.info("resource check skipped, recently verified: %s" % (obj_id))
+            metrics.count_check("skipped")
+            return None
         resource_issue = check_resource(
             ckan_archive_info,
             apache_archive_info,
@@ -164,32 +230,85 @@ def check_resources(ckan, current_resources, resource_id_legacy_url, auth, num_t
             legacy_url,
             [current_ckan_obj.get(t) for t in S3_HASH_FIELDS],
         )
+        metrics.count_check(resource_issue or "ok")
         if resource_issue:
             logger.error(
                 "resource check failed (%s) queued for re-upload: %s"
                 % (resource_issue, obj_id)
             )
-            to_reupload.append((current_ckan_obj, legacy_url))
-        else:
-            logger.info("resource check OK: %s" % (obj_id))
+            return current_ckan_obj, legacy_url
+        logger.info("resource check OK: %s" % (obj_id))
+        if verifier is not None:
+            # the size and etag are cached by the archive info
+            verifier.verified(
+                current_ckan_obj, *ckan_archive_info.get_size_and_etag(current_url)
+            )
+        return None
 
-    logger.info("%d resources to be checked" % (len(current_resources)))
-    for current_ckan_obj in current_resources:
-        obj_id = current_ckan_obj["id"]
-        legacy_url = resource_id_legacy_url.get(obj_id)
-        current_url = current_ckan_obj.get("url")
-        check(current_ckan_obj, legacy_url, current_url)
+    logger.info(
+        "%d resources to be checked (%d threads)"
+        % (len(current_resources), num_threads)
+    )
+    # the checks only share the archive info caches (which are locked), and
+    # results are gathered in submission order, so `to_reupload` is built by
+    # a single thread in a deterministic order
+    to_reupload = []
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        futures = [executor.submit(check, t) for t in current_resources]
+        for checked_count, future in enumerate(futures, 1):
+            reupload = future.result()
+            if reupload is not None:
+                to_reupload.append(reupload)
+            if checked_count % reporting_interval == 0:
+                logger.info(
+                    "checked %d of %d resources"
+                    % (checked_count, len(current_resources))
+                )
 
+    if verifier is not None:
+        verifier.flush(ckan, num_threads)
     return to_reupload
 
 
-def check_package_resources(ckan, ckan_packages, resource_id_legacy_url, auth):
+def check_package_resources(
+    ckan,
+    ckan_packages,
+    resource_id_legacy_url,
+    auth,
+    num_threads=8,
+    verifier=None,
+    ckan_archive_info=None,
+    archive_info=None,
+):
     all_resources = []
     for package_obj in sorted(ckan_packages, key=lambda p: p["name"]):
         current_resources = package_obj["resources"]
         all_resources += current_resources
 
-    return check_resources(ckan, all_resources, resource_id_legacy_url, auth, 8)
+    return check_resources(
+        ckan,
+        all_resources,
+        resource_id_legacy_url,
+        auth,
+        num_threads,
+        verifier,
+        ckan_archive_info,
+        archive_info,
+    )
+
+
+def make_ckan_archive_info(ckan, s3_index=False, s3_inventory=None):
+    """
+    with `s3_index` or `s3_inventory` (the path to an S3 Inventory CSV report) set,
+    resources are checked against an index of the upload bucket, rather than
+    one request at a time. returns None for the default per-resource checks.
+    """
+    if not s3_index and not s3_inventory:
+        return None
+    destination = reupload_destination(ckan)
+    if destination is None:
+        raise Exception("no S3 bucket is known for {}".format(ckan.address))
+    return S3IndexArchiveInfo(ckan, destination, inventory_path=s3_inventory)
 
 
 def sync_package_resources(
@@ -220,6 +339,8 @@ def sync_package_resources(
         # them come back and upload into CKAN using the reupload functionality of this script
         create_obj = resource_obj.copy()
         create_obj["url"] = legacy_url
+        # created with its fingerprint, so it needn't be patched in to place later
+        create_obj[FINGERPRINT_FIELD] = object_fingerprint(resource_obj)
         current_ckan_obj = create_resource(ckan, create_obj)
         if current_ckan_obj:
             created_resource_count += 1
@@ -253,59 +374,48 @@ def sync_package_resources(
             logger.debug("skipping patch of unknown resource: {}".format(obj_id))
             continue
         legacy_url = resource_id_legacy_url[obj_id]
-        was_patched, ckan_obj = patch_if_required(
-            ckan, "resource", current_ckan_obj, resource_obj
+        was_patched, ckan_obj, fingerprint_only = patch_if_required(
+            ckan, "resource", current_ckan_obj, resource_obj, fingerprint=True
         )
         if was_patched:
             logger.info("patched resource: %s" % (obj_id))
+        elif fingerprint_only:
+            logger.debug("recorded fingerprint of resource: %s" % (obj_id))
 
     return to_reupload
 
 
+def reupload_destination(ckan):
+    "the bucket/prefix CKAN keeps uploaded resources under, or None if unknown"
+    # TODO: there is no bucket for anything other than prod OR STAGING - however it's unclear whether this breaks in non-prod environments
+    ## Test this by setting it to None or '' any that way we don't accidentally send data to a bucket that is inadvertently created in S3
+    if re.search("^https://data.bioplatforms.com", getattr(ckan, "address", "")):
+        return "bpa-ckan-prod/prodenv"
+    elif re.search("^https://staging.bioplatforms.com", getattr(ckan, "address", "")):
+        return "bpa-ckan-staging/stagingenv"
+    return None
+
+
 def reupload_resources(
     ckan,
     to_reupload,
     shared_resources,
     auth,
-    write_reuploads_fn,
-    write_reuploads_interval,
+    journal=None,
+    download_threads=2,
+    upload_threads=4,
+    patch_threads=1,
+    streaming=False,
+    archive_info=None,
 ):
-    def do_actual_upload(ckan, reupload_obj, legacy_url, destination, auth):
-        try:
-            reupload_resource(ckan, reupload_obj, legacy_url, destination, auth)
-        except Exception as e:
-            logger.error(e)
-            logger.info("Resource failed to upload. Continuing...")
-        else:
-            to_reupload.remove((reupload_obj, legacy_url))
-            logger.info(
-                f"Resource successfully uploaded. Removed {reupload_obj} at {legacy_url} from reupload list..."
-            )
-        finally:
-            remaining_reuploads_count = len(to_reupload)
-            logger.info(
-                f"Resource Upload progress: {remaining_reuploads_count} out of {total_reuploads} to do."
-            )
-            # Only write to disk when interval counter reached
-            if (
-                write_reuploads_fn
-                and remaining_reuploads_count % int(write_reuploads_interval) == 0
-            ):
-                logger.info(
-                    f"Reached write reuploads interval: {write_reuploads_interval}"
-                )
-                write_reuploads_fn(to_reupload)
-
-    total_reuploads = len(to_reupload)
-    logger.info("%d objects to be re-uploaded" % (total_reuploads))
-    # TODO: there is no bucket for anything other than prod OR STAGING - however it's unclear whether this breaks in non-prod environments
-    ## Test this by setting it to None or '' any that way we don't accidentally send data to a bucket that is inadvertently created in S3
-    destination = None
-    if re.search("^https://data.bioplatforms.com", getattr(ckan, "address", "")):
-        destination = "bpa-ckan-prod/prodenv"
-        logger.info("Resources will be reuploaded under: {}".format(destination))
-    elif re.search("^https://staging.bioplatforms.com", getattr(ckan, "address", "")):
-        destination = "bpa-ckan-staging/stagingenv"
+    """
+    re-upload `to_reupload` through a `ReuploadPipeline`, returning the
+    resources which could not be re-uploaded. if `journal` (a `ReuploadJournal`)
+    is given, `to_reupload` is ignored: work is claimed from the journal in
+    batches until it is drained, and each result is recorded as it completes.
+    """
+    destination = reupload_destination(ckan)
+    if destination is not None:
         logger.info("Resources will be reuploaded under: {}".format(destination))
     else:
         logger.warn(
@@ -313,80 +423,56 @@ def reupload_resources(
                 getattr(ckan, "address", "")
             )
         )
-    # copy list and loop that, so can remove safely from original during loop
-    for indx, (reupload_obj, legacy_url) in enumerate(to_reupload[:]):
-        # first determine if this is a shared file.
-        # if it is, has it already been uploaded?
-        # if NOT, go off and upload it, and capture the necessary fields to reuse in our shared files list.
-        # if so, don't upload it again, but we do need to update the url, size etc from uploaded version of the resource
-        # if its NOT a share resource, just upload as normal.
-        if "shared_file" in reupload_obj and reupload_obj["shared_file"]:
-            shared_linkage = reupload_obj["md5"] + "/" + reupload_obj["name"]
-            if shared_linkage not in shared_resources:
-                logger.error(
-                    "No shared resource on file for {}, resource {},  not uploading".format(
-                        shared_linkage, reupload_obj
-                    )
-                )
-                continue
-            uploaded_shared_resource = shared_resources[shared_linkage][0].get(
-                "uploaded_resource"
-            )
-            if (
-                uploaded_shared_resource is None
-                or "size" not in uploaded_shared_resource
-            ):
-                # do the upload, and add the updated resource to the shared_resources object
-                do_actual_upload(ckan, reupload_obj, legacy_url, destination, auth)
-                ckan_updated_resource = get_or_create_resource(ckan, reupload_obj)
-                shared_resources[shared_linkage][0] = {
-                    "uploaded_resource": ckan_updated_resource
-                }
-            else:
-                # just update the resource with the metadata from the matching shared_resource.
-                reupload_obj["url"] = uploaded_shared_resource["url"]
-                reupload_obj["size"] = uploaded_shared_resource["size"]
-                reupload_obj["url_type"] = ""  # explicitly NOT upload
-                ckan_method(ckan, "resource", "update")(**reupload_obj)
-                to_reupload.remove((reupload_obj, legacy_url))
-                logger.info(
-                    f"Shared resource not re-uploaded. Removed {reupload_obj} at {legacy_url} from reupload list..."
-                )
-
-        else:  # it's not a shared file, upload regardless.
-            do_actual_upload(ckan, reupload_obj, legacy_url, destination, auth)
-
 
-def write_reuploads(**kwargs):
-    if kwargs["write_reuploads"] and kwargs["reuploads_path"]:
-
-        def dump_reload(to_reupload):
-            with open(kwargs["reuploads_path"], "wb") as writer:
-                pickle.dump(to_reupload, writer)
-            logger.info(f"Reuploads disk cache write completed.")
-
-        return dump_reload
-    else:
-        logger.info("Reuploads write disabled.")
+    def progress(pipeline, success, remaining_reuploads_count):
+        logger.info(
+            f"Resource Upload progress: {remaining_reuploads_count} out of {pipeline.total} to do."
+        )
 
+    def record(reupload_obj, legacy_url, success):
+        if success:
+            journal.succeeded(reupload_obj["id"])
+        else:
+            journal.failed(reupload_obj["id"])
 
-def sync_resources(
-    ckan,
-    resources,
-    resource_linkage_attrs,
-    ckan_packages,
-    auth,
-    num_threads,
-    do_uploads,
-    do_resource_checks,
-    do_delete,
-    do_single_ticket,
-    **kwargs,
-):
+    pipeline = ReuploadPipeline(
+        ckan,
+        destination,
+        auth,
+        shared_resources,
+        download_threads=download_threads,
+        upload_threads=upload_threads,
+        patch_threads=patch_threads,
+        on_progress=progress,
+        streaming=streaming,
+        on_result=record if journal is not None else None,
+        archive_info=archive_info,
+    )
+    if journal is None:
+        logger.info("%d objects to be re-uploaded" % (len(to_reupload)))
+        return pipeline.run(to_reupload)
+
+    logger.info("re-uploading from journal: {}".format(journal.counts()))
+    # enough to keep every stage of the pipeline busy
+    batch_size = REUPLOAD_BATCH_PER_THREAD * (download_threads + upload_threads)
+    remaining = []
+    while True:
+        batch = journal.claim(batch_size)
+        if not batch:
+            break
+        remaining += pipeline.run(batch)
+    return remaining
+
+
+def link_resources(resources, resource_linkage_attrs, packages, do_single_ticket):
+    """
+    wire the resources to their CKAN package. returns a dictionary of package ID to
+    the resources of that package, and a dictionary of resource ID to legacy URL.
+    """
     logger.info("checking  %d resources for synch" % (len(resources)))
     reporting_interval = determine_reporting_interval(len(resources))
     resource_linkage_package_id = {}
-    for package_obj in ckan_packages:
+    for package_obj in packages:
         linkage_tpl = tuple(
             (package_obj[t] for t in resource_linkage_attrs),
         )
@@ -396,10 +482,8 @@ def sync_resources(
             )
         resource_linkage_package_id[linkage_tpl] = package_obj["id"]
     resources_synched = 0
-    # wire the resources to their CKAN package
     resource_idx = {}
     resource_id_legacy_url = {}
-    shared_resources = {}
     for resource_linkage, legacy_url, resource_obj in resources:
         package_id = resource_linkage_package_id.get(resource_linkage)
         if do_single_ticket is None:
@@ -421,93 +505,222 @@ def sync_resources(
         if obj["id"] in resource_id_legacy_url:
             raise Exception("duplicate resource ID: {}".format(obj["id"]))
         resource_id_legacy_url[obj["id"]] = legacy_url
-        # if this is a shared resource, and not already on the list of shared resources, add it in.
-        # shared resource should be unique by md5 and filename, so use that as a key.
-        if "shared_file" in obj and obj["shared_file"]:
-            shared_linkage = obj["md5"] + "/" + obj["name"]
-            # if we haven't seen this linkage before, see if there is already a resource uploaded in CKAN
-            if (
-                shared_linkage not in shared_resources
-            ):  # we haven't seen this shared file before
-                shared_resources.setdefault(shared_linkage, []).append(
-                    {"uploaded_resource": get_uploaded_resource_from_ckan(ckan, obj)}
-                )
-            else:
-                if shared_resources[shared_linkage][0].get("uploaded_resource") is None:
-                    shared_resources[shared_linkage][0] = {
-                        "uploaded_resource": get_uploaded_resource_from_ckan(ckan, obj)
-                    }
 
         resources_synched += 1
         if resources_synched % reporting_interval == 0:
             logger.info(
                 "synced %d of %d resources" % (resources_synched, len(resources))
             )
+    return resource_idx, resource_id_legacy_url
+
+
+def is_uploaded(resource):
+    return resource is not None and resource.get("url_type") == "upload"
+
+
+def find_shared_resources(
+    ckan,
+    resource_idx,
+    resource_cache=None,
+    get_uploaded=None,
+    lookup_missing=True,
+    num_threads=8,
+):
+    """
+    for each shared file, find a resource with that file already uploaded in
+    CKAN, if any. the answer is taken from `resource_cache` (resource ID to CKAN
+    resource, see `pkgcache.index_resources`) where it holds any of the
+    resources sharing the file. for the remaining files, with `lookup_missing`
+    set, the resources are looked up in CKAN with `get_uploaded(ckan, obj)`
+    (defaulting to `resource_show`): concurrently, a round at a time, trying
+    each file's resources in turn until one is found to be uploaded.
+    """
+    if get_uploaded is None:
+        get_uploaded = get_uploaded_resource_from_ckan
+    if resource_cache is None:
+        resource_cache = {}
+    candidates = {}
+    for package_resources in resource_idx.values():
+        for obj in package_resources:
+            key = shared_linkage(obj)
+            if key is not None:
+                candidates.setdefault(key, []).append(obj)
+
+    uploaded = {}
+    # file -> the resources sharing it which are not in the cache, to look up
+    pending = {}
+    for key, objs in candidates.items():
+        cached = [resource_cache.get(obj["id"]) for obj in objs]
+        found = [t for t in cached if is_uploaded(t)]
+        uploaded[key] = found[0] if found else None
+        if not found and lookup_missing:
+            missing = [obj for obj in objs if obj["id"] not in resource_cache]
+            if missing:
+                pending[key] = missing
+    logger.info(
+        "%d shared files: %d found uploaded in the cache, %d to look up"
+        % (
+            len(candidates),
+            sum(1 for t in uploaded.values() if t is not None),
+            len(pending),
+        )
+    )
+
+    with ThreadPoolExecutor(max_workers=max(1, num_threads)) as executor:
+        while pending:
+            batch = [(key, objs.pop(0)) for key, objs in pending.items()]
+            results = executor.map(lambda t: get_uploaded(ckan, t[1]), batch)
+            for (key, _), resource in zip(batch, results):
+                if resource is not None:
+                    uploaded[key] = resource
+            pending = dict(
+                (key, objs)
+                for key, objs in pending.items()
+                if objs and uploaded[key] is None
+            )
+
+    return dict(
+        (key, [{"uploaded_resource": resource}]) for key, resource in uploaded.items()
+    )
+
 
+def sync_resources(
+    ckan,
+    resources,
+    resource_linkage_attrs,
+    ckan_packages,
+    auth,
+    num_threads,
+    do_uploads,
+    do_resource_checks,
+    do_delete,
+    do_single_ticket,
+    **kwargs,
+):
+    resource_idx, resource_id_legacy_url = link_resources(
+        resources, resource_linkage_attrs, ckan_packages, do_single_ticket
+    )
+    shared_resources = find_shared_resources(
+        ckan,
+        resource_idx,
+        resource_cache=index_resources(ckan_packages),
+        num_threads=kwargs.get("check_threads") or 8,
+    )
+
+    journal = kwargs.get("reupload_journal")
+    # shared by the checks and re-uploads, so each archive directory is listed once
+    archive_info = make_archive_info(auth, kwargs.get("archive_mirror"))
     if not do_resource_checks:
         logger.warning(
             "resource checks disabled: resource integrity will not be confirmed"
         )
         to_reupload = []
-    elif kwargs["read_reuploads"]:
-        with open(kwargs["reuploads_path"], "rb") as reader:
-            to_reupload = pickle.load(reader)
-        logger.info(f"Reuploads disk cache read completed.")
+    elif kwargs.get("read_reuploads"):
+        # the journal already holds the outstanding re-uploads
+        journal.resume()
+        to_reupload = []
     else:
         # check all existing resources on all existing packages, in parallel
-        to_reupload = check_package_resources(
-            ckan, ckan_packages, resource_id_legacy_url, auth
-        )
+        with phase("resource-checks"):
+            to_reupload = check_package_resources(
+                ckan,
+                ckan_packages,
+                resource_id_legacy_url,
+                auth,
+                kwargs.get("check_threads") or 8,
+                kwargs.get("verifier"),
+                make_ckan_archive_info(
+                    ckan, kwargs.get("s3_index"), kwargs.get("s3_inventory")
+                ),
+                archive_info,
+            )
+        if journal is not None:
+            journal.reset()
 
     logger.info(
         f"Before the package resources sync, reupload count is: {len(to_reupload)}"
     )
-    for package_obj in sorted(ckan_packages, key=lambda p: p["name"]):
-        package_id = package_obj["id"]
-        package_resources = resource_idx.get(package_id)
-        if package_resources is None:
-            logger.warning("No resources for package `%s`" % (package_id))
-            continue
-        to_reupload += sync_package_resources(
+    with phase("resource-sync"):
+        to_reupload += sync_all_resources(
             ckan,
-            package_obj,
+            ckan_packages,
+            resource_idx,
             resource_id_legacy_url,
-            package_resources,
             auth,
             do_delete,
+            kwargs.get("async_in_flight"),
         )
 
-    write_reuploads_fn = write_reuploads(**kwargs)
+    if journal is not None:
+        journal.enqueue(to_reupload)
     if do_uploads:
-        reupload_resources(
-            ckan,
-            to_reupload,
-            shared_resources,
-            auth,
-            write_reuploads_fn,
-            kwargs.get("write_reuploads_interval"),
-        )
+        with phase("reupload"):
+            to_reupload = reupload_resources(
+                ckan,
+                to_reupload,
+                shared_resources,
+                auth,
+                journal=journal,
+                download_threads=kwargs.get("download_threads") or 2,
+                upload_threads=kwargs.get("upload_threads") or num_threads,
+                patch_threads=kwargs.get("patch_threads") or 1,
+                streaming=kwargs.get("stream_reuploads", False),
+                archive_info=archive_info,
+            )
+    if journal is not None:
+        to_reupload = journal.remaining()
 
     logger.info(f"Post resource upload, resources remaining: {len(to_reupload)}")
-    if write_reuploads_fn:
-        write_reuploads_fn(to_reupload)
 
 
-def sync_metadata(
+def sync_all_resources(
     ckan,
-    meta,
+    ckan_packages,
+    resource_idx,
+    resource_id_legacy_url,
     auth,
-    num_threads,
-    do_uploads,
-    do_resource_checks,
     do_delete,
-    do_update_orgs,
-    do_single_ticket,
-    **kwargs,
+    async_in_flight=None,
 ):
-    # command line to update orgs as dev for plant pathogens:
-    # bpa-ingest sync --skip-resource-checks --metadata-only --update-orgs --verify-ssl False -u https://localhost:8443
-    #     -k [key goes here] pp-illumina-shortread
+    "sync the resources of each package, returning those to be re-uploaded"
+    to_reupload = []
+    if async_in_flight:
+        from bpaingest import aiockan
+
+        to_reupload += aiockan.run(
+            ckan,
+            async_in_flight,
+            aiockan.sync_all_package_resources,
+            ckan_packages,
+            resource_idx,
+            resource_id_legacy_url,
+            do_delete,
+        )
+    else:
+        for package_obj in sorted(ckan_packages, key=lambda p: p["name"]):
+            package_id = package_obj["id"]
+            package_resources = resource_idx.get(package_id)
+            if package_resources is None:
+                logger.warning("No resources for package `%s`" % (package_id))
+                continue
+            to_reupload += sync_package_resources(
+                ckan,
+                package_obj,
+                resource_id_legacy_url,
+                package_resources,
+                auth,
+                do_delete,
+            )
+
+    return to_reupload
+
+
+def prepare_metadata(ckan, meta, auth, do_single_ticket):
+    """
+    the packages and resources to be synced from `meta`, with duplicate packages
+    excluded, and the raw resources files built and validated
+    """
+
     def unique_packages():
         by_id = dict((t["id"], t) for t in packages)
         id_count = Counter(t["id"] for t in packages)
@@ -521,9 +734,6 @@ def sync_metadata(
                 continue
             yield by_id[k]
 
-    if do_update_orgs and hasattr(meta, "google_project_codes_meta"):
-        sync_child_organizations(ckan, meta.google_project_codes_meta)
-    organization = get_organization(ckan, meta.organization)
     packages = meta.get_packages()
     packages = list(unique_packages())
     if do_single_ticket is not None:
@@ -535,19 +745,46 @@ def sync_metadata(
 
     resources = meta.get_resources()
 
-    raw_resources_metadata = build_raw_resources_as_file(
-        logger, ckan, meta, packages, resources
-    )
-    validate_raw_resources_file_metadata(logger, raw_resources_metadata, auth)
-    ckan_packages = sync_packages(
-        ckan,
-        meta.ckan_data_type,
-        packages,
-        organization,
-        None,
-        do_delete,
-        do_single_ticket,
-    )
+    with phase("raw-resources"):
+        raw_resources_metadata = build_raw_resources_as_file(
+            logger, ckan, meta, packages, resources
+        )
+        validate_raw_resources_file_metadata(logger, raw_resources_metadata, auth)
+    return packages, resources
+
+
+def sync_metadata(
+    ckan,
+    meta,
+    auth,
+    num_threads,
+    do_uploads,
+    do_resource_checks,
+    do_delete,
+    do_update_orgs,
+    do_single_ticket,
+    **kwargs,
+):
+    # command line to update orgs as dev for plant pathogens:
+    # bpa-ingest sync --skip-resource-checks --metadata-only --update-orgs --verify-ssl False -u https://localhost:8443
+    #     -k [key goes here] pp-illumina-shortread
+    if do_update_orgs and hasattr(meta, "google_project_codes_meta"):
+        sync_child_organizations(ckan, meta.google_project_codes_meta)
+    organization = get_organization(ckan, meta.organization)
+    packages, resources = prepare_metadata(ckan, meta, auth, do_single_ticket)
+    with phase("package-sync"):
+        ckan_packages = sync_packages(
+            ckan,
+            meta.ckan_data_type,
+            packages,
+            organization,
+            None,
+            do_delete,
+            do_single_ticket,
+            num_threads=kwargs.get("sync_threads") or num_threads,
+            state_cache=kwargs.get("state_cache"),
+            async_in_flight=kwargs.get("async_in_flight"),
+        )
     sync_resources(
         ckan,
         resources,
@@ -0,0 +1,98 @@
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .metadata import ContextualRegistry, DownloadMetadata
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+
+def select_projects(slugs, patterns):
+    """
+    the slugs matching (in full) any of the regular expressions `patterns`, in
+    sorted order; all the slugs, if there are no patterns
+    """
+    if not patterns:
+        return sorted(slugs)
+    compiled = [re.compile(t) for t in patterns]
+    return sorted(s for s in slugs if any(r.fullmatch(s) for r in compiled))
+
+
+def split_budget(workers, projects):
+    "the workers each of `projects` concurrent projects is given, at least one"
+    return max(1, workers // max(1, projects))
+
+
+def sync_projects(
+    project_classes,
+    sync_project,
+    download_path=None,
+    max_projects=4,
+    workers=16,
+    refresh=False,
+    store=None,
+    mirror_path=None,
+):
+    """
+    sync several projects in this process, up to `max_projects` at a time, by
+    calling `sync_project(slug, dlmeta, num_threads)` for each. `workers` is
+    divided between the projects running at once. contextual metadata is
+    fetched once and shared between projects, as are the tracking sheets (see
+    `tracking.track_registry`); whatever is shared between the projects'
+    syncs (the CKAN client, and caches) is up to `sync_project`. `refresh`,
+    `store` and `mirror_path` are passed on to `DownloadMetadata`.
+
+    `project_classes` maps each slug to its project class. returns a dict of
+    slug to None, or the exception which ended the sync of that project.
+    """
+    concurrent = min(max_projects, len(project_classes)) or 1
+    num_threads = split_budget(workers, concurrent)
+    logger.info(
+        "syncing %d projects, %d at a time, with %d workers each"
+        % (len(project_classes), concurrent, num_threads)
+    )
+    if download_path is not None:
+        contextual_path = os.path.join(download_path, "contextual")
+        os.makedirs(contextual_path, exist_ok=True)
+    else:
+        contextual_path = tempfile.mkdtemp(prefix="bpaingest-contextual-")
+    contextual_registry = ContextualRegistry(contextual_path)
+
+    def sync_one(slug):
+        project_logger = make_logger(slug)
+        start = time.perf_counter()
+        try:
+            with DownloadMetadata(
+                project_logger,
+                project_classes[slug],
+                path=os.path.join(download_path, slug) if download_path else None,
+                contextual_registry=contextual_registry,
+                refresh=refresh,
+                store=store,
+                mirror_path=mirror_path,
+            ) as dlmeta:
+                sync_project(slug, dlmeta, num_threads)
+        except Exception as e:
+            project_logger.error("sync failed: %s" % (e), exc_info=True)
+            return e
+        project_logger.info("sync complete (%.1fs)" % (time.perf_counter() - start))
+        return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrent) as executor:
+            results = dict(
+                zip(project_classes, executor.map(sync_one, project_classes))
+            )
+    finally:
+        if download_path is None:
+            shutil.rmtree(contextual_path)
+    failed = sorted(slug for slug, e in results.items() if e is not None)
+    if failed:
+        logger.error(
+            "%d projects failed to sync: %s" % (len(failed), ", ".join(failed))
+        )
+    return results
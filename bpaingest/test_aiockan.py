@@ -0,0 +1,166 @@
+import asyncio
+import json
+
+import pytest
+
+from . import aiockan
+from .aiockan import AsyncCKAN
+from .test_sync import make_packages
+
+
+class FakeAsyncCKAN(AsyncCKAN):
+    """
+    an `AsyncCKAN` whose requests are answered from memory. writes to a
+    package are tracked, so that overlapping writes can be caught.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__("http://ckan.invalid", backoff_base=0, **kwargs)
+        self.packages = {}
+        self.calls = []
+        self.failures = []
+        self.writing = set()
+        self.overlapping_writes = 0
+        self.peak_in_flight = 0
+        self._active = 0
+
+    async def __aenter__(self):
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def _package(self, id):
+        for obj in self.packages.values():
+            if id in (obj["id"], obj["name"]):
+                return obj
+
+    async def _post(self, url, data, headers):
+        action = url.rsplit("/", 1)[-1]
+        data = json.loads(data)
+        self.calls.append(action)
+        if self.failures:
+            return self.failures.pop(0), "<html>busy</html>"
+        package_id = data.get("package_id") or data.get("id")
+        write = action.endswith(("_create", "_patch")) and action.startswith("resource")
+        if write:
+            if package_id in self.writing:
+                self.overlapping_writes += 1
+            self.writing.add(package_id)
+        self._active += 1
+        self.peak_in_flight = max(self.peak_in_flight, self._active)
+        await asyncio.sleep(0.001)
+        self._active -= 1
+        if write:
+            self.writing.discard(package_id)
+        result = self._dispatch(action, data)
+        if result is None:
+            body = {"success": False, "error": {"__type": "Not Found Error"}}
+            return 404, json.dumps(body)
+        return 200, json.dumps({"success": True, "result": result})
+
+    def _dispatch(self, action, data):
+        if action == "package_show":
+            return self._package(data["id"])
+        if action == "package_create":
+            obj = dict(data, state="active", tags=[], resources=[])
+            self.packages[obj["id"]] = obj
+            return obj
+        if action == "package_patch":
+            self.packages[data["id"]].update(data)
+            return self.packages[data["id"]]
+        if action == "resource_create":
+            self.packages[data["package_id"]]["resources"].append(dict(data))
+            return data
+        if action == "resource_patch":
+            for package in self.packages.values():
+                for resource in package["resources"]:
+                    if resource["id"] == data["id"]:
+                        resource.update(data)
+                        return resource
+
+
+def run(ckan, coro_fn, *args):
+    async def _run():
+        async with ckan:
+            return await coro_fn(ckan, *args)
+
+    return asyncio.run(_run())
+
+
+def targets(n):
+    return [dict(t, owner_org="org") for t in make_packages(n)]
+
+
+def test_sync_packages():
+    ckan = FakeAsyncCKAN(max_in_flight=20)
+    to_sync = targets(100)
+    synced = run(ckan, aiockan.sync_packages, to_sync, {})
+    assert [t["id"] for t in synced] == [t["id"] for t in to_sync]
+    assert ckan.peak_in_flight == 20
+
+    # with the fingerprint recorded, a second sync only reads
+    ckan.calls = []
+    to_sync[3]["title"] = "changed"
+    cache = dict((t["id"], t) for t in synced)
+    synced = run(ckan, aiockan.sync_packages, to_sync, cache)
+    assert ckan.calls == ["package_patch"]
+    assert synced[3]["title"] == "changed"
+
+
+def test_retry_throttled():
+    ckan = FakeAsyncCKAN()
+    ckan.failures = [429, 503]
+    synced = run(ckan, aiockan.sync_packages, targets(1), {})
+    assert ckan.calls[:3] == ["package_show"] * 3
+    assert synced[0]["id"] == "pkg-0000"
+
+
+def test_sync_package_resources():
+    ckan = FakeAsyncCKAN()
+    to_sync = targets(4)
+    ckan_packages = run(ckan, aiockan.sync_packages, to_sync, {})
+    resource_idx = {}
+    legacy_urls = {}
+    for package in ckan_packages:
+        resource_idx[package["id"]] = []
+        for i in range(5):
+            resource_id = "%s-res-%d" % (package["id"], i)
+            resource_idx[package["id"]].append(
+                {"id": resource_id, "package_id": package["id"], "name": "r%d" % i}
+            )
+            legacy_urls[resource_id] = "https://archive.invalid/%s" % resource_id
+    ckan.calls = []
+    to_reupload = run(
+        ckan,
+        aiockan.sync_all_package_resources,
+        ckan_packages,
+        resource_idx,
+        legacy_urls,
+        False,
+    )
+    assert sorted(url for _, url in to_reupload) == sorted(legacy_urls.values())
+    assert sum(len(t["resources"]) for t in ckan.packages.values()) == 20
+    # created with their fingerprints, so no patches follow the creates
+    assert "resource_patch" not in ckan.calls
+    # packages are worked on together, but each package's writes are in turn
+    assert ckan.peak_in_flight > 1
+    assert ckan.overlapping_writes == 0
+
+
+def test_sync_package_resources_duplicate_ids():
+    ckan = FakeAsyncCKAN()
+    (package,) = run(ckan, aiockan.sync_packages, targets(1), {})
+    resource = {"id": "res", "package_id": package["id"], "name": "r"}
+    ckan.calls = []
+    with pytest.raises(Exception, match="duplicate resource IDs"):
+        run(
+            ckan,
+            aiockan.sync_package_resources,
+            package,
+            {"res": "https://archive.invalid/res"},
+            [resource, dict(resource)],
+            False,
+        )
+    assert ckan.calls == []
@@ -0,0 +1,100 @@
+from .libs.fetch_data import parse_autoindex
+from .ops import (
+    ApacheArchiveIndex,
+    LocalMirrorArchiveInfo,
+    download_legacy_file,
+    remove_legacy_download,
+)
+
+TABLE_LISTING = b"""
+<html><body><h1>Index of /bpa/ticket-1</h1><table>
+<tr><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=S;O=A">Size</a></th></tr>
+<tr><td><a href="/bpa/">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td></tr>
+<tr><td><a href="reads_R1.fastq.gz">reads_R1.fastq.gz</a></td><td align="right">2019-05-01 10:00  </td><td align="right">1234</td></tr>
+<tr><td><a href="reads%20R2.fastq.gz">reads R2.fastq.gz</a></td><td align="right">2019-05-01 10:00  </td><td align="right">1.2G</td></tr>
+<tr><td><a href="sub/">sub/</a></td><td align="right">2019-05-01 10:00  </td><td align="right">  - </td></tr>
+</table></body></html>
+"""
+
+PRE_LISTING = b"""
+<html><body><pre><a href="?C=N;O=D">Name</a>  <a href="?C=M;O=A">Last modified</a>
+<hr><a href="/bpa/">Parent Directory</a>                             -
+<a href="a.md5">a.md5</a>                 2019-05-01 10:00  88
+<a href="b.xlsx">b.xlsx</a>                2019-05-01 10:00   12K
+</pre></body></html>
+"""
+
+
+def test_parse_autoindex():
+    assert parse_autoindex(TABLE_LISTING) == {
+        "reads_R1.fastq.gz": 1234,
+        "reads%20R2.fastq.gz": None,
+        "sub/": None,
+    }
+    assert parse_autoindex(PRE_LISTING) == {"a.md5": 88, "b.xlsx": None}
+
+
+class Response:
+    def __init__(self, status_code, headers=None, content=b""):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = content
+
+
+class ArchiveSession:
+    "the ticket directory is a symlink, redirected to where the data lives"
+
+    def __init__(self):
+        self.requests = []
+
+    def head(self, url, auth=None, headers=None):
+        self.requests.append(("HEAD", url))
+        if url == "https://archive.invalid/bpa/ticket-1/":
+            return Response(301, {"location": "https://archive.invalid/store/t1/"})
+        if url == "https://archive.invalid/store/t1/reads%20R2.fastq.gz":
+            return Response(200, {"content-length": "1288490188"})
+        return Response(200)
+
+    def get(self, url, auth=None):
+        self.requests.append(("GET", url))
+        assert url == "https://archive.invalid/store/t1/"
+        return Response(200, content=TABLE_LISTING)
+
+
+def test_apache_archive_index():
+    info = ApacheArchiveIndex(None)
+    session = info._local.session = ArchiveSession()
+    base = "https://archive.invalid/bpa/ticket-1/"
+    assert info.get_size(base + "reads_R1.fastq.gz") == 1234
+    assert (
+        info.resolve_url(base + "reads_R1.fastq.gz")
+        == "https://archive.invalid/store/t1/reads_R1.fastq.gz"
+    )
+    # the listing only gives a rounded size, so this one costs a HEAD
+    assert info.get_size(base + "reads%20R2.fastq.gz") == 1288490188
+    assert session.requests == [
+        ("HEAD", base),
+        ("HEAD", "https://archive.invalid/store/t1/"),
+        ("GET", "https://archive.invalid/store/t1/"),
+        ("HEAD", "https://archive.invalid/store/t1/reads%20R2.fastq.gz"),
+    ]
+
+
+def test_local_mirror_archive_info(tmpdir):
+    ticket = tmpdir.mkdir("store").mkdir("t1")
+    ticket.join("reads R2.fastq.gz").write("ACGT" * 100)
+    tmpdir.join("ticket-1").mksymlinkto(ticket)
+    info = LocalMirrorArchiveInfo(str(tmpdir))
+    url = "https://archive.invalid/bpa/ticket-1/reads%20R2.fastq.gz"
+    assert info.get_size(url) == 400
+    assert info.resolve_url(url) == str(ticket.join("reads R2.fastq.gz"))
+    assert info.resolve_url(url.replace("R2", "R3")) is None
+    assert info.range_reader(info.resolve_url(url))(4, 4) == b"ACGT"
+
+    tempdir, path = download_legacy_file(url, None, archive_info=info)
+    try:
+        with open(path) as fd:
+            assert fd.read() == "ACGT" * 100
+    finally:
+        remove_legacy_download(tempdir, path)
+    assert ticket.join("reads R2.fastq.gz").check()
@@ -0,0 +1,82 @@
+import datetime
+
+from . import sync
+from .checkcache import CheckResultCache, ResourceVerifier, VERIFIED_AT_FIELD
+from .sync import check_resources
+
+
+class FakeArchiveInfo:
+    def __init__(self, *args):
+        pass
+
+    def get_size_and_etag(self, url):
+        return 10, '"etag"'
+
+
+class PatchCKAN:
+    address = "http://ckan.invalid"
+
+    def __init__(self):
+        self.patches = []
+        self.action = self
+
+    def resource_patch(self, **kwargs):
+        self.patches.append(kwargs)
+        return dict(kwargs, metadata_modified="2024-03-01T00:00:00.000000")
+
+
+def make_resources(n):
+    return [
+        {
+            "id": "res-%d" % i,
+            "package_id": "pkg-%d" % (i % 2),
+            "url": "http://ckan.invalid/res-%d" % i,
+            "metadata_modified": "2024-01-01T00:00:00.000000",
+        }
+        for i in range(n)
+    ]
+
+
+def run_checks(monkeypatch, ckan, resources, verifier):
+    checked = []
+
+    def fake_check(ckan_info, apache_info, current_url, legacy_url, etags):
+        checked.append(current_url)
+        return None
+
+    monkeypatch.setattr(sync, "check_resource", fake_check)
+    monkeypatch.setattr(sync, "CKANArchiveInfo", FakeArchiveInfo)
+    assert check_resources(ckan, resources, {}, None, 4, verifier) == []
+    return checked
+
+
+def test_skip_unmodified(tmp_path, monkeypatch):
+    cache = CheckResultCache(str(tmp_path / "checks.sqlite"))
+    ckan = PatchCKAN()
+    resources = make_resources(4)
+    verifier = ResourceVerifier(cache=cache, skip_unmodified=True, write_ckan=True)
+    assert len(run_checks(monkeypatch, ckan, resources, verifier)) == 4
+    assert sorted(t["id"] for t in ckan.patches) == [t["id"] for t in resources]
+    assert ckan.patches[0]["s3_verified_size"] == 10
+    assert ckan.patches[0]["s3_verified_etag"] == "etag"
+    assert cache.get("res-0")["etag"] == '"etag"'
+
+    # CKAN hands the resources back with the metadata_modified of our patch
+    for resource in resources:
+        resource["metadata_modified"] = "2024-03-01T00:00:00.000000"
+    resources[2]["metadata_modified"] = "2024-04-01T00:00:00.000000"
+    resources[3]["url"] = "http://ckan.invalid/moved"
+    ckan.patches = []
+    checked = run_checks(monkeypatch, ckan, resources, verifier)
+    assert sorted(checked) == sorted([resources[2]["url"], resources[3]["url"]])
+
+
+def test_verified_within():
+    now = datetime.datetime(2024, 5, 1, 12, 0, 0)
+    verifier = ResourceVerifier(max_age=datetime.timedelta(hours=24))
+    resource = {"id": "res", "url": "http://ckan.invalid/res"}
+    assert not verifier.is_fresh(resource, now)
+    resource[VERIFIED_AT_FIELD] = "2024-04-30T13:00:00"
+    assert verifier.is_fresh(resource, now)
+    resource[VERIFIED_AT_FIELD] = "2024-04-29T13:00:00"
+    assert not verifier.is_fresh(resource, now)
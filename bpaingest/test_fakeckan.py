@@ -0,0 +1,53 @@
+import ckanapi
+import pytest
+
+from . import scheduler
+from .benchmark import run_benchmark
+from .fakeckan import FakeCKANServer
+from .scheduler import CKANScheduler
+
+
+@pytest.fixture
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(
+        scheduler, "_scheduler", CKANScheduler(min_rate=1000, backoff_base=0.001)
+    )
+
+
+def test_fake_ckan_actions():
+    with FakeCKANServer() as server:
+        ckan = ckanapi.RemoteCKAN(server.url)
+        package = ckan.action.package_create(id="p1", name="bpa-p1", type="t")
+        assert package["resources"] == []
+        resource = ckan.action.resource_create(package_id="bpa-p1", id="r1", name="a")
+        ckan.action.resource_patch(id=resource["id"], size="10")
+        assert ckan.action.package_show(id="p1")["resources"][0]["size"] == "10"
+        with pytest.raises(ckanapi.errors.NotFound):
+            ckan.action.package_show(id="missing")
+        with pytest.raises(ckanapi.errors.ValidationError):
+            ckan.action.package_create(id="p2", name="bpa-p1")
+        assert ckan.action.package_search(q="type:t")["count"] == 1
+
+
+def test_benchmark(tmp_path, fast_retries):
+    results = dict(
+        (t["phase"], t)
+        for t in run_benchmark(4, 3, num_threads=4, mirror_path=str(tmp_path))
+    )
+    assert results["sync"]["calls"]["resource_create"] == 12
+    # resources are created with their fingerprint, so aren't patched after
+    assert "resource_patch" not in results["sync"]["calls"]
+    # nothing has changed, so the second sync makes no writes
+    assert set(results["resync"]["calls"]) == {"organization_show", "package_search"}
+    assert results["genhash"]["calls"]["resource_patch"] == 12
+    # every check passes without reference to CKAN beyond the package search
+    assert "resource_patch" not in results["check"]["calls"]
+
+
+def test_benchmark_throttled(fast_retries):
+    results = run_benchmark(
+        4, 3, error_rate=0.2, error_status=429, phases=("sync",), seed=1
+    )
+    # some calls were refused, and retried
+    assert sum(scheduler.get_scheduler().retry_stats.values()) > 0
+    assert results[0]["calls"]["resource_create"] == 12
@@ -0,0 +1,138 @@
+import os
+import pickle
+import socket
+import subprocess
+import sys
+
+from .journal import ReuploadJournal, worker_is_dead
+from .sync import reupload_resources
+from .test_reupload import RecordingCKAN, make_reuploads, patch_stages
+
+
+def test_journal_workers_do_not_share_work(tmp_path):
+    path = str(tmp_path / "reuploads.sqlite")
+    to_reupload = make_reuploads(10)
+    first = ReuploadJournal(path, worker="first")
+    first.enqueue(to_reupload)
+    second = ReuploadJournal(path, worker="second")
+
+    a = first.claim(4)
+    b = second.claim(4)
+    c = first.claim(4)
+    claimed = [t[0]["id"] for t in a + b + c]
+    assert claimed == [t[0]["id"] for t in to_reupload]
+    assert first.claim(4) == []
+
+    for resource, _ in a + c:
+        first.succeeded(resource["id"])
+    second.failed(b[0][0]["id"])
+    # a worker can only finish its own claims
+    first.succeeded(b[1][0]["id"])
+    assert first.counts() == {"done": 6, "failed": 1, "running": 3}
+    first.close()
+
+    # after a crash, the journal is reopened and failures are retried
+    journal = ReuploadJournal(path, worker="third", lease=0)
+    journal.resume()
+    assert [t[0]["id"] for t in journal.remaining()] == [t[0]["id"] for t in b]
+    # claims held by `second` have outlived the (zero) lease
+    assert sorted(t[0]["id"] for t in journal.claim(10)) == sorted(
+        t[0]["id"] for t in b
+    )
+
+
+def test_journal_resume_dead_worker(tmp_path):
+    path = str(tmp_path / "reuploads.sqlite")
+    to_reupload = make_reuploads(4)
+    # a worker on this host which has since exited, and one elsewhere
+    exited = subprocess.Popen([sys.executable, "-c", "pass"])
+    exited.wait()
+    dead_worker = "%s:%d" % (socket.gethostname(), exited.pid)
+    assert worker_is_dead(dead_worker)
+    assert not worker_is_dead("elsewhere.invalid:1")
+    dead = ReuploadJournal(path, worker=dead_worker)
+    dead.enqueue(to_reupload)
+    dead.claim(2)
+    dead.close()
+    elsewhere = ReuploadJournal(path, worker="elsewhere.invalid:1")
+    elsewhere.claim(1)
+    elsewhere.close()
+
+    journal = ReuploadJournal(path)
+    journal.resume()
+    assert journal.counts() == {"pending": 3, "running": 1}
+    assert [t[0]["id"] for t in journal.claim(10)] == [
+        to_reupload[i][0]["id"] for i in (0, 1, 3)
+    ]
+
+
+def test_journal_renews_claims(tmp_path):
+    path = str(tmp_path / "reuploads.sqlite")
+    first = ReuploadJournal(path, worker="first", lease=60)
+    first.enqueue(make_reuploads(2))
+    (held, _), (finished, _) = first.claim(2)
+    first.succeeded(finished["id"])
+    # the claim would have lapsed, but is renewed while the transfer runs
+    first._conn.execute("UPDATE reuploads SET updated_at = 0")
+    first.renew()
+    second = ReuploadJournal(path, worker="second", lease=60)
+    assert second.claim(2) == []
+    # a result for a claim which has been handed on is not recorded
+    second._conn.execute("UPDATE reuploads SET updated_at = 0")
+    assert [t[0]["id"] for t in second.claim(2)] == [held["id"]]
+    first.succeeded(held["id"])
+    assert second.counts() == {"done": 1, "running": 1}
+    first.close()
+    second.close()
+
+
+def test_journal_reset_keeps_live_claims(tmp_path):
+    path = str(tmp_path / "reuploads.sqlite")
+    to_reupload = make_reuploads(4)
+    other = ReuploadJournal(path, worker="elsewhere.invalid:1")
+    other.enqueue(to_reupload)
+    (held, _), (finished, _) = other.claim(2)
+    other.succeeded(finished["id"])
+
+    journal = ReuploadJournal(path)
+    journal.reset()
+    assert journal.counts() == {"running": 1}
+    # the other worker can still record its result
+    other.succeeded(held["id"])
+    assert journal.counts() == {"done": 1}
+    other.close()
+    journal.close()
+
+
+def test_journal_import_legacy_dump(tmp_path):
+    to_reupload = make_reuploads(3)
+    with open(str(tmp_path / "reupload_resources.dump"), "wb") as fd:
+        pickle.dump(to_reupload, fd)
+    journal = ReuploadJournal(str(tmp_path / "reuploads.sqlite"))
+    journal.import_legacy_dump()
+    assert journal.remaining() == to_reupload
+    assert os.listdir(str(tmp_path)).count("reupload_resources.dump") == 0
+    # imported only once
+    journal.import_legacy_dump()
+    assert journal.counts() == {"pending": 3}
+    journal.close()
+
+
+def test_reupload_resources_from_journal(tmp_path, monkeypatch):
+    to_reupload = make_reuploads(20)
+    uploads = patch_stages(monkeypatch, fail_urls=(to_reupload[5][1],))
+    journal = ReuploadJournal(str(tmp_path / "reuploads.sqlite"))
+    journal.enqueue(to_reupload)
+    remaining = reupload_resources(
+        RecordingCKAN(),
+        None,
+        {},
+        None,
+        journal=journal,
+        download_threads=1,
+        upload_threads=1,
+    )
+    assert remaining == [to_reupload[5]]
+    assert len(uploads) == 19
+    assert journal.counts() == {"done": 19, "failed": 1}
+    assert journal.remaining() == [to_reupload[5]]
@@ -0,0 +1,51 @@
+import os
+
+from .libs.fetch_data import Fetcher
+from .libs.test_libs import serve_directory
+from .metastore import MetadataStore
+from .util import make_logger
+
+logger = make_logger(__name__)
+
+
+def test_metadata_store(tmpdir):
+    archive = tmpdir.mkdir("archive")
+    archive.mkdir("contextual").join("samples.xlsx").write("v1")
+    server = serve_directory(str(archive))
+    url = "http://127.0.0.1:%d/" % (server.server_address[1])
+    store_path = str(tmpdir.join("store"))
+
+    def fetch(store, slug):
+        target = tmpdir.join(slug)
+        Fetcher(logger, str(target), url, store=store).fetch_metadata_from_folder(
+            None, {}, []
+        )
+        return target.join("samples.xlsx")
+
+    try:
+        store = MetadataStore(store_path)
+        amd, omg = fetch(store, "amd"), fetch(store, "omg")
+        assert (store.downloaded, store.reused) == (1, 1)
+        assert amd.read() == omg.read() == "v1"
+        assert os.path.samefile(str(amd), str(omg))
+        store.close()
+
+        # a later run revalidates the stored file, rather than downloading it
+        store = MetadataStore(store_path)
+        fetch(store, "amd")
+        assert (store.downloaded, store.reused) == (0, 1)
+        store.close()
+
+        changed = archive.join("contextual", "samples.xlsx")
+        changed.write("v2")
+        mtime = changed.mtime() + 10
+        os.utime(str(changed), (mtime, mtime))
+        store = MetadataStore(store_path)
+        assert fetch(store, "amd").read() == "v2"
+        assert store.downloaded == 1
+        # other views are untouched until they are next fetched
+        assert omg.read() == "v1"
+        store.close()
+    finally:
+        server.shutdown()
+        server.server_close()
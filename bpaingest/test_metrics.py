@@ -0,0 +1,55 @@
+import json
+
+from .metrics import LATENCY_BUCKETS, Histogram, Metrics, MetricsWriter
+from .scheduler import CKANScheduler
+from .test_scheduler import Flaky, http_error
+
+
+def test_histogram_quantiles():
+    histogram = Histogram(LATENCY_BUCKETS)
+    assert histogram.quantile(0.5) is None
+    for _ in range(90):
+        histogram.observe(0.02)
+    for _ in range(10):
+        histogram.observe(3.0)
+    assert 0.01 < histogram.quantile(0.5) <= 0.025
+    assert 2.5 < histogram.quantile(0.95) <= 5.0
+    assert histogram.as_dict()["count"] == 100
+    histogram.observe(1000.0)
+    assert histogram.quantile(1.0) == LATENCY_BUCKETS[-1]
+
+
+def test_scheduler_records_latency_and_retries(monkeypatch):
+    from . import scheduler
+
+    metrics = Metrics()
+    monkeypatch.setattr(scheduler, "metrics", metrics)
+    fn = Flaky(http_error(503))
+    CKANScheduler(backoff_base=0.001).call("package_show", fn, id="x")
+    d = metrics.as_dict()
+    assert d["ckan_calls"]["package_show"]["count"] == 2
+    assert d["ckan_errors"] == {"package_show/server-error": 1}
+    assert d["ckan_retries"] == {"package_show/server-error": 1}
+
+
+def test_write(tmpdir):
+    metrics = Metrics()
+    metrics.observe_call("resource", "patch", 0.2)
+    metrics.add_transfer("uploaded", 4096)
+    metrics.count_check("wrong-size")
+    metrics.count_check("ok")
+    json_path, prom_path = str(tmpdir / "metrics.json"), str(tmpdir / "metrics.prom")
+    with MetricsWriter(metrics, json_path, prom_path, interval=0):
+        pass
+    with open(json_path) as fd:
+        d = json.load(fd)
+    assert d["transfer_bytes"] == {"uploaded": 4096}
+    assert d["resource_checks"] == {"ok": 1, "wrong-size": 1}
+    with open(prom_path) as fd:
+        prom = fd.read()
+    assert (
+        'bpaingest_ckan_call_seconds_count{method="patch",object_type="resource"} 1'
+        in prom
+    )
+    assert 'bpaingest_resource_checks_total{outcome="wrong-size"} 1' in prom
+    assert 'bpaingest_reupload_bytes_bucket{direction="uploaded",le="+Inf"} 1' in prom
@@ -0,0 +1,198 @@
+import threading
+import time
+
+import ckanapi
+
+from .plan import Plan, make_plan, apply_plan, run_actions
+
+
+class PlanCKAN:
+    "in-memory CKAN holding packages with their resources"
+
+    address = "http://ckan.invalid"
+
+    def __init__(self, packages):
+        self.packages = dict((t["id"], t) for t in packages)
+        self.calls = []
+        self.action = self
+
+    def __getattr__(self, name):
+        def call(**kwargs):
+            self.calls.append((name, kwargs.get("id")))
+            return getattr(self, "_" + name)(**kwargs)
+
+        return call
+
+    def _organization_show(self, id):
+        return {"id": "org-" + id, "name": id}
+
+    def _package_search(self, q, include_private, rows, start=0, sort=None):
+        typ = q.split(":", 1)[1]
+        matches = sorted(
+            (t for t in self.packages.values() if t["type"] == typ),
+            key=lambda t: t["id"],
+        )
+        return {"count": len(matches), "results": matches[start : start + rows]}
+
+    def _package_show(self, id):
+        for obj in self.packages.values():
+            if id in (obj["id"], obj["name"]):
+                return obj
+        raise ckanapi.errors.NotFound
+
+    def _package_create(self, **kwargs):
+        obj = dict(kwargs, state="active", tags=[], resources=[])
+        self.packages[obj["id"]] = obj
+        return obj
+
+    def _package_patch(self, **kwargs):
+        self.packages[kwargs["id"]].update(kwargs)
+        return self.packages[kwargs["id"]]
+
+    def _package_delete(self, id):
+        del self.packages[id]
+
+    def _resource_create(self, **kwargs):
+        self.packages[kwargs["package_id"]]["resources"].append(kwargs)
+        return dict(kwargs, url_type="")
+
+    def _resource_patch(self, **kwargs):
+        for pkg in self.packages.values():
+            for resource in pkg["resources"]:
+                if resource["id"] == kwargs["id"]:
+                    resource.update(kwargs)
+                    return resource
+
+    def _resource_delete(self, id):
+        for pkg in self.packages.values():
+            pkg["resources"] = [t for t in pkg["resources"] if t["id"] != id]
+
+
+def make_package(sample_id, **kwargs):
+    return dict(
+        {
+            "id": "pkg-" + sample_id,
+            "name": "bpa-" + sample_id,
+            "type": "test-type",
+            "sample_id": sample_id,
+            "private": True,
+            "resource_permissions": "",
+            "access_control_reason": "",
+            "access_control_date": "",
+            "access_control_mode": "",
+            "tags": [],
+        },
+        **kwargs
+    )
+
+
+class FakeMeta:
+    organization = "test-org"
+    ckan_data_type = "test-type"
+    resource_linkage = ("sample_id",)
+
+    def get_packages(self):
+        return [make_package("a", title="changed"), make_package("b")]
+
+    def get_resources(self):
+        return [
+            (("a",), "http://archive.invalid/a1", {"id": "res-a1", "name": "a1"}),
+            (("b",), "http://archive.invalid/b1", {"id": "res-b1", "name": "b1"}),
+        ]
+
+
+def extant_ckan():
+    package = dict(
+        make_package("a", owner_org="org-test-org"),
+        resources=[
+            {"id": "res-a1", "name": "a1", "package_id": "pkg-a"},
+            {"id": "res-a2", "name": "a2", "package_id": "pkg-a"},
+        ],
+    )
+    stale = dict(make_package("z"), resources=[])
+    return PlanCKAN([package, stale])
+
+
+def test_plan_and_apply(tmp_path):
+    ckan = extant_ckan()
+    plan = make_plan(ckan, FakeMeta(), None, "test-project", False, True, None)
+    # planning makes no changes
+    assert all(name.endswith(("_show", "_search")) for name, _ in ckan.calls)
+
+    by_kind = dict((t["action"], t) for t in plan.actions)
+    assert sorted(plan.summary().items()) == [
+        ("package_create", 1),
+        ("package_delete", 1),
+        ("package_patch", 1),
+        ("resource_create", 1),
+        ("resource_delete", 1),
+        ("resource_patch", 1),
+        ("reupload", 1),
+    ]
+    assert by_kind["package_delete"]["object"]["id"] == "pkg-z"
+    # resources wait for their package, and for each other
+    create = by_kind["resource_create"]
+    assert create["depends"] == [by_kind["package_create"]["id"]]
+    assert by_kind["reupload"]["depends"] == [create["id"]]
+    assert by_kind["resource_delete"]["depends"] == [by_kind["package_patch"]["id"]]
+    assert by_kind["resource_patch"]["depends"] == [by_kind["resource_delete"]["id"]]
+
+    path = str(tmp_path / "plan.json")
+    plan.write(path)
+    plan = Plan.read(path)
+    remaining = apply_plan(ckan, plan, None, 4, False)
+    assert [t[0]["id"] for t in remaining] == ["res-b1"]
+    assert sorted(ckan.packages) == ["pkg-a", "pkg-b"]
+    assert ckan.packages["pkg-a"]["title"] == "changed"
+    assert [t["id"] for t in ckan.packages["pkg-a"]["resources"]] == ["res-a1"]
+    assert [t["id"] for t in ckan.packages["pkg-b"]["resources"]] == ["res-b1"]
+
+    # once applied, there is nothing left to do
+    plan = make_plan(ckan, FakeMeta(), None, "test-project", False, True, None)
+    assert plan.actions == []
+
+
+def test_run_actions_order():
+    actions = [
+        {"id": 0, "action": "test", "depends": []},
+        {"id": 1, "action": "test", "depends": [0]},
+        {"id": 2, "action": "test", "depends": []},
+        {"id": 3, "action": "test", "depends": [1, 2]},
+        {"id": 4, "action": "test", "depends": []},
+        {"id": 5, "action": "test", "depends": [4]},
+    ]
+    finished = []
+    lock = threading.Lock()
+
+    def execute(action):
+        time.sleep(0.01)
+        if action["id"] == 4:
+            raise Exception("failed")
+        with lock:
+            finished.append(action["id"])
+        return action["id"]
+
+    results, failed = run_actions(actions, execute, 4)
+    assert failed == {4, 5}
+    assert sorted(results) == [0, 1, 2, 3]
+    assert finished.index(0) < finished.index(1) < finished.index(3)
+    assert finished.index(2) < finished.index(3)
+
+
+def test_run_actions_long_chain_failure():
+    # a package's resource changes form one chain; a failure near its start
+    # skips everything after it
+    length = 5000
+    actions = [
+        {"id": i, "action": "test", "depends": [i - 1] if i else []}
+        for i in range(length)
+    ]
+
+    def execute(action):
+        if action["id"] == 1:
+            raise Exception("failed")
+        return action["id"]
+
+    results, failed = run_actions(actions, execute, 4)
+    assert results == {0: 0}
+    assert failed == set(range(1, length))
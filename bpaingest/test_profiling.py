@@ -0,0 +1,92 @@
+import json
+import os
+import pstats
+import threading
+import time
+
+from .profiling import PhaseProfiler, profiler
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def idle(seconds):
+    time.sleep(seconds)
+
+
+def test_disabled():
+    assert not profiler.enabled
+    with profiler.phase("sync"):
+        pass
+    assert "sync" not in profiler.timings
+
+
+def test_timings(tmpdir):
+    phases = PhaseProfiler()
+    phases.configure(output_path=str(tmpdir))
+    for _ in range(2):
+        with phases.phase("get-packages"):
+            busy(0.01)
+    count, wall, cpu = phases.timings["get-packages"]
+    assert count == 2
+    assert wall >= 0.02
+    phases.finish()
+    with open(os.path.join(str(tmpdir), "phases.json")) as fd:
+        assert json.load(fd)["get-packages"]["count"] == 2
+
+
+def test_cprofile(tmpdir):
+    phases = PhaseProfiler()
+    phases.configure("cprofile", str(tmpdir))
+    with phases.phase("outer"):
+        idle(0.01)
+        with phases.phase("inner"):
+            busy(0.01)
+        idle(0.01)
+    phases.finish()
+    # each phase has its own profile, without the time spent in nested phases
+    assert sorted(os.listdir(str(tmpdir))) == [
+        "inner.prof",
+        "outer.prof",
+        "phases.json",
+    ]
+
+    def functions(name):
+        stats = pstats.Stats(os.path.join(str(tmpdir), name + ".prof"))
+        return set(fn for (_, _, fn) in stats.stats)
+
+    assert "busy" in functions("inner")
+    assert "busy" not in functions("outer")
+    assert "idle" in functions("outer")
+
+
+def test_cprofile_other_thread(tmpdir):
+    phases = PhaseProfiler()
+    phases.configure("cprofile", str(tmpdir))
+
+    def work():
+        with phases.phase("worker"):
+            busy(0.01)
+
+    with phases.phase("outer"):
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+    phases.finish()
+    # the worker's phase is timed, but only one thread is profiled at once
+    assert phases.timings["worker"][0] == 1
+    assert sorted(os.listdir(str(tmpdir))) == ["outer.prof", "phases.json"]
+
+
+def test_sample(tmpdir):
+    phases = PhaseProfiler()
+    phases.configure("sample", str(tmpdir), interval=0.001)
+    with phases.phase("resource-checks"):
+        busy(0.05)
+    phases.finish()
+    with open(os.path.join(str(tmpdir), "resource-checks.folded")) as fd:
+        folded = fd.read()
+    assert "busy (test_profiling.py" in folded
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import threading
+import time
+
+from . import reupload
+from .reupload import ReuploadPipeline
+
+
+class RecordingCKAN:
+    address = "http://ckan.invalid"
+
+    def __init__(self):
+        self.updates = []
+        self.action = self
+
+    def resource_update(self, **kwargs):
+        self.updates.append(kwargs)
+        return kwargs
+
+
+def patch_stages(monkeypatch, fail_urls=(), delay=0.0):
+    uploads = []
+    lock = threading.Lock()
+
+    def fake_download(legacy_url, auth, **kwargs):
+        time.sleep(delay)
+        if legacy_url in fail_urls:
+            return None, None
+        tempdir = tempfile.mkdtemp()
+        path = os.path.join(tempdir, legacy_url.rsplit("/", 1)[-1])
+        with open(path, "wb") as fd:
+            fd.write(b"x" * 10)
+        return tempdir, path
+
+    def fake_upload(path, ckan_obj, destination):
+        time.sleep(delay)
+        with lock:
+            uploads.append(ckan_obj["id"])
+        return True
+
+    def fake_patch(ckan, ckan_obj, filename, size):
+        return dict(ckan_obj, url="s3://" + filename, size=size, url_type="upload")
+
+    monkeypatch.setattr(reupload, "download_legacy_file", fake_download)
+    monkeypatch.setattr(reupload, "upload_to_s3", fake_upload)
+    monkeypatch.setattr(reupload, "patch_uploaded_resource", fake_patch)
+    return uploads
+
+
+def make_reuploads(n, shared=False):
+    return [
+        (
+            {
+                "id": "res-{}".format(i),
+                "md5": "abc" if shared else str(i),
+                "name": "common.xlsx" if shared else "file-{}".format(i),
+                "shared_file": shared,
+            },
+            "http://legacy.invalid/file-{}".format(i),
+        )
+        for i in range(n)
+    ]
+
+
+def test_reupload_pipeline_failures_remain(monkeypatch):
+    to_reupload = make_reuploads(10)
+    uploads = patch_stages(monkeypatch, fail_urls=(to_reupload[3][1],))
+    pipeline = ReuploadPipeline(RecordingCKAN(), "bucket/env", None, {})
+    remaining = pipeline.run(to_reupload)
+    assert remaining == [to_reupload[3]]
+    assert sorted(uploads) == sorted(
+        t["id"] for t, _ in to_reupload if t != remaining[0][0]
+    )
+
+
+def test_reupload_pipeline_shared_uploaded_once(monkeypatch):
+    to_reupload = make_reuploads(8, shared=True)
+    uploads = patch_stages(monkeypatch, fail_urls=(to_reupload[0][1],), delay=0.01)
+    ckan = RecordingCKAN()
+    shared_resources = {"abc/common.xlsx": [{"uploaded_resource": None}]}
+    pipeline = ReuploadPipeline(
+        ckan, "bucket/env", None, shared_resources, download_threads=4
+    )
+    remaining = pipeline.run(to_reupload)
+    # the first upload fails, the next resource for the key takes over
+    assert remaining == [to_reupload[0]]
+    assert uploads == ["res-1"]
+    assert sorted(t["id"] for t in ckan.updates) == [
+        "res-{}".format(i) for i in range(2, 8)
+    ]
+    assert all(t["url"] == "s3://file-1" for t in ckan.updates)
@@ -0,0 +1,286 @@
+import threading
+from hashlib import md5
+
+import pytest
+
+from .libs.multihash import make_multipart, generate_hashes
+from .ops import S3IndexArchiveInfo, check_resource
+from .s3 import (
+    choose_part_size,
+    read_inventory_csv,
+    list_resource_objects,
+    check_uploaded_etag,
+    http_range_reader,
+    stream_to_s3,
+    stream_file_to_s3,
+    S3_MAX_PARTS,
+    S3TransferException,
+)
+
+MB = 1 << 20
+
+
+class FakeS3:
+    """
+    in-memory stand-in for the subset of the boto3 S3 client used for uploads
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.lock = threading.Lock()
+        # hand back an ETag which doesn't match the uploaded parts
+        self.corrupt_etag = False
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = (Body, kwargs)
+        return {"ETag": '"%s"' % md5(Body).hexdigest()}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        with self.lock:
+            upload_id = "upload-%d" % len(self.uploads)
+            self.uploads[upload_id] = {"Key": Key, "Parts": {}, "kwargs": kwargs}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId]["Parts"][PartNumber] = Body
+        return {"ETag": '"%s"' % md5(Body).hexdigest()}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        upload = self.uploads.pop(UploadId)
+        parts = [upload["Parts"][t["PartNumber"]] for t in MultipartUpload["Parts"]]
+        self.objects[(Bucket, Key)] = (b"".join(parts), upload["kwargs"])
+        etag = make_multipart([md5(t).digest() for t in parts])
+        if self.corrupt_etag:
+            etag = md5(b"".join(parts)).hexdigest()
+        return {"ETag": '"%s"' % etag}
+
+    def list_multipart_uploads(self, Bucket, Prefix):
+        return {
+            "Uploads": [
+                {"Key": t["Key"], "UploadId": upload_id}
+                for upload_id, t in self.uploads.items()
+                if t["Key"].startswith(Prefix)
+            ]
+        }
+
+    def get_paginator(self, name):
+        fake = self
+        if name == "list_objects_v2":
+
+            class ObjectPaginator:
+                def paginate(self, Bucket, Prefix, StartAfter=""):
+                    keys = sorted(
+                        k
+                        for b, k in fake.objects
+                        if b == Bucket and k.startswith(Prefix) and k > StartAfter
+                    )
+                    # two keys per page, to exercise pagination
+                    for i in range(0, len(keys), 2):
+                        yield {
+                            "Contents": [
+                                {
+                                    "Key": k,
+                                    "Size": len(fake.objects[(Bucket, k)][0]),
+                                    "ETag": '"%s"'
+                                    % md5(fake.objects[(Bucket, k)][0]).hexdigest(),
+                                }
+                                for k in keys[i : i + 2]
+                            ]
+                        }
+
+            return ObjectPaginator()
+        assert name == "list_parts"
+
+        class Paginator:
+            def paginate(self, Bucket, Key, UploadId):
+                parts = fake.uploads[UploadId]["Parts"]
+                yield {
+                    "Parts": [
+                        {
+                            "PartNumber": n,
+                            "Size": len(body),
+                            "ETag": '"%s"' % md5(body).hexdigest(),
+                        }
+                        for n, body in parts.items()
+                    ]
+                }
+
+        return Paginator()
+
+
+def make_reader(data, reads, fail_once=()):
+    failed = set()
+
+    def read(start, length):
+        reads.append(start)
+        if start in fail_once and start not in failed:
+            failed.add(start)
+            raise IOError("connection reset")
+        return data[start : start + length]
+
+    return read
+
+
+def expected_etag(data, part_size):
+    return make_multipart(
+        [md5(data[i : i + part_size]).digest() for i in range(0, len(data), part_size)]
+    )
+
+
+def test_choose_part_size():
+    assert choose_part_size(0) == 8 * MB
+    assert choose_part_size(8 * MB * S3_MAX_PARTS) == 8 * MB
+    assert choose_part_size(8 * MB * S3_MAX_PARTS + 1) == 16 * MB
+    assert choose_part_size(100 * 1024 * MB * 10) == 128 * MB
+
+
+def test_stream_small_object():
+    client = FakeS3()
+    data = b"hello" * 100
+    etag = stream_to_s3(
+        make_reader(data, []), len(data), "bucket", "key", client=client
+    )
+    assert etag == md5(data).hexdigest()
+    body, kwargs = client.objects[("bucket", "key")]
+    assert body == data
+    assert kwargs["Tagging"] == "source=bpaingest"
+
+
+def test_stream_empty_object():
+    # no request is made for an empty range, so the URL is never fetched
+    client = FakeS3()
+    reader = http_range_reader("http://legacy.invalid/empty.fastq.gz", None)
+    etag = stream_to_s3(reader, 0, "bucket", "key", client=client)
+    assert etag == md5(b"").hexdigest()
+    assert client.objects[("bucket", "key")][0] == b""
+
+
+def test_stream_multipart_with_retry():
+    client = FakeS3()
+    part_size = MB
+    data = bytes(range(256)) * (4096 * 3 + 100)
+    reads = []
+    etag = stream_to_s3(
+        make_reader(data, reads, fail_once=(part_size,)),
+        len(data),
+        "bucket",
+        "key",
+        client=client,
+        part_size=part_size,
+        retries=2,
+    )
+    assert client.objects[("bucket", "key")][0] == data
+    assert etag == expected_etag(data, part_size)
+    # the failed part is re-read, and only that part
+    assert sorted(reads) == [0, part_size, part_size, 2 * part_size, 3 * part_size]
+
+
+def test_stream_multipart_resume():
+    client = FakeS3()
+    part_size = MB
+    data = b"x" * (3 * part_size + 5)
+    upload_id = client.create_multipart_upload(Bucket="bucket", Key="key")["UploadId"]
+    client.upload_part("bucket", "key", upload_id, 1, data[:part_size])
+    reads = []
+    etag = stream_to_s3(
+        make_reader(data, reads),
+        len(data),
+        "bucket",
+        "key",
+        client=client,
+        part_size=part_size,
+    )
+    assert sorted(reads) == [part_size, 2 * part_size, 3 * part_size]
+    assert client.objects[("bucket", "key")][0] == data
+    assert etag == expected_etag(data, part_size)
+
+
+def test_stream_multipart_etag_mismatch():
+    client = FakeS3()
+    client.corrupt_etag = True
+    data = b"x" * (2 * MB + 5)
+    with pytest.raises(S3TransferException, match="ETag mismatch"):
+        stream_to_s3(
+            make_reader(data, []),
+            len(data),
+            "bucket",
+            "key",
+            client=client,
+            part_size=MB,
+        )
+
+
+def test_file_upload_matches_multihash(tmp_path):
+    path = tmp_path / "reads.fastq.gz"
+    path.write_bytes(b"ACGT" * (9 * MB // 4))
+    resource = dict(id="res", **generate_hashes(str(path)))
+    client = FakeS3()
+    etag = stream_file_to_s3(str(path), "bucket", "key", client=client)
+    assert etag == resource["s3etag_8388608"]
+    assert etag.endswith("-2")
+    assert check_uploaded_etag(resource, etag, path.stat().st_size)
+    assert not check_uploaded_etag(resource, md5(b"").hexdigest(), 9 * MB)
+    assert check_uploaded_etag({"id": "res"}, etag, 9 * MB)
+
+
+def test_s3_index_archive_info(tmp_path):
+    client = FakeS3()
+    objects = {
+        "0a1b": ("reads 1.fastq.gz", b"x" * 10),
+        "0c2d": ("reads2.fastq.gz", b"y" * 20),
+        "f3e4": ("meta.xlsx", b"z" * 30),
+        "f5a6": ("meta2.xlsx", b"w" * 40),
+    }
+    for resource_id, (filename, data) in objects.items():
+        client.put_object(
+            Bucket="bucket",
+            Key="env/resources/%s/%s" % (resource_id, filename),
+            Body=data,
+        )
+    client.put_object(Bucket="bucket", Key="other/resources/0a1b/x", Body=b"")
+
+    class CKAN:
+        address = "https://ckan.invalid"
+
+    info = S3IndexArchiveInfo(CKAN(), "bucket/env", client=client)
+    url = "https://ckan.invalid/dataset/pkg/resource/0a1b/download/reads%201.fastq.gz"
+    assert info.get_size_and_etag(url) == (10, md5(b"x" * 10).hexdigest())
+    assert info.get_size_and_etag(url.replace("0a1b", "9999")) == (None, None)
+
+    class Legacy:
+        def get_size(self, url):
+            return 10
+
+    assert check_resource(info, Legacy(), url, "http://legacy/r", [None]) is None
+    assert check_resource(info, Legacy(), url, "http://legacy/r", ["other"]) == (
+        "wrong-etag"
+    )
+
+    # the same index, read from an inventory report
+    inventory = tmp_path / "inventory.csv"
+    inventory.write_text(
+        "\n".join(
+            '"bucket","%s","%d","%s"'
+            % (
+                k.replace(" ", "%20"),
+                len(body),
+                md5(body).hexdigest(),
+            )
+            for (b, k), (body, _) in sorted(client.objects.items())
+        )
+    )
+    assert read_inventory_csv(str(inventory), "bucket/env") == info._index
+
+
+def test_list_resource_objects_outside_shards():
+    # keys with a resource ID which isn't hexadecimal fall between the shards
+    client = FakeS3()
+    resource_ids = ["0a1b", "9f", "A1", "Z9", "_x", "-y", "f0", "zz-res", ":c"]
+    for resource_id in resource_ids:
+        client.put_object(
+            Bucket="bucket", Key="env/resources/%s/file" % resource_id, Body=b"x"
+        )
+    client.put_object(Bucket="bucket", Key="env/other/zz/file", Body=b"x")
+    index = list_resource_objects("bucket/env", client=client, num_threads=4)
+    assert sorted(index) == sorted((t, "file") for t in resource_ids)
@@ -0,0 +1,100 @@
+import ckanapi
+import pytest
+import requests
+
+from . import ops
+from .scheduler import (
+    SERVER_ERROR,
+    THROTTLED,
+    TIMEOUT,
+    CKANScheduler,
+    RetryBudget,
+    classify_error,
+)
+
+
+def http_error(status):
+    return ckanapi.errors.CKANAPIError(
+        repr(["http://ckan.invalid/api/action/package_show", status, "busy"])
+    )
+
+
+def test_classify_error():
+    assert classify_error(http_error(429)) == THROTTLED
+    assert classify_error(http_error(502)) == SERVER_ERROR
+    assert classify_error(requests.exceptions.ReadTimeout()) == TIMEOUT
+    assert classify_error(http_error(400)) is None
+    assert classify_error(ckanapi.errors.NotFound("gone")) is None
+    assert classify_error(ckanapi.errors.ValidationError({"name": "taken"})) is None
+
+
+class Flaky:
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return kwargs
+
+
+def scheduler(**kwargs):
+    return CKANScheduler(backoff_base=0, **kwargs)
+
+
+def test_retry_transient():
+    s = scheduler(max_rate=1000)
+    fn = Flaky(http_error(503), http_error(429))
+    assert s.call("package_patch", fn, id="a") == {"id": "a"}
+    assert fn.calls == 3
+    assert dict(s.retry_stats) == {
+        ("package_patch", SERVER_ERROR): 1,
+        ("package_patch", THROTTLED): 1,
+    }
+    # CKAN pushed back, so the rate has come down
+    assert s.limiter.rate < 1000
+
+
+def test_no_retry():
+    s = scheduler()
+    fn = Flaky(ckanapi.errors.NotFound("gone"))
+    with pytest.raises(ckanapi.errors.NotFound):
+        s.call("package_show", fn, id="a")
+    assert fn.calls == 1
+    # a create which reached CKAN may have been acted upon
+    fn = Flaky(http_error(500))
+    with pytest.raises(ckanapi.errors.CKANAPIError):
+        s.call("package_create", fn, name="a")
+    assert fn.calls == 1
+    fn = Flaky(http_error(429))
+    assert s.call("package_create", fn, name="a") == {"name": "a"}
+
+
+def test_attempts_and_budget():
+    s = scheduler()
+    fn = Flaky(*[http_error(502)] * 10)
+    with pytest.raises(ckanapi.errors.CKANAPIError):
+        s.call("package_patch", fn, id="a")
+    assert fn.calls == 3
+
+    s = scheduler(budget=RetryBudget(ratio=0, minimum=1))
+    fn = Flaky(*[http_error(502)] * 10)
+    with pytest.raises(ckanapi.errors.CKANAPIError):
+        s.call("package_show", fn, id="a")
+    assert fn.calls == 2
+
+
+def test_ckan_method_scheduled(monkeypatch):
+    s = scheduler()
+    monkeypatch.setattr(ops, "get_scheduler", lambda: s)
+
+    class CKAN:
+        pass
+
+    ckan = CKAN()
+    ckan.action = CKAN()
+    ckan.action.package_patch = Flaky(requests.exceptions.ConnectionError())
+    assert ops.apply_patch(ckan, "package", {"id": "a"}) == {"id": "a"}
+    assert dict(s.retry_stats) == {("package_patch", TIMEOUT): 1}
@@ -0,0 +1,94 @@
+import re
+
+from .pkgcache import iter_package_search
+from .statecache import CKANStateCache
+
+
+class SearchCKAN:
+    "package_search over an in-memory list, honouring the parameters we use"
+
+    address = "http://ckan.invalid"
+
+    def __init__(self, packages):
+        self.packages = packages
+        self.searches = []
+        self.action = self
+
+    def package_search(
+        self, q, include_private, rows, start=0, sort=None, fq=None, fl=None
+    ):
+        self.searches.append(dict(q=q, fq=fq, rows=rows, start=start, fl=fl))
+        typ = q.split(":", 1)[1]
+        matches = [t for t in self.packages if t["type"] == typ]
+        if fq is not None:
+            since = re.match(r"metadata_modified:\[(.*)Z TO \*\]", fq).group(1)
+            matches = [t for t in matches if t["metadata_modified"] >= since]
+        if sort is not None:
+            assert sort == "id asc"
+            matches.sort(key=lambda t: t["id"])
+        results = matches[start : start + rows]
+        if fl is not None:
+            results = [{"id": t["id"]} for t in results]
+        return {"count": len(matches), "results": results}
+
+
+def make_package(i, modified):
+    return {
+        "id": "pkg-%d" % i,
+        "name": "bpa-pkg-%d" % i,
+        "type": "test-type",
+        "metadata_modified": modified,
+        "resources": [{"id": "res-%d" % i, "md5": "md5-%d" % i, "name": "file-%d" % i}],
+    }
+
+
+def test_state_cache_incremental(tmp_path):
+    path = str(tmp_path / "state.sqlite")
+    packages = [
+        make_package(i, "2024-01-0%dT00:00:00.000001" % (i + 1)) for i in range(3)
+    ]
+    ckan = SearchCKAN(packages)
+
+    cache = CKANStateCache(path, ckan.address)
+    cache.refresh(ckan, "test-type")
+    assert [t["id"] for t in cache.packages_of_type("test-type")] == [
+        "pkg-0",
+        "pkg-1",
+        "pkg-2",
+    ]
+    assert cache.resource("res-1")["name"] == "file-1"
+    assert cache.resources_by_md5("md5-2", "file-2")[0]["id"] == "res-2"
+    cache.close()
+
+    # modify one package, delete another: only the modification is fetched
+    packages[0] = dict(make_package(0, "2024-02-01T00:00:00"), title="changed")
+    del packages[1]
+    ckan.searches = []
+    cache = CKANStateCache(path, ckan.address)
+    cache.refresh(ckan, "test-type")
+    assert ckan.searches[0]["fq"] == "metadata_modified:[2024-01-03T00:00:00Z TO *]"
+    assert [t["id"] for t in cache.packages_of_type("test-type")] == [
+        "pkg-0",
+        "pkg-2",
+    ]
+    assert cache.package("pkg-0")["title"] == "changed"
+    assert cache.resource("res-1") is None
+
+    # a cache built against another CKAN is discarded
+    cache = CKANStateCache(path, "http://other.invalid")
+    assert cache.packages_of_type("test-type") == []
+
+
+def test_iter_package_search_pages():
+    packages = [make_package(i, "2024-01-01T00:00:00") for i in range(50)]
+    ckan = SearchCKAN(list(reversed(packages)))
+    pages = list(
+        iter_package_search(
+            ckan, page_size=7, num_threads=3, q="type:test-type", include_private=True
+        )
+    )
+    assert [len(t) for t in pages] == [7] * 7 + [1]
+    assert [t["id"] for page in pages for t in page] == sorted(
+        t["id"] for t in packages
+    )
+    assert sorted(t["start"] for t in ckan.searches) == list(range(0, 50, 7))
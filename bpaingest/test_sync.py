@@ -0,0 +1,233 @@
+import threading
+import time
+
+import ckanapi
+
+from . import ops, sync
+from .ops import patch_if_required, object_fingerprint, FINGERPRINT_FIELD
+from .sync import sync_packages, check_resources
+
+
+class FakeAction:
+    def __init__(self, ckan):
+        self._ckan = ckan
+
+    def __getattr__(self, name):
+        return lambda **kwargs: self._ckan.call(name, kwargs)
+
+
+class FakeCKAN:
+    """
+    minimal in-memory stand-in for the CKAN action API, with a fixed latency
+    on every call so that concurrency can be observed
+    """
+
+    address = "http://ckan.invalid"
+    apikey = "key"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.packages = {}
+        self.action = FakeAction(self)
+        self.peak_in_flight = 0
+        self._active = 0
+        self._lock = threading.RLock()
+
+    def call(self, name, kwargs):
+        with self._lock:
+            self._active += 1
+            self.peak_in_flight = max(self.peak_in_flight, self._active)
+        time.sleep(self.latency)
+        with self._lock:
+            self._active -= 1
+            return self._dispatch(name, kwargs)
+
+    def _dispatch(self, name, kwargs):
+        if name == "package_search":
+            return {"count": len(self.packages), "results": []}
+        if name == "package_show":
+            for obj in self.packages.values():
+                if kwargs["id"] in (obj["id"], obj["name"]):
+                    return obj
+            raise ckanapi.errors.NotFound
+        if name == "package_create":
+            obj = dict(kwargs, state="active", tags=[], resources=[])
+            self.packages[obj["id"]] = obj
+            return obj
+        if name == "package_patch":
+            self.packages[kwargs["id"]].update(kwargs)
+            return self.packages[kwargs["id"]]
+        raise NotImplementedError(name)
+
+
+def make_packages(n):
+    return [
+        {
+            "id": "pkg-{:04d}".format(i),
+            "name": "bpa-test-{:04d}".format(i),
+            "type": "test-type",
+            "private": True,
+            "resource_permissions": "",
+            "access_control_reason": "",
+            "access_control_date": "",
+            "access_control_mode": "",
+            "title": "package {}".format(i),
+            "tags": [],
+        }
+        for i in range(n)
+    ]
+
+
+def test_sync_packages_ordered():
+    ckan = FakeCKAN()
+    packages = make_packages(50)
+    synced = sync_packages(
+        ckan, "test-type", list(reversed(packages)), {"id": "org"}, None, False, None, 8
+    )
+    assert [t["name"] for t in synced] == sorted(t["name"] for t in packages)
+    assert all(t["owner_org"] == "org" for t in synced)
+
+
+def test_sync_packages_concurrent():
+    def peak_in_flight(num_threads):
+        ckan = FakeCKAN(latency=0.005)
+        sync_packages(
+            ckan,
+            "test-type",
+            make_packages(40),
+            {"id": "org"},
+            None,
+            False,
+            None,
+            num_threads,
+        )
+        return ckan.peak_in_flight
+
+    assert peak_in_flight(1) == 1
+    assert 1 < peak_in_flight(8) <= 8
+
+
+def test_check_resources_concurrent(monkeypatch):
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def fake_check_resource(
+        ckan_archive_info, apache_archive_info, current_url, legacy_url, etags
+    ):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+        time.sleep(0.005)
+        with lock:
+            in_flight[0] -= 1
+        if int(current_url.rsplit("/", 1)[-1]) % 3 == 0:
+            return "wrong-size"
+
+    monkeypatch.setattr(sync, "check_resource", fake_check_resource)
+    resources = [
+        {"id": "res-{}".format(i), "url": "http://ckan.invalid/{}".format(i)}
+        for i in range(30)
+    ]
+    legacy_urls = {t["id"]: "http://legacy.invalid/" + t["id"] for t in resources}
+    to_reupload = check_resources(FakeCKAN(), resources, legacy_urls, None, 10)
+    assert 1 < in_flight[1] <= 10
+    assert to_reupload == [
+        (t, legacy_urls[t["id"]]) for i, t in enumerate(resources) if i % 3 == 0
+    ]
+
+
+class PatchCountingCKAN(FakeCKAN):
+    def __init__(self):
+        super().__init__()
+        self.patches = []
+
+    def call(self, name, kwargs):
+        if name == "package_patch":
+            self.patches.append(kwargs)
+        return super().call(name, kwargs)
+
+
+def test_patch_if_required_fingerprint(monkeypatch):
+    ckan = PatchCountingCKAN()
+    ckan.packages["pkg"] = {"id": "pkg", "title": "a", "tags": []}
+    patch_obj = {"id": "pkg", "title": "a", "tags": []}
+
+    # nothing differs, but the fingerprint is recorded
+    was_patched, obj, fingerprint_only = patch_if_required(
+        ckan, "package", ckan.packages["pkg"], patch_obj, fingerprint=True
+    )
+    assert not was_patched
+    assert fingerprint_only
+    assert len(ckan.patches) == 1
+    assert obj[FINGERPRINT_FIELD] == object_fingerprint(patch_obj)
+
+    # with the fingerprint in place, the comparison is skipped
+    def no_diff(*args, **kwargs):
+        raise AssertionError("diff_objects called")
+
+    monkeypatch.setattr(ops, "diff_objects", no_diff)
+    was_patched, obj, fingerprint_only = patch_if_required(
+        ckan, "package", obj, dict(patch_obj), fingerprint=True
+    )
+    assert not was_patched
+    assert not fingerprint_only
+    assert len(ckan.patches) == 1
+    monkeypatch.undo()
+
+    # a change is patched, with the new fingerprint
+    changed = dict(patch_obj, title="b")
+    was_patched, obj, fingerprint_only = patch_if_required(
+        ckan, "package", obj, changed, fingerprint=True
+    )
+    assert was_patched
+    assert not fingerprint_only
+    assert obj["title"] == "b"
+    assert obj[FINGERPRINT_FIELD] == object_fingerprint(changed)
+
+
+def test_object_fingerprint_canonical():
+    a = {"id": "x", "tags": [{"name": "b"}, {"name": "a"}], "size": 10}
+    b = {"size": "10", "tags": [{"name": "a"}, {"name": "b"}], "id": "x"}
+    assert object_fingerprint(a) == object_fingerprint(b)
+    assert object_fingerprint(a) == object_fingerprint(
+        dict(a, **{FINGERPRINT_FIELD: "old"})
+    )
+    assert object_fingerprint(a) != object_fingerprint(dict(a, size=11))
+
+
+def test_find_shared_resources():
+    def shared(resource_id, package_id, md5="abc", name="common.xlsx"):
+        return {
+            "id": resource_id,
+            "package_id": package_id,
+            "md5": md5,
+            "name": name,
+            "shared_file": True,
+        }
+
+    resource_idx = {
+        "p1": [shared("r1", "p1"), shared("r2", "p1", md5="def")],
+        "p2": [shared("r3", "p2"), shared("r4", "p2", md5="def")],
+        "p3": [shared("r5", "p3", md5="ghi"), shared("r6", "p3", md5="ghi")],
+    }
+    # only the resources of p1 and p2 are in the cache
+    resource_cache = {
+        "r1": {"id": "r1", "url_type": ""},
+        "r2": {"id": "r2", "url_type": ""},
+        "r3": {"id": "r3", "url_type": "upload"},
+        "r4": {"id": "r4", "url_type": ""},
+    }
+    looked_up = []
+
+    def get_uploaded(ckan, obj):
+        looked_up.append(obj["id"])
+        return {"id": obj["id"], "url_type": "upload"} if obj["id"] == "r6" else None
+
+    shared_resources = sync.find_shared_resources(
+        None, resource_idx, resource_cache=resource_cache, get_uploaded=get_uploaded
+    )
+    assert shared_resources["abc/common.xlsx"][0]["uploaded_resource"]["id"] == "r3"
+    # every copy is in the cache, and none is uploaded
+    assert shared_resources["def/common.xlsx"][0]["uploaded_resource"] is None
+    assert shared_resources["ghi/common.xlsx"][0]["uploaded_resource"]["id"] == "r6"
+    assert looked_up == ["r5", "r6"]
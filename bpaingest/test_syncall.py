@@ -0,0 +1,70 @@
+import threading
+
+from .metadata import DownloadMetadata
+from .syncall import select_projects, split_budget, sync_projects
+
+
+def test_select_projects():
+    slugs = ["amd-metagenomics", "amd-amplicons", "gap-illumina", "tsi-pacbio"]
+    assert select_projects(slugs, []) == sorted(slugs)
+    assert select_projects(slugs, ["amd-.*", "tsi-pacbio"]) == [
+        "amd-amplicons",
+        "amd-metagenomics",
+        "tsi-pacbio",
+    ]
+    # patterns match the whole slug
+    assert select_projects(slugs, ["amd"]) == []
+
+
+def test_split_budget():
+    assert split_budget(16, 4) == 4
+    assert split_budget(3, 4) == 1
+
+
+class Contextual:
+    name = "contextual"
+    metadata_urls = []
+    loaded = 0
+
+    def __init__(self, logger, path):
+        type(self).loaded += 1
+
+
+class Project:
+    auth = ("user", "password")
+    metadata_urls = []
+    contextual_classes = [Contextual]
+
+    def __init__(self, logger, path, metadata_info=None, contextual_metadata=None):
+        self.contextual_metadata = contextual_metadata
+
+
+def make_project(fail=False):
+    class P(Project):
+        pass
+
+    P.fail = fail
+    return P
+
+
+def test_sync_projects(tmp_path):
+    projects = dict(("project-%d" % i, make_project(fail=(i == 2))) for i in range(6))
+    synced = {}
+    lock = threading.Lock()
+
+    def sync_project(slug, dlmeta, num_threads):
+        assert isinstance(dlmeta, DownloadMetadata)
+        if dlmeta.project_class.fail:
+            raise Exception("failed")
+        with lock:
+            synced[slug] = (dlmeta.meta.contextual_metadata[0], num_threads)
+
+    results = sync_projects(
+        projects, sync_project, download_path=str(tmp_path), max_projects=3, workers=9
+    )
+    assert sorted(synced) == sorted(set(projects) - {"project-2"})
+    assert [slug for slug, e in results.items() if e is not None] == ["project-2"]
+    # the contextual metadata is loaded once, and shared
+    assert Contextual.loaded == 1
+    assert len(set(id(t[0]) for t in synced.values())) == 1
+    assert all(t[1] == 3 for t in synced.values())
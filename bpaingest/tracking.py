@@ -1,4 +1,6 @@
 import os
+import threading
+from collections import defaultdict
 from .util import make_logger, csv_to_named_tuple, one
 from glob import glob
 
@@ -15,6 +17,35 @@ def get_track_csv(platform, glob_pattern, project=None):
     return one(glob(os.path.join(get_track_dir(platform, project), glob_pattern)))
 
 
+class TrackRegistry:
+    """
+    the tracking sheets are read by many projects: when several are synced in
+    one process (see `sync-all`), each sheet is read once, and the parsed
+    result shared. the results must be treated as read-only.
+    """
+
+    def __init__(self):
+        self._results = {}
+        self._lock = threading.Lock()
+        self._key_locks = defaultdict(threading.Lock)
+
+    def get(self, key, read_fn):
+        "the result of `read_fn()`, called only the first time `key` is seen"
+        with self._lock:
+            key_lock = self._key_locks[key]
+        with key_lock:
+            if key not in self._results:
+                self._results[key] = read_fn()
+            return self._results[key]
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+
+track_registry = TrackRegistry()
+
+
 class GoogleDriveTrackMetadata:
     platform = "google-drive"
 
@@ -23,7 +54,9 @@ class GoogleDriveTrackMetadata:
         logger.info("Reading track CSV file: " + fname)
         if not hasattr(self, "skip_tracking_rows"):
             self.skip_tracking_rows = 0
-        self.track_meta = self.read_track_csv(fname)
+        self.track_meta = track_registry.get(
+            (type(self), fname), lambda: self.read_track_csv(fname)
+        )
 
     def read_track_csv(self, fname):
         header, rows = csv_to_named_tuple(
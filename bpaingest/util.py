@@ -6,8 +6,10 @@ import re
 import string
 from collections import namedtuple
 from hashlib import md5
+from urllib.parse import unquote, urlparse
 
 import ckanapi
+import requests
 from dateutil.relativedelta import relativedelta
 
 
@@ -35,8 +37,8 @@ def validate_write_reuploads_interval(logger, args):
         raise Exception(
             f"To use cache reuploads write interval, the interval must be an integer and cache write reuploads must be enabled."
         )
-    logger.info(
-        f"Activated write reuploads interval of {args.write_reuploads_interval}"
+    logger.warning(
+        f"Write reuploads interval is no longer required: the reupload journal records each upload as it completes."
     )
     return args.write_reuploads_interval
 
@@ -50,7 +52,7 @@ def make_reuploads_cache_path(logger, args):
         )
     reuploads_dir = os.path.join(args.download_path, args.project_name)
     os.makedirs(reuploads_dir, exist_ok=True)
-    reupload_path = os.path.join(reuploads_dir, "reupload_resources.dump")
+    reupload_path = os.path.join(reuploads_dir, "reuploads.sqlite")
     msg_activation = f"Activated reupload cache at {reupload_path} for"
     if args.read_reuploads:
         msg_activation += " reads"
@@ -60,6 +62,30 @@ def make_reuploads_cache_path(logger, args):
     return reupload_path
 
 
+def make_state_cache_path(logger, args):
+    if not getattr(args, "state_cache", False):
+        return None
+    if not args.download_path:
+        raise Exception("To use the CKAN state cache, download_path must also be set.")
+    os.makedirs(args.download_path, exist_ok=True)
+    state_cache_path = os.path.join(args.download_path, "ckan-state.sqlite")
+    logger.info(f"Activated CKAN state cache at {state_cache_path}")
+    return state_cache_path
+
+
+def make_check_cache_path(logger, args):
+    if not getattr(args, "check_cache", False):
+        return None
+    if not args.download_path:
+        raise Exception(
+            "To use the resource check cache, download_path must also be set."
+        )
+    os.makedirs(args.download_path, exist_ok=True)
+    check_cache_path = os.path.join(args.download_path, "resource-checks.sqlite")
+    logger.info(f"Activated resource check cache at {check_cache_path}")
+    return check_cache_path
+
+
 def prune_dict(d, keys):
     if d is None:
         return None
@@ -118,9 +144,31 @@ def logger_wrap(func):
     return wrap
 
 
+def make_ckan_session(pool_size):
+    "a requests session, holding up to `pool_size` keep-alive connections"
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 def make_ckan_api(args):
+    """
+    all CKAN calls share one pooled session, and pass through a scheduler
+    which limits their rate and concurrency, see `ops.ckan_method`
+    """
+    from .scheduler import configure_scheduler
+
+    concurrency = getattr(args, "ckan_concurrency", None) or 16
+    configure_scheduler(
+        max_rate=getattr(args, "ckan_rate", None), max_concurrency=concurrency
+    )
     ckan = ckanapi.RemoteCKAN(
-        args.ckan_url, apikey=args.api_key, verify_ssl=args.verify_ssl
+        args.ckan_url,
+        apikey=args.api_key,
+        verify_ssl=args.verify_ssl,
+        session=make_ckan_session(concurrency),
     )
     return ckan
 
@@ -291,3 +339,12 @@ def get_md5_legacy_url(meta):
 
 
 logger = make_logger(__name__)
+
+
+def localpath(mirror_path, legacy_url):
+    "the path of `legacy_url` (percent-encoded) in a filesystem mirror of the archive"
+    path = unquote(urlparse(legacy_url).path)
+    if path.startswith("/bpa/"):
+        path = path[5:]
+    path = path.lstrip("/")
+    return os.path.join(mirror_path, path)
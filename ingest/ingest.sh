@@ -21,6 +21,10 @@
 # in local dev, running a single project component:
 # DEV_MODE=1 ./ingest.sh sync <x> run stemcells-singlecellrnaseq
 #
+# to sync many projects in a single process, sharing one CKAN client and the
+# contextual metadata, use bpa-ingest directly; the slugs are regular expressions:
+# bpa-ingest sync-all -k "$apikey" -u "$CKAN_URL" --projects 4 --workers 16 'amd-.*'
+#
 # to pass additional flags to bpa-ingest, set INGEST_ARGS:
 # INGEST_ARGS="--skip-resource-checks" ./ingest.sh sync <x> run stemcells-singlecellrnaseq
 #